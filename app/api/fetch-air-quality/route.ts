@@ -7,10 +7,62 @@ import path from 'path';
 
 const execPromise = promisify(exec);
 
+// Resident Python data service (`python3 fast_air_quality.py --serve`)
+const DATA_SERVICE_URL = process.env.AIR_QUALITY_SERVICE_URL || 'http://127.0.0.1:8765';
+
+// Latency budget of a source run; sources still running then are reported as timed out
+const SOURCES_BUDGET_SECONDS = 90;
+
+// Extra time allowed for the interpreter to start and write metadata.json after the budget
+const SOURCES_GRACE_MS = 15000;
+
+// Ask the resident data service to run the source fetchers; null if it is not running
+async function fetchSourcesFromDataService() {
+  try {
+    const response = await fetch(`${DATA_SERVICE_URL}/fetch-sources`, {
+      method: 'POST',
+      cache: 'no-store',
+      signal: AbortSignal.timeout(SOURCES_BUDGET_SECONDS * 1000 + SOURCES_GRACE_MS)
+    });
+    if (!response.ok) {
+      console.warn(`Data service responded with ${response.status}`);
+      return null;
+    }
+    return await response.json();
+  } catch {
+    // Service not running - fall back to spawning the script
+    return null;
+  }
+}
+
+function readMetadata() {
+  const metadataPath = path.join(process.cwd(), 'data', 'api_data', 'metadata.json');
+  
+  if (fs.existsSync(metadataPath)) {
+    const metadataContent = fs.readFileSync(metadataPath, 'utf-8');
+    return JSON.parse(metadataContent);
+  }
+  return null;
+}
+
 export async function POST() {
   try {
+    // Prefer the warm resident service over spawning a new interpreter
+    const serviceResult = await fetchSourcesFromDataService();
+    if (serviceResult) {
+      return NextResponse.json({
+        success: true,
+        message: 'Data fetched successfully',
+        output: '',
+        metadata: readMetadata()
+      });
+    }
+    
     // Execute the Python controller script
-    const { stdout, stderr } = await execPromise('python3 run_air_quality_apis.py');
+    const { stdout, stderr } = await execPromise(
+      `python3 run_air_quality_apis.py --budget ${SOURCES_BUDGET_SECONDS}`,
+      { timeout: SOURCES_BUDGET_SECONDS * 1000 + SOURCES_GRACE_MS }
+    );
     
     if (stderr) {
       console.error('Error from Python script:', stderr);
@@ -21,13 +73,7 @@ export async function POST() {
     }
     
     // Try to read the metadata file to get the results
-    const metadataPath = path.join(process.cwd(), 'data', 'api_data', 'metadata.json');
-    let metadata = null;
-    
-    if (fs.existsSync(metadataPath)) {
-      const metadataContent = fs.readFileSync(metadataPath, 'utf-8');
-      metadata = JSON.parse(metadataContent);
-    }
+    const metadata = readMetadata();
     
     return NextResponse.json({
       success: true,
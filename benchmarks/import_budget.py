@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Import-time budget check for the Python entry points.
+Imports every entry point in a fresh interpreter under `python -X importtime`
+and fails when its cumulative import time goes over its budget, or when it
+pulls in one of the heavy packages (pandas, numpy, pyarrow, requests) that
+are only meant to be imported on first use.
+
+Each entry point is imported several times and the fastest run is compared,
+so a busy machine does not fail the check by itself. The heaviest imports
+of any failing entry point are listed to show what to make lazy.
+
+Usage:
+    python3 benchmarks/import_budget.py
+    python3 benchmarks/import_budget.py --only fast_air_quality --runs 10
+    python3 benchmarks/import_budget.py --scale 2     # slower machine
+
+No external packages are required.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Cumulative import time allowed per entry point, in milliseconds
+IMPORT_BUDGETS_MS = {
+    "fast_air_quality": 40,
+    "run_air_quality_apis": 25,
+    "AirNow": 30,
+    "EPA": 30,
+    "OpenAQ": 30,
+    "WAQI": 30
+}
+
+# Packages no entry point may import at startup
+FORBIDDEN_MODULES = ("pandas", "numpy", "pyarrow", "requests")
+
+# Imports listed for an entry point over its budget
+SHOW_HEAVIEST = 10
+
+def import_times(module, cwd):
+    """
+    Import a module in a fresh interpreter and collect its -X importtime report.
+
+    Parameters:
+    - module (str): Module to import
+    - cwd (str): Working directory of the interpreter (entry points may
+      create data directories relative to it)
+
+    Returns:
+    - List of (module name, self microseconds, cumulative microseconds), in
+      the order the report lists them
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT_DIR, os.path.join(ROOT_DIR, "script")] +
+                                        ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=cwd, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip()}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # Column header
+        entries.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+    return entries
+
+def check(module, budget_ms, runs, cwd):
+    """
+    Check one entry point against its budget.
+
+    Returns:
+    - Dictionary with the fastest cumulative time, the forbidden modules
+      imported and the heaviest imports of the fastest run
+    """
+    best = None
+    for _ in range(runs):
+        entries = import_times(module, cwd)
+        total = next((cumulative for name, _, cumulative in entries if name == module), None)
+        if total is None:
+            raise RuntimeError(f"No import time reported for {module}")
+        if best is None or total < best[0]:
+            best = (total, entries)
+
+    total, entries = best
+    names = {name for name, _, _ in entries}
+    forbidden = sorted(m for m in FORBIDDEN_MODULES if m in names)
+    heaviest = sorted(entries, key=lambda entry: entry[1], reverse=True)[:SHOW_HEAVIEST]
+    return {
+        "ms": total / 1000,
+        "budget_ms": budget_ms,
+        "forbidden": forbidden,
+        "heaviest": [(name, own / 1000) for name, own, _ in heaviest],
+        "passed": total / 1000 <= budget_ms and not forbidden
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the Python entry points")
+    parser.add_argument("--only", action="append", choices=sorted(IMPORT_BUDGETS_MS),
+                        help="Check only these entry points (repeatable)")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Imports per entry point; the fastest is compared (default: 5)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply every budget, for slower machines (default: 1.0)")
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory(prefix="import-budget-") as cwd:
+        for module in args.only or IMPORT_BUDGETS_MS:
+            result = check(module, IMPORT_BUDGETS_MS[module] * args.scale, max(args.runs, 1), cwd)
+            status = "ok" if result["passed"] else "FAIL"
+            print(f"{module:<22} {result['ms']:8.1f} ms  (budget {result['budget_ms']:.0f} ms)  {status}")
+            if result["forbidden"]:
+                print(f"    imports {', '.join(result['forbidden'])} at startup")
+            if not result["passed"]:
+                failed.append(module)
+                for name, ms in result["heaviest"]:
+                    print(f"    {ms:8.1f} ms  {name}")
+
+    if failed:
+        print(f"\nOver budget: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
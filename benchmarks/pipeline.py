@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the fetch, parse, transform and write pipeline.
+Times every stage in an isolated temporary working directory:
+
+- fetch_*: each source fetcher's request plus normalization, against a
+  local stub HTTP server that replays the source's payload
+- normalize_*: to_measurements on large synthetic OpenAQ and EPA records,
+  and decoding plus normalizing a whole OpenAQ response body
+- store_append / ingest: measurement store writes, alone and with the
+  station index, rollups and correlation updates
+- route_optimization / get_all_data_*: the dashboard datasets, built
+  fresh and served from the cache
+
+Results are written as JSON. With --baseline, every benchmark is compared
+to a saved run and the script exits non-zero when one is slower than the
+baseline by more than its threshold. Baselines are machine-specific, so
+save one with --save-baseline on the machine that runs the comparison.
+
+Replay recorded responses instead of the synthetic ones by putting
+airnow.json, epa.json, openaq.json and/or waqi.json in a directory and
+passing --payloads.
+
+Usage:
+    python3 benchmarks/pipeline.py --save-baseline benchmarks/baseline.json
+    python3 benchmarks/pipeline.py --baseline benchmarks/baseline.json
+    python3 benchmarks/pipeline.py --only fetch --repeat 10
+
+Requirements:
+- requests
+- pandas
+- pyarrow
+- numpy
+
+Install with: pip install requests pandas pyarrow numpy
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "script"))
+sys.path.insert(0, ROOT_DIR)
+
+# Allowed slowdown over the baseline before a benchmark fails (0.25 = 25% slower)
+DEFAULT_THRESHOLD = 0.25
+
+# Looser thresholds for benchmarks dominated by sockets, threads and processes
+THRESHOLDS = {
+    "fetch_airnow": 0.5,
+    "fetch_epa": 0.5,
+    "fetch_openaq": 0.5,
+    "fetch_waqi": 0.5,
+    "normalize_openaq_body": 0.5
+}
+
+# Stations of the synthetic payloads are spread around this point
+CENTER = (27.7172, 85.3240)
+
+WAQI_CITIES = ["Kathmandu", "Lalitpur", "Bhaktapur", "Kirtipur", "Thimi",
+               "Banepa", "Dhulikhel", "Panauti", "Hetauda", "Pokhara"]
+
+def synthetic_openaq(rows, seed=0, stations=50):
+    """OpenAQ v2 measurement results, hourly per station, newest last."""
+    rng = random.Random(seed)
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    parameters = [("pm25", "µg/m³"), ("pm10", "µg/m³"), ("no2", "ppm"), ("o3", "ppm")]
+    coordinates = [(CENTER[0] + rng.uniform(-0.15, 0.15), CENTER[1] + rng.uniform(-0.15, 0.15))
+                   for _ in range(stations)]
+    per_hour = stations * len(parameters)
+    hours = -(-rows // per_hour)
+    results = []
+    for i in range(rows):
+        station = i % stations
+        parameter, unit = parameters[(i // stations) % len(parameters)]
+        hour = end - timedelta(hours=hours - 1 - i // per_hour)
+        value = rng.uniform(5, 150) if unit == "µg/m³" else rng.uniform(0.001, 0.08)
+        results.append({
+            "locationId": 1000 + station,
+            "location": f"Station {station}",
+            "parameter": parameter,
+            "value": round(value, 3),
+            "date": {"utc": hour.isoformat(), "local": hour.isoformat()},
+            "unit": unit,
+            "coordinates": {"latitude": coordinates[station][0], "longitude": coordinates[station][1]},
+            "country": "NP",
+            "city": "Kathmandu"
+        })
+    return results
+
+def synthetic_epa(rows, seed=0):
+    """AQS sampleData records for three sites and two parameters."""
+    rng = random.Random(seed)
+    sites = [("36", "081", "0124", 40.7366, -73.8231), ("06", "037", "1103", 34.0668, -118.2270),
+             ("48", "201", "1039", 29.6700, -95.1285)]
+    parameters = [("88101", "Micrograms/cubic meter (LC)"), ("44201", "Parts per million")]
+    start = datetime(2026, 1, 1)
+    records = []
+    for i in range(rows):
+        state, county, site, lat, lon = sites[i % len(sites)]
+        code, unit = parameters[(i // len(sites)) % len(parameters)]
+        moment = start + timedelta(hours=i // (len(sites) * len(parameters)))
+        records.append({
+            "state_code": state, "county_code": county, "site_number": site,
+            "parameter_code": code, "latitude": lat, "longitude": lon,
+            "date_gmt": moment.strftime("%Y-%m-%d"), "time_gmt": moment.strftime("%H:%M"),
+            "date_local": moment.strftime("%Y-%m-%d"), "time_local": moment.strftime("%H:%M"),
+            "sample_measurement": round(rng.uniform(1, 60) if code == "88101" else rng.uniform(0.01, 0.08), 3),
+            "units_of_measure": unit, "method_code": "170", "poc": 1
+        })
+    return records
+
+def synthetic_airnow(rows=12, seed=0):
+    """AirNow current observations for one lat/long query."""
+    rng = random.Random(seed)
+    today = datetime.now().strftime("%Y-%m-%d ")
+    names = ["O3", "PM2.5", "PM10"]
+    return [{
+        "DateObserved": today, "HourObserved": 12, "LocalTimeZone": "EST",
+        "ReportingArea": f"Area {i // len(names)}", "StateCode": "NY",
+        "Latitude": 40.7 + i * 0.01, "Longitude": -74.0 - i * 0.01,
+        "ParameterName": names[i % len(names)], "AQI": rng.randint(10, 180),
+        "Category": {"Number": 2, "Name": "Moderate"}
+    } for i in range(rows)]
+
+class StubServer:
+    """Local HTTP server answering every source's endpoint with a fixed payload."""
+
+    def __init__(self, payloads):
+        bodies = {name: json.dumps(payload).encode("utf-8") for name, payload in payloads.items()
+                  if name != "openaq"}
+        openaq = payloads["openaq"]
+        empty = json.dumps({"meta": {"found": len(openaq)}, "results": []}).encode("utf-8")
+        pages = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.startswith("/aq/observation"):
+                    body = bodies["airnow"]
+                elif url.path.startswith("/data/api/sampleData"):
+                    body = bodies["epa"]
+                elif url.path.startswith("/feed/"):
+                    body = bodies["waqi"]
+                elif url.path.startswith("/v2/measurements"):
+                    limit = int(query.get("limit", ["1000"])[0])
+                    page = int(query.get("page", ["1"])[0])
+                    key = (limit, page)
+                    if key not in pages:
+                        results = openaq[(page - 1) * limit:page * limit]
+                        pages[key] = json.dumps({"meta": {"found": len(openaq)}, "results": results}).encode("utf-8") \
+                            if results else empty
+                    body = pages[key]
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def load_payloads(directory, rows):
+    """Recorded payloads from a directory, with synthetic ones for the rest."""
+    from waqi_parse import synthetic_feed
+
+    payloads = {
+        "airnow": synthetic_airnow(),
+        "epa": {"Header": [{"status": "Success", "rows": rows // 10}], "Data": synthetic_epa(rows // 10)},
+        "openaq": synthetic_openaq(rows // 10),
+        "waqi": json.loads(synthetic_feed(1))
+    }
+    if directory:
+        for name in payloads:
+            path = os.path.join(directory, f"{name}.json")
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    payload = json.load(f)
+                # Recorded OpenAQ responses hold the page envelope; the stub pages the results itself
+                payloads[name] = payload.get("results", payload) if name == "openaq" and isinstance(payload, dict) else payload
+    return payloads
+
+def measure(fn, repeat, items=None, setup=None):
+    """
+    Time fn repeatedly.
+
+    Parameters:
+    - fn (callable): Code under test
+    - repeat (int): Number of timed runs
+    - items (int, optional): Work items per run, for a throughput figure
+    - setup (callable, optional): Untimed preparation before every run
+
+    Returns:
+    - Dictionary with 'seconds' (best run), 'median', 'runs' and, with
+      items, 'items' and 'items_per_second'
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    result = {"seconds": min(times), "median": statistics.median(times), "runs": repeat}
+    if items:
+        result["items"] = items
+        result["items_per_second"] = round(items / min(times), 1)
+    return result
+
+def fetch_benchmarks(server, repeat):
+    """Per-source fetch plus parse against the stub server."""
+    import AirNow
+    import EPA
+    import OpenAQ
+    import WAQI
+    from rate_limit import scheduler
+
+    host = urlparse(server.url).netloc
+    scheduler.quotas[host] = (1e6, 1e6)
+    AirNow.BASE_URL = f"{server.url}/aq/observation/latLong/current/"
+    EPA.BASE_URL = f"{server.url}/data/api/sampleData/bysite"
+    OpenAQ.BASE_URL = f"{server.url}/v2/measurements"
+    WAQI.FEED_URL = server.url + "/feed/{station}/"
+
+    def forget(module):
+        # Identical replayed bodies would otherwise be skipped as unchanged
+        return lambda: module.watermarks.validators.clear()
+
+    def airnow():
+        for lat, lon, _ in AirNow.LOCATIONS:
+            for distance in (10, 25, 50, 100):
+                AirNow.fetch_airnow_data("key", lat, lon, distance)
+
+    def epa():
+        for site in EPA.MONITORING_SITES:
+            EPA.fetch_epa_data("user@example.com", "key", site["state"], site["county"],
+                               site["site"], "88101", "20260101", "20260131")
+
+    def openaq():
+        for _ in OpenAQ.iter_openaq_pages("NP", "Kathmandu", "pm25", page_size=1000):
+            pass
+
+    def waqi():
+        WAQI.to_measurements(WAQI.fetch_waqi_batch(WAQI_CITIES))
+
+    return {
+        "fetch_airnow": measure(airnow, repeat, items=len(AirNow.LOCATIONS) * 4, setup=forget(AirNow)),
+        "fetch_epa": measure(epa, repeat, items=len(EPA.MONITORING_SITES), setup=forget(EPA)),
+        "fetch_openaq": measure(openaq, repeat, setup=forget(OpenAQ)),
+        "fetch_waqi": measure(waqi, repeat, items=len(WAQI_CITIES), setup=forget(WAQI))
+    }
+
+def normalize_benchmarks(rows, repeat):
+    """to_measurements on large synthetic responses."""
+    import EPA
+    import OpenAQ
+    from normalize import normalize_body
+
+    openaq = synthetic_openaq(rows)
+    epa = synthetic_epa(rows)
+    body = json.dumps({"meta": {"found": rows}, "results": openaq}).encode()
+    return {
+        "normalize_openaq": measure(lambda: OpenAQ.to_measurements(openaq), repeat, items=rows),
+        "normalize_epa": measure(lambda: EPA.to_measurements(epa), repeat, items=rows),
+        "normalize_openaq_body": measure(lambda: normalize_body(OpenAQ.SCHEMA, body), repeat, items=rows)
+    }
+
+def storage_benchmarks(rows, repeat):
+    """Measurement store writes, alone and through the full ingest path."""
+    import OpenAQ
+    from ingest import ingest
+    from storage import MeasurementStore
+
+    measurements = OpenAQ.to_measurements(synthetic_openaq(rows, seed=1))
+    scratch = MeasurementStore("air_quality_data/benchmark_store")
+
+    def clear():
+        shutil.rmtree(scratch.root, ignore_errors=True)
+
+    result = {"store_append": measure(lambda: scratch.append(measurements), repeat, items=rows, setup=clear)}
+    clear()
+    # Every run adds the batch again, which also leaves local data for the dashboard benchmarks
+    result["ingest"] = measure(lambda: ingest(measurements), repeat, items=rows)
+    return result
+
+def dataset_benchmarks(repeat):
+    """Dashboard datasets, built fresh and read from the cache."""
+    import fast_air_quality
+
+    def quiet(fn):
+        def run():
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                fn()
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        return run
+
+    cold = quiet(lambda: fast_air_quality.get_all_data(force_refresh=True))
+    warm = quiet(fast_air_quality.get_all_data)
+    result = {
+        "route_optimization": measure(fast_air_quality.generate_route_optimization_data, repeat),
+        "get_all_data_cold": measure(cold, repeat)
+    }
+    result["get_all_data_warm"] = measure(warm, repeat, setup=fast_air_quality.wait_for_refreshes)
+    fast_air_quality.wait_for_refreshes()
+    return result
+
+def compare(results, baseline, threshold):
+    """
+    Compare results to a baseline.
+
+    Returns:
+    - List of (name, baseline seconds, seconds, ratio, allowed ratio, ok)
+    """
+    rows = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        allowed = 1 + THRESHOLDS.get(name, threshold)
+        ratio = result["seconds"] / previous["seconds"] if previous["seconds"] else 1.0
+        rows.append((name, previous["seconds"], result["seconds"], ratio, allowed, ratio <= allowed))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the air quality data pipeline")
+    parser.add_argument("--rows", type=int, default=50000, help="Rows in the synthetic normalization and storage inputs")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark")
+    parser.add_argument("--only", help="Only run benchmarks whose group or name contains this text")
+    parser.add_argument("--payloads", help="Directory of recorded source payloads to replay")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results")
+    parser.add_argument("--baseline", help="Saved results to compare against")
+    parser.add_argument("--save-baseline", help="Also write the results to this baseline file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed slowdown over the baseline (0.25 = 25%% slower)")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    payload_dir = os.path.abspath(args.payloads) if args.payloads else None
+
+    # Stores write relative to the working directory, so run in a scratch one
+    workdir = tempfile.mkdtemp(prefix="air_quality_bench_")
+    os.chdir(workdir)
+    groups = ["normalize", "fetch", "storage", "dataset"]
+    selected = [g for g in groups if not args.only or args.only in g or args.only.startswith(g)] or groups
+
+    results = {}
+    try:
+        if "normalize" in selected:
+            results.update(normalize_benchmarks(args.rows, args.repeat))
+        if "fetch" in selected:
+            with StubServer(load_payloads(payload_dir, args.rows)) as server:
+                results.update(fetch_benchmarks(server, args.repeat))
+        if "storage" in selected:
+            results.update(storage_benchmarks(args.rows, args.repeat))
+        if "dataset" in selected:
+            results.update(dataset_benchmarks(args.repeat))
+    finally:
+        os.chdir(ROOT_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.only:
+        results = {name: r for name, r in results.items() if args.only in name} or results
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "rows": args.rows,
+        "results": results
+    }
+    for path in filter(None, [output, save_path]):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"{'benchmark':<22}{'best (ms)':>12}{'median (ms)':>13}{'items/s':>12}")
+    for name, result in results.items():
+        throughput = f"{result['items_per_second']:,.0f}" if "items_per_second" in result else ""
+        print(f"{name:<22}{result['seconds'] * 1000:>12.2f}{result['median'] * 1000:>13.2f}{throughput:>12}")
+    print(f"\nResults written to {output}")
+
+    if not baseline_path:
+        return 0
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    failures = 0
+    print(f"\nCompared to {baseline_path}:")
+    for name, before, after, ratio, allowed, ok in compare(results, baseline, args.threshold):
+        failures += not ok
+        print(f"{name:<22}{before * 1000:>10.2f} -> {after * 1000:>10.2f} ms  x{ratio:.2f} "
+              f"(limit x{allowed:.2f}) {'ok' if ok else 'SLOWER'}")
+    if failures:
+        print(f"\n{failures} benchmark(s) exceeded their threshold")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Parse-time benchmark for WAQI city pages.
+Compares the old full BeautifulSoup parse against the targeted extractor in
+script/WAQI.py (and the JSON feed path) on saved aqicn.org pages, and checks
+that both HTML paths extract the same values.
+
+Save pages to benchmark against with e.g.:
+    curl -s https://aqicn.org/city/beijing/ > pages/beijing.html
+
+Usage:
+    python3 benchmarks/waqi_parse.py --pages pages/
+    python3 benchmarks/waqi_parse.py            # synthetic pages
+
+Requirements:
+- beautifulsoup4 (for the baseline parser)
+
+Install with: pip install beautifulsoup4
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "script"))
+
+from WAQI import extract_waqi_page
+
+def parse_with_beautifulsoup(page):
+    """The original extraction: build a full html.parser tree, then look up two elements."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, 'html.parser')
+    aqi_div = soup.find('div', {'id': 'aqiwgtvalue'})
+    if not aqi_div:
+        return None
+
+    pollutants = {}
+    pollutant_table = soup.find('table', {'id': 'aqitable'})
+    if pollutant_table:
+        for row in pollutant_table.find_all('tr'):
+            cols = row.find_all('td')
+            if len(cols) >= 2:
+                pollutants[cols[0].text.strip().lower()] = cols[1].text.strip()
+    return aqi_div.text.strip(), pollutants
+
+def synthetic_page(seed, filler_blocks=2000):
+    """Build a page shaped like an aqicn.org city page (~200 KB of unrelated markup)."""
+    blocks = [
+        f'<div class="card" data-i="{i}"><span>Station {i}</span><a href="/s/{i}/">{seed * i % 500}</a></div>'
+        for i in range(filler_blocks)
+    ]
+    half = filler_blocks // 2
+    rows = "".join(
+        f'<tr><td class="name">{name}</td><td class="cur">{(seed * 7 + i * 13) % 300}</td>'
+        f'<td><span class="bar"></span></td></tr>'
+        for i, name in enumerate(["PM2.5", "PM10", "O3", "NO2", "SO2", "CO", "T", "H"])
+    )
+    script = "<script>var d = " + json.dumps({"v": list(range(500))}) + ";</script>"
+    return (
+        f"<html><head><title>City {seed}</title>{script * 20}</head><body>"
+        f"{''.join(blocks[:half])}"
+        f'<div class="aqivalue" id="aqiwgtvalue" title="Unhealthy">{100 + seed % 200}</div>'
+        f"{''.join(blocks[half:])}"
+        f'<table id="aqitable"><tr><th>Pollutant</th><th>Current</th></tr>{rows}</table>'
+        f"</body></html>"
+    )
+
+def synthetic_feed(seed):
+    """Build a WAQI JSON feed payload for the same station."""
+    return json.dumps({
+        "status": "ok",
+        "data": {
+            "aqi": 100 + seed % 200,
+            "idx": seed,
+            "city": {"name": f"City {seed}", "geo": [27.7, 85.3]},
+            "iaqi": {p: {"v": (seed * 7 + i * 13) % 300}
+                     for i, p in enumerate(["pm25", "pm10", "o3", "no2", "so2", "co", "t", "h"])},
+            "time": {"s": "2026-01-01 12:00:00", "iso": "2026-01-01T12:00:00+05:45"}
+        }
+    })
+
+def time_per_item(fn, items, repeat):
+    """Best-of-repeat mean seconds per item."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        best = min(best, (time.perf_counter() - start) / len(items))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark WAQI page parsing")
+    parser.add_argument("--pages", help="Directory of saved aqicn.org city pages (*.html)")
+    parser.add_argument("--count", type=int, default=10, help="Synthetic pages to generate")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions")
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(args.pages, "*.html"))):
+            with open(path, encoding="utf-8", errors="replace") as f:
+                pages.append(f.read())
+        if not pages:
+            parser.error(f"No *.html pages found in {args.pages}")
+    else:
+        pages = [synthetic_page(seed) for seed in range(args.count)]
+    feeds = [synthetic_feed(seed) for seed in range(len(pages))]
+
+    mismatches = sum(extract_waqi_page(p) != parse_with_beautifulsoup(p) for p in pages)
+
+    soup_time = time_per_item(parse_with_beautifulsoup, pages, args.repeat)
+    targeted_time = time_per_item(extract_waqi_page, pages, args.repeat)
+    feed_time = time_per_item(json.loads, feeds, args.repeat)
+
+    size_kb = sum(len(p) for p in pages) / len(pages) / 1024
+    print(f"{len(pages)} pages, {size_kb:.0f} KB average")
+    print(f"BeautifulSoup (html.parser): {soup_time * 1000:8.2f} ms/page")
+    print(f"Targeted extractor:          {targeted_time * 1000:8.2f} ms/page "
+          f"({soup_time / targeted_time:.0f}x faster)")
+    print(f"JSON feed decode:            {feed_time * 1000:8.3f} ms/city")
+    print(f"Extraction mismatches: {mismatches}")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,19 +3,55 @@
 # 1. First, create this file in the correct location
 # Save this file as 'fast_air_quality.py' in your project root directory
 
-import asyncio
+import hashlib
 import json
 import time
 import os
 import random
-from datetime import datetime
+import re
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
 
 # Configuration
 CONFIG = {
     "cache_duration": 3600,  # Cache data for 1 hour
+    "cache_ttl": {
+        "current_aqi": 600  # Current readings go stale faster
+    },
     "timeout": 10,  # API request timeout in seconds
+    "slo_seconds": 2.0,  # get_all_data answers within this, serving cached copies of slower rebuilds
+    "server": {
+        "host": "127.0.0.1",  # Only listen on localhost
+        "port": 8765
+    },
     "data_dir": "./data/api_data",
+    "location": {  # Default location, served from data_dir itself
+        "city": "Kathmandu",
+        "latitude": 27.7172,
+        "longitude": 85.3240,
+        "radius_km": 30,  # Stations this close feed the rollup-based views
+        "routes": True  # The road network in routing.py covers this city
+    },
+    "cities": {  # Named locations get_all_data accepts besides station ids and coordinates
+        "Kathmandu": {"latitude": 27.7172, "longitude": 85.3240, "routes": True},
+        "Pokhara": {"latitude": 28.2096, "longitude": 83.9856},
+        "Delhi": {"latitude": 28.6139, "longitude": 77.2090},
+        "Dhaka": {"latitude": 23.8103, "longitude": 90.4125},
+        "Beijing": {"latitude": 39.9042, "longitude": 116.4074},
+        "London": {"latitude": 51.5074, "longitude": -0.1278},
+        "Los Angeles": {"latitude": 34.0522, "longitude": -118.2437},
+        "New York": {"latitude": 40.7128, "longitude": -74.0060}
+    },
+    "fan_out_workers": 8,  # Locations get_all_data builds at once
+    "memory_cache_entries": 4096,  # Parsed datasets kept in memory across all locations
+    "correlations": {
+        "window": "30d",  # Rolling window of the weather correlations
+        "min_samples": 24  # Fewer paired hours keep the default figures
+    },
     "endpoints": {
         "current_aqi": "https://api.waqi.info/feed/@8399/?token=demo",
         "openaq": "https://api.openaq.org/v2/latest?limit=10&page=1&offset=0&sort=desc&radius=1000&country=NP&location=Kathmandu&order_by=lastUpdated",
@@ -26,72 +62,240 @@ CONFIG = {
 # Ensure data directory exists
 Path(CONFIG["data_dir"]).mkdir(parents=True, exist_ok=True)
 
+# Helper modules shared with the source fetchers live in script/
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "script")
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+def location_key(name):
+    """Directory-safe key of a location name, e.g. 'Los Angeles' -> 'los-angeles'"""
+    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+
+def make_location(city, latitude, longitude, **fields):
+    """
+    Build a location dictionary with its cache key.
+    
+    Parameters:
+    - city (str): Display name
+    - latitude (float): Latitude of the location
+    - longitude (float): Longitude of the location
+    - **fields: Optional radius_km, routes, station_ids, key
+    
+    Returns:
+    - Location dictionary
+    """
+    location = {
+        "city": city,
+        "latitude": float(latitude),
+        "longitude": float(longitude),
+        "radius_km": CONFIG["location"]["radius_km"],
+        "routes": False,
+        **fields
+    }
+    location.setdefault("key", location_key(city))
+    return location
+
+def resolve_location(spec=None):
+    """
+    Turn a city name, station id or coordinates into a location.
+    
+    Parameters:
+    - spec: None for CONFIG["location"]; a name from CONFIG["cities"]; a
+      station id known to the station index (the location then covers that
+      station only); a "lat,lon" string; or a dictionary with latitude,
+      longitude and optionally city
+    
+    Returns:
+    - Location dictionary (see make_location)
+    
+    Raises:
+    - ValueError if the spec matches no city, station or coordinates
+    """
+    if spec is None:
+        return make_location(**CONFIG["location"])
+    if isinstance(spec, dict):
+        if spec.get("city"):
+            return make_location(**spec)
+        return make_location(f"{spec['latitude']},{spec['longitude']}", **spec)
+    
+    for city, fields in CONFIG["cities"].items():
+        if city.lower() == spec.strip().lower():
+            return make_location(city, **fields)
+    
+    match = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*", spec)
+    if match:
+        return make_location(spec.strip(), float(match.group(1)), float(match.group(2)))
+    
+    from spatial import stations
+    
+    station = stations.get(spec)
+    if station is not None:
+        return make_location(station.get("station_name") or spec, station["latitude"], station["longitude"],
+                             station_ids=[spec], key=location_key(f"station-{spec}"))
+    raise ValueError(f"Unknown location: {spec!r} is not a configured city, known station id or 'lat,lon'")
+
+def is_default_location(location):
+    """True for CONFIG["location"], whose datasets live in data_dir itself"""
+    return location is None or location["key"] == location_key(CONFIG["location"]["city"])
+
+def generate_current_aqi_data(location=None):
+    """Generate the current AQI reading, computed from the pollutant concentrations"""
+    from aqi import CATEGORIES, compute_aqi
+
+    pollutants = {
+        "pm25": 78,
+        "pm10": 125
+    }
+    result = compute_aqi({name: [value] for name, value in pollutants.items()})
+    return {
+        "aqi": int(result["aqi"][0]),
+        "category": CATEGORIES[result["category"][0]],
+        "dominant_pollutant": result["dominant"][0],
+        "city": (location or CONFIG["location"])["city"],
+        "timestamp": datetime.now().isoformat(),
+        "pollutants": pollutants
+    }
+
+def local_rollups(location=None):
+    """
+    Return the measurement rollups and the ids of the stations around a location.
+    
+    Parameters:
+    - location (dict, optional): Location from resolve_location (default:
+      CONFIG["location"]); a station location covers its own station only
+    
+    Returns:
+    - Tuple of (RollupStore, list of station ids), or (None, None) if no
+      station near the location has been seen yet
+    """
+    from rollups import rollups
+    from spatial import stations
+    
+    location = location or CONFIG["location"]
+    if location.get("station_ids"):
+        return rollups, list(location["station_ids"])
+    nearby = stations.within(location["latitude"], location["longitude"], location["radius_km"])
+    if not nearby:
+        return None, None
+    return rollups, [station["station_id"] for station in nearby]
+
+def generate_weekly_trend_data(location=None):
+    """Generate the weekly PM trend, from the daily rollups when local data exists"""
+    rollups, station_ids = local_rollups(location)
+    trend = rollups.weekly_trend(station_ids) if rollups else None
+    if trend:
+        return trend
+    
+    return [
+        {"day": "Mon", "PM25": 65, "PM10": 110},
+        {"day": "Tue", "PM25": 75, "PM10": 130},
+        {"day": "Wed", "PM25": 90, "PM10": 145},
+        {"day": "Thu", "PM25": 70, "PM10": 115},
+        {"day": "Fri", "PM25": 55, "PM10": 95},
+        {"day": "Sat", "PM25": 40, "PM10": 80},
+        {"day": "Sun", "PM25": 85, "PM10": 140}
+    ]
+
+def generate_locations_data(location=None):
+    """Generate per-location readings, from the latest daily PM2.5 means of the local stations when they exist"""
+    from spatial import stations
+    
+    rollups, station_ids = local_rollups(location)
+    if rollups:
+        start = (datetime.now() - timedelta(days=2)).date().isoformat()
+        latest = rollups.series("day", station_ids, "pm25", start=start).ffill()
+        if not latest.empty:
+            values = latest.iloc[-1].dropna()
+            return [{"name": (stations.get(station_id) or {}).get("station_name") or station_id,
+                     "value": int(round(value))}
+                    for station_id, value in values.items()][:10]
+    if not is_default_location(location):
+        # The sample neighbourhoods below are Kathmandu's
+        return []
+    
+    return [
+        {"name": "Thamel", "value": 65},
+        {"name": "Kalanki", "value": 180},
+        {"name": "Balaju", "value": 125},
+        {"name": "Bhaktapur", "value": 80},
+        {"name": "Lalitpur", "value": 55}
+    ]
+
+def generate_hourly_exposure_data(location=None):
+    """Generate the hourly exposure profile, from the hour-of-day rollups when local data exists"""
+    exposure = [
+        {"time": "6am", "value": 15, "temperature": 20, "humidity": 65},
+        {"time": "8am", "value": 85, "temperature": 22, "humidity": 60},
+        {"time": "10am", "value": 60, "temperature": 24, "humidity": 55},
+        {"time": "12pm", "value": 45, "temperature": 26, "humidity": 50},
+        {"time": "2pm", "value": 30, "temperature": 28, "humidity": 45},
+        {"time": "4pm", "value": 55, "temperature": 27, "humidity": 48},
+        {"time": "6pm", "value": 95, "temperature": 25, "humidity": 52},
+        {"time": "8pm", "value": 40, "temperature": 23, "humidity": 58}
+    ]
+    
+    rollups, station_ids = local_rollups(location)
+    profile = rollups.hourly_profile(station_ids, "pm25", hours=range(24)) if rollups else None
+    if profile:
+        for entry in exposure:
+            hour = datetime.strptime(entry["time"], "%I%p").hour
+            if profile.get(hour) is not None:
+                entry["value"] = profile[hour]
+    return exposure
+
 def generate_mock_data():
     """Generate mock data"""
-    # This function provides mock data
-    mock_data = {
-        "current_aqi": {
-            "aqi": 156,
-            "city": "Kathmandu",
-            "timestamp": datetime.now().isoformat(),
-            "pollutants": {
-                "pm25": 78,
-                "pm10": 125
-            }
-        },
-        "weekly_trend": [
-            {"day": "Mon", "PM25": 65, "PM10": 110},
-            {"day": "Tue", "PM25": 75, "PM10": 130},
-            {"day": "Wed", "PM25": 90, "PM10": 145},
-            {"day": "Thu", "PM25": 70, "PM10": 115},
-            {"day": "Fri", "PM25": 55, "PM10": 95},
-            {"day": "Sat", "PM25": 40, "PM10": 80},
-            {"day": "Sun", "PM25": 85, "PM10": 140}
-        ],
-        "locations": [
-            {"name": "Thamel", "value": 65},
-            {"name": "Kalanki", "value": 180},
-            {"name": "Balaju", "value": 125},
-            {"name": "Bhaktapur", "value": 80},
-            {"name": "Lalitpur", "value": 55}
-        ],
-        "hourly_exposure": [
-            {"time": "6am", "value": 15, "temperature": 20, "humidity": 65},
-            {"time": "8am", "value": 85, "temperature": 22, "humidity": 60},
-            {"time": "10am", "value": 60, "temperature": 24, "humidity": 55},
-            {"time": "12pm", "value": 45, "temperature": 26, "humidity": 50},
-            {"time": "2pm", "value": 30, "temperature": 28, "humidity": 45},
-            {"time": "4pm", "value": 55, "temperature": 27, "humidity": 48},
-            {"time": "6pm", "value": 95, "temperature": 25, "humidity": 52},
-            {"time": "8pm", "value": 40, "temperature": 23, "humidity": 58}
-        ],
-        "route_optimization": generate_route_optimization_data(),
-        "detailed_weather": generate_detailed_weather_data(),
-        "metadata": {
-            "last_updated": datetime.now().isoformat(),
-            "fetch_time_seconds": 0.1,
-            "data_sources": {
-                "current_aqi": True,
-                "openaq": True,
-                "weather": True
-            }
+    # This function provides mock data for every dataset
+    mock_data = {key: build() for key, build in DATASET_BUILDERS.items()}
+    mock_data["metadata"] = {
+        "last_updated": datetime.now().isoformat(),
+        "fetch_time_seconds": 0.1,
+        "data_sources": {
+            "current_aqi": True,
+            "openaq": True,
+            "weather": True
         }
     }
+    return mock_data
+
+def generate_station_readings():
+    """Generate current PM2.5 readings of the Kathmandu monitoring stations"""
+    return [
+        {"name": "US Embassy", "latitude": 27.7172, "longitude": 85.3240, "pm25": 65},
+        {"name": "Ratnapark", "latitude": 27.7041, "longitude": 85.3131, "pm25": 85},
+        {"name": "Pulchowk", "latitude": 27.6778, "longitude": 85.3187, "pm25": 42},
+        {"name": "Shankhapark", "latitude": 27.7104, "longitude": 85.3093, "pm25": 75},
+        {"name": "Kalanki", "latitude": 27.6939, "longitude": 85.2824, "pm25": 128},
+        {"name": "Koteshwor", "latitude": 27.6769, "longitude": 85.3497, "pm25": 156},
+        {"name": "Chabahil", "latitude": 27.7197, "longitude": 85.3429, "pm25": 68},
+        {"name": "Swayambhu", "latitude": 27.7147, "longitude": 85.2896, "pm25": 105},
+        {"name": "Balaju", "latitude": 27.7362, "longitude": 85.3007, "pm25": 85},
+        {"name": "Budhanilkantha", "latitude": 27.7784, "longitude": 85.3618, "pm25": 32}
+    ]
+
+def find_route(start, end, cost="time"):
+    """
+    Find a route over the Kathmandu road network using current station readings.
     
-    # Save mock data to cache files
-    for key, data in mock_data.items():
-        cache_file = os.path.join(CONFIG["data_dir"], f"{key}.json")
-        with open(cache_file, 'w') as f:
-            json.dump(data, f, indent=2)
+    Parameters:
+    - start (str): Start junction id or name
+    - end (str): End junction id or name
+    - cost (str): 'time' for the fastest route, 'exposure' for the least polluted one
     
-    # Save combined data
-    with open(os.path.join(CONFIG["data_dir"], "combined_data.json"), 'w') as f:
-        json.dump(mock_data, f, indent=2)
+    Returns:
+    - Dictionary describing the path, or None if there is no route
+    """
+    from routing import load_graph
     
-    return mock_data
+    return load_graph().shortest_path(start, end, cost=cost, readings=generate_station_readings())
 
-def generate_route_optimization_data():
-    """Generate detailed route optimization data"""
+def generate_route_optimization_data(location=None):
+    """Generate detailed route optimization data (empty where routing.py has no road network)"""
+    from exposure import optimize_routes
+    
+    if not (location or CONFIG["location"]).get("routes"):
+        return []
+    
     # Routes with real-world locations in Kathmandu
     base_routes = [
         {
@@ -99,101 +303,116 @@ def generate_route_optimization_data():
             "name": "Home to Office",
             "start": "Thamel",
             "end": "New Baneshwor",
-            "distance_km": 6.5,
-            "avg_pm25": 85,
-            "avg_pm10": 136,
-            "exposure_time_mins": 39,
-            "peak_hours_factor": 1.5,
-            "total_exposure": 331
+            "peak_hours_factor": 1.5
         },
         {
             "id": "route2",
             "name": "Office to Gym",
             "start": "New Baneshwor", 
             "end": "Patan",
-            "distance_km": 4.2,
-            "avg_pm25": 72,
-            "avg_pm10": 115.2,
-            "exposure_time_mins": 25,
-            "peak_hours_factor": 1.0,
-            "total_exposure": 180
+            "peak_hours_factor": 1.0
         },
         {
             "id": "route3",
             "name": "Weekend Shopping",
             "start": "Thamel",
             "end": "Bhatbhateni",
-            "distance_km": 3.8,
-            "avg_pm25": 90,
-            "avg_pm10": 144,
-            "exposure_time_mins": 22,
-            "peak_hours_factor": 1.0,
-            "total_exposure": 198
+            "peak_hours_factor": 1.0
         }
     ]
     
-    # Generate alternatives for each route
-    routes_with_alternatives = []
-    
+    # The fastest path is the route as travelled today; the least-exposure
+    # path becomes the "less polluted route" variant when it differs
     for route in base_routes:
-        # Alternative 1: Slightly longer but less polluted
-        alt1 = {
-            "id": f"{route['id']}_alt1",
-            "name": f"Alternative 1: Less polluted route",
-            "distance_km": round(route["distance_km"] * 1.15, 1),
-            "avg_pm25": int(route["avg_pm25"] * 0.65),
-            "avg_pm10": int(route["avg_pm25"] * 0.65 * 1.6),
-            "exposure_time_mins": int(route["distance_km"] * 1.15 * 6),
-            "reduction_percent": 35,
-            "extra_time_mins": int(route["distance_km"] * 1.15 * 6) - int(route["distance_km"] * 6),
-            "total_exposure": int(route["avg_pm25"] * 0.65 * (route["distance_km"] * 1.15 * 6) / 10),
-            "exposure_reduction": route["total_exposure"] - int(route["avg_pm25"] * 0.65 * (route["distance_km"] * 1.15 * 6) / 10)
-        }
-        
-        # Alternative 2: Same distance but different time
-        alt2 = {
-            "id": f"{route['id']}_alt2",
-            "name": f"Alternative 2: Travel during off-peak hours",
-            "distance_km": route["distance_km"],
-            "avg_pm25": int(route["avg_pm25"] * 0.75),
-            "avg_pm10": int(route["avg_pm25"] * 0.75 * 1.6),
-            "exposure_time_mins": int(route["distance_km"] * 6),
-            "reduction_percent": 25,
-            "extra_time_mins": 0,
-            "total_exposure": int(route["avg_pm25"] * 0.75 * (route["distance_km"] * 6) / 10),
-            "exposure_reduction": route["total_exposure"] - int(route["avg_pm25"] * 0.75 * (route["distance_km"] * 6) / 10)
-        }
-        
-        # Alternative 3: Different transportation mode
-        alt3 = {
-            "id": f"{route['id']}_alt3",
-            "name": f"Alternative 3: Use different transport mode",
-            "distance_km": route["distance_km"],
-            "avg_pm25": int(route["avg_pm25"] * 0.5),
-            "avg_pm10": int(route["avg_pm25"] * 0.5 * 1.6),
-            "exposure_time_mins": int(route["distance_km"] * 7),
-            "reduction_percent": 50,
-            "extra_time_mins": int(route["distance_km"] * 7) - int(route["distance_km"] * 6),
-            "total_exposure": int(route["avg_pm25"] * 0.5 * (route["distance_km"] * 7) / 10),
-            "exposure_reduction": route["total_exposure"] - int(route["avg_pm25"] * 0.5 * (route["distance_km"] * 7) / 10)
+        fastest = find_route(route["start"], route["end"], cost="time")
+        cleanest = find_route(route["start"], route["end"], cost="exposure")
+        route["distance_km"] = fastest["distance_km"]
+        route["avg_pm25"] = fastest["avg_pm25"]
+        route["paths"] = {
+            "low_pollution": cleanest if cleanest["path"] != fastest["path"] else None
         }
-        
-        alternatives = [alt1, alt2, alt3]
-        
-        # Sort alternatives by exposure reduction
-        alternatives.sort(key=lambda x: x["exposure_reduction"], reverse=True)
-        
-        routes_with_alternatives.append({
-            "base_route": route,
-            "alternatives": alternatives
-        })
     
-    return routes_with_alternatives
+    # Score every path / departure / mode combination and keep the best three
+    return optimize_routes(base_routes, k=3)
 
-def generate_detailed_weather_data():
+def apply_aqi_forecast(hourly_forecast, rollups, station_ids, longitude):
+    """
+    Fill aqi_forecast values from the station forecast models.
+    
+    Each entry gets the mean forecast across the local stations for the
+    next time its hour comes round in local solar time.
+    
+    Parameters:
+    - hourly_forecast (list): Entries with an 'hour' such as '6:00'
+    - rollups (RollupStore): Recent hourly rollups
+    - station_ids (list): Local station ids
+    - longitude (float): Longitude of the location, for its solar time
+    """
+    from forecast import engine
+    
+    predictions = engine.forecast(rollups, station_ids)
+    if predictions.empty:
+        return
+    
+    mean = predictions.mean(axis=1)
+    local_hours = (mean.index + timedelta(hours=longitude / 15)).hour
+    by_hour = {}
+    for hour, value in zip(local_hours, mean.to_numpy()):
+        by_hour.setdefault(hour, value)
+    for entry in hourly_forecast:
+        hour = int(entry["hour"].split(":")[0])
+        if hour in by_hour:
+            entry["aqi_forecast"] = int(round(by_hour[hour]))
+
+# Dashboard names of the weather parameters tracked by the correlation statistics
+CORRELATION_PARAMETERS = {
+    "Temperature": "temperature",
+    "Wind Speed": "wind_speed",
+    "Humidity": "humidity",
+    "Precipitation": "precipitation",
+    "Pressure": "pressure"
+}
+
+def impact_level(r):
+    """Describe the strength of a correlation coefficient"""
+    strength = abs(r)
+    if strength >= 0.7:
+        return "Very High"
+    if strength >= 0.5:
+        return "High"
+    if strength >= 0.3:
+        return "Medium"
+    return "Low"
+
+def apply_correlations(correlation_entries, station_ids):
+    """
+    Replace default correlations with the streaming statistics of the local stations.
+    
+    Entries keep their defaults unless the rolling window holds at least
+    CONFIG["correlations"]["min_samples"] paired hours with a defined r.
+    
+    Parameters:
+    - correlation_entries (list): Entries with a dashboard 'parameter' name
+    - station_ids (list): Local station ids
+    """
+    from correlations import correlations
+    
+    settings = CONFIG["correlations"]
+    for entry in correlation_entries:
+        weather = CORRELATION_PARAMETERS.get(entry["parameter"])
+        if weather is None:
+            continue
+        stats = correlations.correlation(weather, "pm25", station_ids, settings["window"])
+        if stats["r"] is None or stats["n"] < settings["min_samples"]:
+            continue
+        entry["correlation"] = round(stats["r"], 2)
+        entry["impact_level"] = impact_level(stats["r"])
+        entry["samples"] = stats["n"]
+
+def generate_detailed_weather_data(location=None):
     """Generate detailed weather impact data on air quality"""
     # Weather parameters and their impact on air quality
-    return {
+    weather = {
         "current_weather": {
             "temperature": 28,
             "humidity": 65,
@@ -296,33 +515,589 @@ def generate_detailed_weather_data():
             }
         ]
     }
+    
+    # Monthly AQI comes from the month-of-year rollups when local data exists
+    location = location or CONFIG["location"]
+    rollups, station_ids = local_rollups(location)
+    if rollups:
+        apply_aqi_forecast(weather["hourly_forecast"], rollups, station_ids, location["longitude"])
+        apply_correlations(weather["correlations"], station_ids)
+    seasonal = rollups.seasonal_profile(station_ids, "pm25") if rollups else None
+    if seasonal:
+        for month, entry in enumerate(weather["seasonal_patterns"], start=1):
+            if seasonal.get(month) is not None:
+                entry["avg_aqi"] = seasonal[month]
+    return weather
+
+# Builders for every cached dataset, keyed by cache file name
+DATASET_BUILDERS = {
+    "current_aqi": generate_current_aqi_data,
+    "weekly_trend": generate_weekly_trend_data,
+    "locations": generate_locations_data,
+    "hourly_exposure": generate_hourly_exposure_data,
+    "route_optimization": generate_route_optimization_data,
+    "detailed_weather": generate_detailed_weather_data
+}
+
+# Parsed cache files as path -> (mtime, data), least recently used first,
+# kept warm in long-running processes
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+# One lock per (shard, dataset) so concurrent callers never rebuild it twice at once
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+# Datasets currently being rebuilt in the background, with the Future of their data
+_refreshing = {}
+_refresh_threads = []
+_refresh_lock = threading.Lock()
+
+def shard_dir(location=None):
+    """
+    Directory holding the cached datasets and combined snapshot of a location.
+    
+    The default location uses data_dir itself, where the Next.js routes
+    read it. Every other location gets its own directory, spread over 256
+    subdirectories by a hash of its key so none of them grows too large.
+    Each directory has its own snapshot manifest, so locations never
+    contend for or rewrite each other's files.
+    """
+    if is_default_location(location):
+        return CONFIG["data_dir"]
+    prefix = hashlib.sha1(location["key"].encode("utf-8")).hexdigest()[:2]
+    return os.path.join(CONFIG["data_dir"], "locations", prefix, location["key"])
 
-def get_all_data(force_refresh=False, use_mock=True):
-    """Main function to get all air quality data"""
+def cache_path(key, location=None):
+    """Path of the cache file for a dataset"""
+    return os.path.join(shard_dir(location), f"{key}.json")
+
+def combined_path(location=None):
+    """Path of the combined snapshot read by the Next.js routes"""
+    return os.path.join(shard_dir(location), "combined_data.json")
+
+def cache_ttl(key):
+    """Lifetime in seconds of a cached dataset"""
+    return CONFIG["cache_ttl"].get(key, CONFIG["cache_duration"])
+
+def _remember(path, entry):
+    with _memory_cache_lock:
+        _memory_cache[path] = entry
+        _memory_cache.move_to_end(path)
+        while len(_memory_cache) > CONFIG["memory_cache_entries"]:
+            _memory_cache.popitem(last=False)
+
+def read_cache(key, location=None):
+    """
+    Return (data, age_seconds) for a cached dataset, or (None, None) if unusable.
+    
+    The age is measured from the build time recorded in the snapshot
+    manifest, not from the file's mtime: a checkout or copy resets mtimes, and
+    files without a manifest entry (such as the JSON committed to the
+    repository, in an older format) are treated as missing.
+    """
+    from snapshot import generated_at
+    
+    path = cache_path(key, location)
+    try:
+        built = generated_at(path)
+        if built is None:
+            return None, None
+        mtime = os.path.getmtime(path)
+        # Reuse the parsed copy while the file on disk is unchanged
+        with _memory_cache_lock:
+            cached = _memory_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as f:
+                cached = (mtime, json.load(f))
+        _remember(path, cached)
+        return cached[1], time.time() - built
+    except (OSError, ValueError):
+        return None, None
+
+def _build_lock(path):
+    with _build_locks_lock:
+        lock = _build_locks.get(path)
+        if lock is None:
+            lock = _build_locks[path] = threading.Lock()
+        return lock
+
+def refresh_dataset(key, location=None):
+    """Rebuild a dataset and write it to its cache file"""
+    path = cache_path(key, location)
+    with _build_lock(path):
+        from metrics import metrics
+        from snapshot import publish, touch
+        
+        with metrics.span("build", dataset=key):
+            data = DATASET_BUILDERS[key](location)
+        with metrics.span("write", dataset=key):
+            _, written = publish(path, data)
+        if not written:
+            # Same content as on disk: only mark it as freshly built
+            touch(path)
+        _remember(path, (os.path.getmtime(path), data))
+    return data
+
+def _background_refresh(key, location, future):
+    path = cache_path(key, location)
+    try:
+        future.set_result(refresh_dataset(key, location))
+    except Exception as e:
+        print(f"Background refresh of {path} failed: {e}")
+        future.set_exception(e)
+    finally:
+        with _refresh_lock:
+            _refreshing.pop(path, None)
+
+def refresh_in_background(key, location=None):
+    """
+    Start rebuilding a dataset unless a rebuild is already running.
+    
+    Returns:
+    - concurrent.futures.Future of the rebuilt data (the running rebuild's, if any)
+    """
+    from concurrent.futures import Future
+    
+    path = cache_path(key, location)
+    with _refresh_lock:
+        future = _refreshing.get(path)
+        if future is not None:
+            return future
+        future = _refreshing[path] = Future()
+        thread = threading.Thread(target=_background_refresh, args=(key, location, future))
+        _refresh_threads.append(thread)
+    thread.start()
+    return future
+
+def wait_for_refreshes():
+    """Block until all background refreshes have finished"""
+    while True:
+        with _refresh_lock:
+            if not _refresh_threads:
+                return
+            thread = _refresh_threads.pop()
+        thread.join()
+
+def get_dataset(key, force_refresh=False, timeout=None, location=None):
+    """
+    Get a dataset from the cache, rebuilding it only when needed.
+    
+    Fresh entries are read from disk. Expired entries are returned as-is
+    while a background thread rebuilds them (stale-while-revalidate).
+    Missing entries, or any entry when force_refresh is set, are rebuilt
+    before returning.
+    
+    Parameters:
+    - key (str): Dataset name (key of DATASET_BUILDERS)
+    - force_refresh (bool): Rebuild even if the cached copy is fresh
+    - timeout (float, optional): Seconds to wait for a rebuild; if it takes
+      longer or fails, the cached copy is returned while the rebuild carries
+      on in the background. Without a cached copy the rebuild is awaited.
+    - location (dict, optional): Location from resolve_location (default:
+      CONFIG["location"])
+    
+    Returns:
+    - Tuple of (data, cache status) where status is "hit", "stale", "miss"
+      or "late" (cached copy returned in place of a late or failed rebuild)
+    """
+    if not force_refresh:
+        data, age = read_cache(key, location)
+        if data is not None:
+            if age < cache_ttl(key):
+                return data, "hit"
+            refresh_in_background(key, location)
+            return data, "stale"
+    if timeout is None:
+        return refresh_dataset(key, location), "miss"
+    return await_rebuild(key, refresh_in_background(key, location), timeout, location)
+
+def await_rebuild(key, future, timeout, location=None):
+    """
+    Wait up to timeout seconds for a dataset rebuild.
+    
+    Parameters:
+    - key (str): Dataset name
+    - future (Future): The rebuild, as returned by refresh_in_background
+    - timeout (float): Seconds to wait
+    - location (dict, optional): Location of the dataset
+    
+    Returns:
+    - Tuple of (data, "miss") for a rebuild that finished in time, otherwise
+      (cached copy, "late"); without a cached copy the rebuild is awaited
+    """
+    try:
+        return future.result(timeout=max(timeout, 0)), "miss"
+    except Exception:
+        # Late or failed rebuild; the last cached copy fills the gap
+        data, _ = read_cache(key, location)
+        if data is not None:
+            return data, "late"
+    return future.result(), "miss"
+
+def combined_digest(location=None):
+    """Identity of the combined snapshot, from the content hashes of its datasets"""
+    from snapshot import snapshot_directory
+    
+    snapshots = snapshot_directory(shard_dir(location))
+    digests = []
+    for key in DATASET_BUILDERS:
+        entry = snapshots.entry(os.path.basename(cache_path(key, location)))
+        if entry is None:
+            return None
+        digests.append(f"{key}:{entry['digest']}")
+    return hashlib.sha256("\n".join(digests).encode("utf-8")).hexdigest()
+
+def source_freshness():
+    """
+    Freshness of every source's data, from the metadata of the last source run.
+    
+    Returns:
+    - Dictionary of source script -> status of its last run, time of its
+      last successful run, age in seconds and freshness label
+    """
+    import run_air_quality_apis
+    
+    results = run_air_quality_apis.read_metadata(CONFIG["data_dir"]).get("api_results", {})
+    return {script: {"status": result.get("status", "ok" if result.get("success") else "failed"),
+                     **run_air_quality_apis.freshness(result)}
+            for script, result in results.items()}
+
+def get_location_data(location=None, force_refresh=False, sources=None):
+    """
+    Get every dataset of one location and publish its combined snapshot.
+    
+    The answer comes within CONFIG["slo_seconds"] whenever every dataset
+    has been built once: rebuilds still running by then are replaced by
+    their last cached copy (status "late") and finish in the background.
+    
+    The combined snapshot (combined_data.json) is only rewritten when one of
+    its datasets changed, so its metadata describes the build that last
+    changed it; the returned dictionary always carries this call's metadata.
+    
+    Parameters:
+    - location (dict, optional): Location from resolve_location (default:
+      CONFIG["location"])
+    - force_refresh (bool): Rebuild every dataset
+    - sources (dict, optional): Source freshness to report, when the caller
+      has already read it
+    
+    Returns:
+    - Dictionary of dataset name -> data, plus metadata
+    """
+    from metrics import metrics
+    from snapshot import publish
+    
     start_time = time.time()
+    slo = CONFIG["slo_seconds"]
+    location = location or resolve_location()
+    
+    # Forced rebuilds all start at once so they share the latency budget
+    rebuilds = ({key: refresh_in_background(key, location) for key in DATASET_BUILDERS}
+                if force_refresh else {})
     
-    # Always use mock data for simplicity
-    mock_data = generate_mock_data()
+    all_data = {}
+    cache_status = {}
+    for key in DATASET_BUILDERS:
+        timeout = slo - (time.time() - start_time)
+        if key in rebuilds:
+            all_data[key], cache_status[key] = await_rebuild(key, rebuilds[key], timeout, location)
+        else:
+            all_data[key], cache_status[key] = get_dataset(key, timeout=timeout, location=location)
+        metrics.increment("air_quality_cache_requests_total", dataset=key, status=cache_status[key])
     
     # Add metadata
     metadata = {
         "last_updated": datetime.now().isoformat(),
         "fetch_time_seconds": round(time.time() - start_time, 2),
+        "slo_seconds": slo,
+        "complete": "late" not in cache_status.values(),
+        "location": {field: location[field] for field in ("key", "city", "latitude", "longitude")},
         "data_sources": {
             "current_aqi": True,
             "openaq": True,
             "weather": True
-        }
+        },
+        "sources": sources if sources is not None else source_freshness(),
+        "cache": cache_status
     }
     
-    mock_data["metadata"] = metadata
+    all_data["metadata"] = metadata
     
     # Save combined data
-    with open(os.path.join(CONFIG["data_dir"], "combined_data.json"), 'w') as f:
-        json.dump(mock_data, f, indent=2)
+    publish(combined_path(location), all_data, digest=combined_digest(location))
+    return all_data
+
+def get_all_data(force_refresh=False, use_mock=True, locations=None):
+    """
+    Main function to get all air quality data.
     
-    print(f"Data processing completed in {metadata['fetch_time_seconds']} seconds")
-    return mock_data
+    Parameters:
+    - force_refresh (bool): Rebuild every dataset
+    - use_mock (bool): Kept for callers of the original interface
+    - locations (list, optional): City names, station ids, "lat,lon" strings
+      or location dictionaries (see resolve_location). Without it, the
+      datasets of CONFIG["location"] are returned as before.
+    
+    Locations are built concurrently, at most CONFIG["fan_out_workers"] at
+    a time, each in its own cache shard. A location that fails or cannot be
+    resolved gets an "error" entry and does not hold up the others.
+    
+    Returns:
+    - Without locations: dictionary of dataset name -> data, plus metadata
+    - With locations: {"locations": {location key: data or {"error": ...}},
+      "metadata": {...}}
+    """
+    start_time = time.time()
+    if locations is None:
+        all_data = get_location_data(resolve_location(), force_refresh)
+        print(f"Data processing completed in {all_data['metadata']['fetch_time_seconds']} seconds")
+        return all_data
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    sources = source_freshness()
+    
+    def build(spec):
+        try:
+            location = resolve_location(spec)
+        except ValueError as e:
+            return str(spec), {"error": str(e)}
+        try:
+            return location["key"], get_location_data(location, force_refresh, sources)
+        except Exception as e:
+            print(f"Building {location['city']} failed: {e}")
+            return location["key"], {"error": str(e)}
+    
+    with ThreadPoolExecutor(max_workers=CONFIG["fan_out_workers"]) as pool:
+        results = dict(pool.map(build, locations))
+    
+    metadata = {
+        "last_updated": datetime.now().isoformat(),
+        "fetch_time_seconds": round(time.time() - start_time, 2),
+        "locations": len(results),
+        "errors": sum(1 for data in results.values() if "error" in data),
+        "sources": sources
+    }
+    print(f"Data for {len(results)} locations processed in {metadata['fetch_time_seconds']} seconds")
+    return {"locations": results, "metadata": metadata}
+
+# Serialises source fetches triggered through the data service
+_sources_lock = threading.Lock()
+_last_sources_result = None
+
+def run_sources(data_dir=None):
+    """
+    Run every source fetcher in this process and save their metadata.
+    
+    Concurrent callers share a single run: whoever arrives while a run is
+    in progress waits for it and receives its results.
+    
+    Returns:
+    - Dictionary of per-script results, as written to metadata.json
+    """
+    global _last_sources_result
+    import asyncio
+    import run_air_quality_apis
+    
+    if _sources_lock.acquire(blocking=False):
+        try:
+            data_dir = data_dir or CONFIG["data_dir"]
+            results = asyncio.run(run_air_quality_apis.run_all(list(run_air_quality_apis.SOURCES)))
+            run_air_quality_apis.save_metadata(data_dir, results)
+            _last_sources_result = results
+        finally:
+            _sources_lock.release()
+    else:
+        with _sources_lock:
+            pass
+    return _last_sources_result
+
+def request_handler():
+    """
+    Build the request handler class of the resident data service.
+    
+    http.server is only imported here, so one-shot runs of this script do
+    not pay for it at startup.
+    
+    Returns:
+    - DataRequestHandler class
+    """
+    from http.server import BaseHTTPRequestHandler
+    
+    class DataRequestHandler(BaseHTTPRequestHandler):
+        """
+        Localhost endpoints of the resident data service.
+        
+        - GET /health: liveness check
+        - GET /metrics: pipeline metrics in the Prometheus text format
+        - GET /data[?force=true][&location=]: combined snapshot of a location
+          (default: CONFIG["location"]; a city, station id or "lat,lon"),
+          conditional and precompressed when the client asks for it
+        - GET /route?from=<junction>&to=<junction>[&cost=time|exposure]: routing query
+        - GET /stations/nearest?lat=&lon=[&k=5][&source=]: closest known monitors
+        - GET /stations/within?lat=&lon=&radius_km=[&source=]: monitors within a radius
+        - POST /refresh: rebuild every dataset
+        - POST /fetch-sources: run all source fetchers
+        """
+        
+        def send_json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/health":
+                self.send_json({"status": "ok"})
+            elif url.path == "/metrics":
+                self.send_metrics()
+            elif url.path == "/data":
+                force = query.get("force", ["false"])[0] == "true"
+                try:
+                    location = resolve_location(query.get("location", [None])[0])
+                except ValueError as e:
+                    self.send_json({"error": str(e)}, status=400)
+                    return
+                data = get_location_data(location, force_refresh=force)
+                if not self.send_snapshot(combined_path(location)):
+                    self.send_json(data)
+            elif url.path == "/route":
+                self.send_route(query)
+            elif url.path in ("/stations/nearest", "/stations/within"):
+                self.send_stations(url.path, query)
+            else:
+                self.send_json({"error": "Not found"}, status=404)
+        
+        def send_metrics(self):
+            from metrics import metrics
+        
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def send_snapshot(self, path):
+            """
+            Send a published snapshot file as stored, honouring If-None-Match
+            and Accept-Encoding.
+        
+            Returns:
+            - False if the snapshot has not been published
+            """
+            from snapshot import snapshot_directory
+        
+            directory, name = os.path.split(path)
+            snapshots = snapshot_directory(directory)
+            entry = snapshots.entry(name)
+            if entry is None:
+                return False
+            if self.headers.get("If-None-Match") == entry["etag"]:
+                self.send_response(304)
+                self.send_header("ETag", entry["etag"])
+                self.end_headers()
+                return True
+        
+            accepted = self.headers.get("Accept-Encoding", "")
+            encoding = next((e for e in ("br", "gzip") if e in entry["encodings"] and e in accepted), None)
+            # Read the bytes with the entry of their own publish, so the ETag always matches them
+            entry, body = snapshots.read(name, encoding)
+            if entry is None:
+                return False
+        
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", entry["etag"])
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+                self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+        
+        def send_route(self, query):
+            start = query.get("from", [None])[0]
+            end = query.get("to", [None])[0]
+            if not start or not end:
+                self.send_json({"error": "Both 'from' and 'to' are required"}, status=400)
+                return
+            try:
+                route = find_route(start, end, cost=query.get("cost", ["exposure"])[0])
+            except (KeyError, ValueError) as e:
+                self.send_json({"error": str(e).strip("'")}, status=400)
+                return
+            if route is None:
+                self.send_json({"error": f"No route from {start} to {end}"}, status=404)
+            else:
+                self.send_json(route)
+        
+        def send_stations(self, path, query):
+            from spatial import stations
+        
+            try:
+                lat = float(query["lat"][0])
+                lon = float(query["lon"][0])
+                source = query.get("source", [None])[0]
+                if path == "/stations/nearest":
+                    found = stations.nearest(lat, lon, k=int(query.get("k", ["5"])[0]), source=source)
+                else:
+                    found = stations.within(lat, lon, float(query["radius_km"][0]), source=source)
+            except (KeyError, ValueError):
+                self.send_json({"error": "lat, lon and (for /stations/within) radius_km are required numbers"}, status=400)
+                return
+            self.send_json({"stations": found})
+        
+        def do_POST(self):
+            url = urlparse(self.path)
+            try:
+                if url.path == "/refresh":
+                    self.send_json(get_all_data(force_refresh=True))
+                elif url.path == "/fetch-sources":
+                    self.send_json({"api_results": run_sources()})
+                else:
+                    self.send_json({"error": "Not found"}, status=404)
+            except Exception as e:
+                print(f"Error handling {url.path}: {e}")
+                self.send_json({"error": str(e)}, status=500)
+        
+        def log_message(self, format, *args):
+            # Keep request logging out of stderr; the Next.js routes treat it as a warning
+            pass
+        
+    return DataRequestHandler
+
+def serve(host=None, port=None):
+    """
+    Run the resident data service until interrupted.
+    
+    Parameters:
+    - host (str, optional): Interface to bind (default: CONFIG["server"]["host"])
+    - port (int, optional): Port to listen on (default: CONFIG["server"]["port"])
+    """
+    from http.server import ThreadingHTTPServer
+    
+    host = host or CONFIG["server"]["host"]
+    port = port or CONFIG["server"]["port"]
+    
+    # Warm the in-memory cache before accepting requests
+    get_all_data()
+    
+    server = ThreadingHTTPServer((host, port), request_handler())
+    print(f"Serving air quality data on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        wait_for_refreshes()
 
 if __name__ == "__main__":
     # If running directly, fetch all data
@@ -330,7 +1105,41 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetch air quality data quickly")
     parser.add_argument("--force", action="store_true", help="Force refresh all data")
     parser.add_argument("--mock", action="store_true", help="Use mock data")
+    parser.add_argument("--serve", action="store_true", help="Run as a resident localhost data service")
+    parser.add_argument("--port", type=int, help="Port for --serve")
+    parser.add_argument("--json", action="store_true", help="Write the combined data to stdout")
+    parser.add_argument("--location", action="append",
+                        help="City, station id or 'lat,lon' to build instead of the default location (repeatable)")
     args = parser.parse_args()
     
-    data = get_all_data(force_refresh=args.force, use_mock=True)
-    print(json.dumps(data, indent=2))
\ No newline at end of file
+    if args.serve:
+        serve(port=args.port)
+    elif args.location:
+        from contextlib import redirect_stdout
+        
+        with redirect_stdout(sys.stderr if args.json else sys.stdout):
+            result = get_all_data(force_refresh=args.force, locations=args.location)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            for key, data in result["locations"].items():
+                print(f"{key}: {data['error'] if 'error' in data else 'ok'}")
+        with redirect_stdout(sys.stderr if args.json else sys.stdout):
+            wait_for_refreshes()
+    elif args.json:
+        # Progress messages go to stderr so stdout carries only the JSON document.
+        # With fresh caches this path never imports pandas.
+        from contextlib import redirect_stdout
+        
+        with redirect_stdout(sys.stderr):
+            get_all_data(force_refresh=args.force, use_mock=True)
+        with open(combined_path(), 'rb') as f:
+            sys.stdout.buffer.write(f.read())
+        sys.stdout.flush()
+        with redirect_stdout(sys.stderr):
+            wait_for_refreshes()
+    else:
+        # The data goes to combined_data.json; callers read it from there
+        get_all_data(force_refresh=args.force, use_mock=True)
+        print(f"Combined data is in {combined_path()}")
+        wait_for_refreshes()
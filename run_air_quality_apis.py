@@ -1,81 +1,383 @@
 # run_air_quality_apis.py
-import subprocess
 import os
+import sys
 import json
+import time
 import datetime
-import argparse
 from pathlib import Path
 
+# Make the source fetchers in script/ importable as plain modules
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "script")
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+# Maximum number of requests each source may have in flight at once
+SOURCE_CONCURRENCY = {
+    "AirNow.py": 3,
+    "EPA.py": 2,
+    "OpenAQ.py": 4,
+    "WAQI.py": 8
+}
+
+# Prometheus text file written next to metadata.json after every run
+METRICS_FILE = "metrics.prom"
+
+# Latency budget of a whole run in seconds; sources still running then are reported as timed out
+REFRESH_BUDGET = 90
+
+# Data from a source's last successful run counts as cached, not stale, for this long
+FRESHNESS_SECONDS = 3 * 3600
+
 def ensure_directory(directory):
     """Create directory if it doesn't exist."""
     Path(directory).mkdir(parents=True, exist_ok=True)
 
-def run_script(script_name, data_dir):
-    """Run a specific API script with appropriate parameters."""
-    script_path = os.path.join("script", script_name)  # Corrected folder name
+def located(job, location):
+    """Wrap a job so every metric it records carries its location."""
+    from metrics import labels
+
+    def run():
+        with labels(location=location):
+            return job()
+    return run
+
+def airnow_jobs():
+    """Build one fetch-and-save job per AirNow location."""
+    from AirNow import API_KEY, LOCATIONS, fetch_airnow_data, request_key, save_data
+
+    def job(lat, lon):
+        df = fetch_airnow_data(API_KEY, lat, lon)
+        save_data(df, [request_key(lat, lon)])
+        return df is not None
+
+    return [located(lambda lat=lat, lon=lon: job(lat, lon), name) for lat, lon, name in LOCATIONS], None
+
+def epa_jobs():
+    """Build one fetch-and-save job per EPA (site, parameter) pair."""
+    from EPA import (EMAIL, API_KEY, PARAMETERS, MONITORING_SITES,
+                     default_date_range, incremental_start_date,
+                     fetch_epa_data, save_data)
+
+    start_date, end_date = default_date_range()
+
+    def job(site, param_code):
+        df = fetch_epa_data(
+            EMAIL, API_KEY,
+            site["state"], site["county"], site["site"],
+            param_code, incremental_start_date(site, param_code, start_date),
+            end_date
+        )
+        save_data(df)
+        return df is not None
+
+    return [
+        located(lambda site=site, code=code: job(site, code), site["name"])
+        for site in MONITORING_SITES
+        for code in PARAMETERS.values()
+    ], None
+
+def openaq_jobs():
+    """Build one streaming fetch job per OpenAQ (location, parameter) pair."""
+    from OpenAQ import LOCATIONS, PARAMETERS, stream_openaq_data
+
+    return [
+        located(lambda loc=loc, param=param: stream_openaq_data(loc["country"], loc.get("city"), param) is not None,
+                loc.get("city") or loc["country"])
+        for loc in LOCATIONS
+        for param in PARAMETERS
+    ], None
+
+def waqi_jobs():
+    """Build one fetch job per WAQI city; results are saved together."""
+    from WAQI import CITIES, fetch_waqi_data, save_data
+
+    def finalize(results):
+        save_data([data for data in results if isinstance(data, dict)])
+
+    return [located(lambda city=city: fetch_waqi_data(city), city) for city in CITIES], finalize
+
+# Job builders for every source, keyed by the script that owns them. A job
+# returns something true when its provider answered (new or unchanged data)
+# and something false when its request failed; the optional finalize
+# callback receives every job's result.
+SOURCES = {
+    "AirNow.py": airnow_jobs,
+    "EPA.py": epa_jobs,
+    "OpenAQ.py": openaq_jobs,
+    "WAQI.py": waqi_jobs
+}
+
+async def in_worker(executor, func, *args):
+    """
+    Run a blocking function on an executor, like asyncio.to_thread.
+
+    The function runs in a copy of the caller's context, so metric labels
+    and the request deadline reach the worker thread.
+
+    Parameters:
+    - executor (Executor, optional): Executor to run on (None: the loop's default)
+    - func (callable): Function to run
+    - *args: Its arguments
+    """
+    import asyncio
+    import contextvars
+    import functools
+
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(context.run, func, *args))
+
+async def run_source(script_name, executor=None):
+    """
+    Run every job of a source concurrently, bounded by its concurrency limit.
+
+    Parameters:
+    - script_name (str): Name of the source script (key of SOURCES)
+    - executor (Executor, optional): Executor the jobs run on
+
+    Every request and stage inside the jobs is recorded in the metrics
+    registry under the source's name (the script name without .py), which
+    also names its circuit breaker. A source whose breaker is open is not
+    run at all.
+
+    Returns:
+    - Tuple of (status, {"ok": jobs whose provider answered, "failed": jobs
+      that failed or raised}). Status is "ok" if every job's provider
+      answered, "partial" if only some did, "failed" if none did,
+      "timeout" if none did and the deadline cut jobs short, or
+      "circuit_open" if the breaker was or became open
+    """
+    import asyncio
+    from circuit import breakers
+    from http_client import DeadlineExceeded
+    from metrics import labels
+
+    source = script_name[:-len(".py")].lower()
+    if breakers.get(source).is_open():
+        print(f"⏸️ Skipping {script_name}: its provider kept failing, circuit breaker is open")
+        return "circuit_open", {"ok": 0, "failed": 0}
+
     print(f"Running {script_name}...")
-    
+    semaphore = asyncio.Semaphore(SOURCE_CONCURRENCY.get(script_name, 1))
+
+    async def run_job(job):
+        async with semaphore:
+            return await in_worker(executor, job)
+
+    jobs = []
     try:
-        # Pass data directory as environment variable
-        env = os.environ.copy()
-        env["DATA_DIR"] = data_dir
-        
-        # Run the script and capture output
-        result = subprocess.run(
-            ["python3", script_path], 
-            env=env,
-            capture_output=True, 
-            text=True,
-            check=True
-        )
-        print(f"✅ {script_name} completed successfully")
-        return True, result.stdout
-    except subprocess.CalledProcessError as e:
+        with labels(source=source):
+            jobs, finalize = SOURCES[script_name]()
+            results = await asyncio.gather(*(run_job(job) for job in jobs),
+                                           return_exceptions=True)
+            errors = [r for r in results if isinstance(r, BaseException)]
+            for error in errors:
+                print(f"⚠️ {script_name} job failed: {error}")
+            if finalize:
+                await in_worker(executor, finalize, results)
+    except Exception as e:
         print(f"❌ Error running {script_name}: {e}")
-        print(f"Error output: {e.stderr}")
-        return False, e.stderr
+        return "failed", {"ok": 0, "failed": len(jobs)}
+
+    ok = sum(1 for r in results if r and not isinstance(r, BaseException))
+    counts = {"ok": ok, "failed": len(results) - ok}
+    if ok == len(results):
+        status = "ok"
+    elif ok:
+        status = "partial"
+    elif breakers.get(source).is_open():
+        status = "circuit_open"
+    elif any(isinstance(e, DeadlineExceeded) for e in errors):
+        status = "timeout"
+    else:
+        status = "failed"
+    icon = {"ok": "✅", "partial": "⚠️"}.get(status, "❌")
+    print(f"{icon} {script_name}: {ok} of {len(results)} jobs got data from the provider ({status})")
+    return status, counts
+
+def retrain_forecasts():
+    """Retrain the AQI forecast models if their retraining interval has passed."""
+    from forecast import engine
+    from storage import store
+
+    try:
+        engine.retrain_if_due(store)
+    except Exception as e:
+        print(f"Error retraining forecast models: {e}")
+
+def compact_store():
+    """Merge the small files every run appends into one file per partition."""
+    from storage import store
+
+    try:
+        rewritten = store.compact()
+        if rewritten:
+            print(f"Compacted {rewritten} store partitions")
+    except Exception as e:
+        print(f"Error compacting the measurement store: {e}")
+
+async def run_all(scripts, budget=REFRESH_BUDGET):
+    """
+    Run all sources at the same time and collect their results.
+
+    The run returns once the budget is used up, whether or not every
+    source has finished, and sources that did not finish are reported with
+    the "timeout" status; their data from earlier runs stays in the store.
+    Jobs run on a dedicated thread pool that is then shut down without
+    waiting: jobs not yet started are cancelled, requests in flight are cut
+    short by the shared deadline, and running jobs stop at their next
+    check_deadline() step, so the process exits shortly after the budget
+    rather than when its slowest job would have finished.
+
+    Parameters:
+    - scripts (list): Names of the source scripts to run
+    - budget (float): Seconds the whole run may take
+
+    Returns:
+    - Dictionary of per-script results in the metadata.json format
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from circuit import breakers
+    from http_client import deadline
+
+    # Size the worker pool so every source can use its full concurrency
+    workers = sum(SOURCE_CONCURRENCY.get(script, 1) for script in scripts)
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="source")
+
+    started = time.perf_counter()
+
+    async def run_and_stamp(script):
+        status, jobs = await run_source(script, executor)
+        return script, {
+            "success": status == "ok",
+            "status": status,
+            "jobs": jobs,
+            "seconds": round(time.perf_counter() - started, 3),
+            "timestamp": datetime.datetime.now().isoformat()
+        }
+
+    try:
+        # Tasks copy the context, so every request they make shares the deadline
+        with deadline(budget):
+            tasks = {asyncio.create_task(run_and_stamp(script)): script for script in scripts}
+            done, pending = await asyncio.wait(tasks, timeout=budget)
+
+        finished = dict(task.result() for task in done)
+        for task in pending:
+            task.cancel()
+            print(f"⏱️ {tasks[task]} did not finish within the {budget}s budget")
+            finished[tasks[task]] = {
+                "success": False,
+                "status": "timeout",
+                "seconds": round(time.perf_counter() - started, 3),
+                "timestamp": datetime.datetime.now().isoformat()
+            }
+        breakers.save()
+
+        # New measurements are in; models retrain on their own schedule, not every run
+        if time.perf_counter() - started < budget:
+            await in_worker(executor, retrain_forecasts)
+        # Fold this run's appends into their partitions while the budget allows;
+        # a run that used it all leaves them to the next one
+        if time.perf_counter() - started < budget:
+            await in_worker(executor, compact_store)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return {script: finished[script] for script in scripts}
+
+def freshness(result, now=None):
+    """
+    Describe how fresh a source's data is.
+
+    Parameters:
+    - result (dict): The source's entry in metadata.json, with "last_success"
+    - now (datetime, optional): Time to measure the age at (default: now)
+
+    Returns:
+    - Dictionary with the last successful run, its age in seconds and one of
+      "fresh" (every job of this run got data from the provider), "partial"
+      (only some did; the rest is from earlier runs), "cached" (an earlier
+      run within FRESHNESS_SECONDS succeeded), "stale" (only older runs
+      did) or "missing"
+    """
+    now = now or datetime.datetime.now()
+    last_success = result.get("last_success")
+    age = None if not last_success else (now - datetime.datetime.fromisoformat(last_success)).total_seconds()
+    if result.get("status") == "partial":
+        return {"last_success": last_success, "age_seconds": None if age is None else round(age),
+                "freshness": "partial"}
+    if not last_success:
+        return {"last_success": None, "age_seconds": None, "freshness": "missing"}
+    if result.get("success"):
+        label = "fresh"
+    else:
+        label = "cached" if age <= FRESHNESS_SECONDS else "stale"
+    return {"last_success": last_success, "age_seconds": round(age), "freshness": label}
+
+def read_metadata(data_dir):
+    """Load metadata.json from a data directory, or an empty dictionary."""
+    try:
+        with open(os.path.join(data_dir, "metadata.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 def save_metadata(data_dir, results):
-    """Save metadata about the API runs."""
+    """
+    Save metadata about the API runs, with a metrics summary and the Prometheus text file.
+
+    A source only succeeds when every one of its jobs got data from its
+    provider. Sources that did not (including partial runs) carry over the
+    time of their last successful run, so the freshness of the data they
+    left in the store can still be reported.
+    """
+    from circuit import breakers
+    from metrics import metrics
+
+    previous = read_metadata(data_dir).get("api_results", {})
+    now = datetime.datetime.now()
+    for script, result in results.items():
+        if result.get("success"):
+            result["last_success"] = result["timestamp"]
+        else:
+            result["last_success"] = (previous.get(script) or {}).get("last_success")
+        result.update(freshness(result, now))
+
     metadata = {
-        "last_updated": datetime.datetime.now().isoformat(),
-        "api_results": results
+        "last_updated": now.isoformat(),
+        "api_results": results,
+        "breakers": breakers.snapshot(),
+        "metrics": metrics.summary()
     }
-    
+
     with open(os.path.join(data_dir, "metadata.json"), "w") as f:
         json.dump(metadata, f, indent=2)
+    metrics.write_textfile(os.path.join(data_dir, METRICS_FILE))
 
 def main():
+    # Imported on use so that importing this module stays cheap
+    import argparse
+    import asyncio
+
     parser = argparse.ArgumentParser(description="Run air quality API scripts")
-    parser.add_argument("--data-dir", default="./data/api_data", 
+    parser.add_argument("--data-dir", default="./data/api_data",
                         help="Directory to store API data")
+    parser.add_argument("--budget", type=float, default=REFRESH_BUDGET,
+                        help=f"Seconds the whole run may take (default: {REFRESH_BUDGET})")
     args = parser.parse_args()
-    
+
     # Ensure data directory exists
     ensure_directory(args.data_dir)
-    
-    # List of scripts to run
-    scripts = [
-        "AirNow.py",
-        "EPA.py", 
-        "OpenAQ.py",
-        "WAQI.py"
-    ]
-    
-    # Run each script and collect results
-    results = {}
-    for script in scripts:
-        success, output = run_script(script, args.data_dir)
-        results[script] = {
-            "success": success,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-    
+
+    # Run all sources concurrently and collect results
+    results = asyncio.run(run_all(list(SOURCES), budget=args.budget))
+
     # Save metadata
     save_metadata(args.data_dir, results)
-    
+
     print("\nAll scripts completed! Data saved to:", args.data_dir)
     return results
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
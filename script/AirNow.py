@@ -7,15 +7,68 @@ air quality information for locations across the United States.
 Requirements:
 - requests
 - pandas
+- pyarrow
 
-Install with: pip install requests pandas
+Install with: pip install requests pandas pyarrow
 """
 
-import requests
-import pandas as pd
-import json
-from datetime import datetime
-import os
+from metrics import metrics
+from normalize import Schema, const, field, join, lookup, normalize, normalize_body, strip, upper
+from watermarks import WatermarkStore
+
+BASE_URL = "https://www.airnowapi.org/aq/observation/latLong/current/"
+
+# Last-seen measurement times and response validators for AirNow
+watermarks = WatermarkStore("airnow")
+
+# Replace with your actual API key
+API_KEY = "YOUR_AIRNOW_API_KEY"
+
+# Example locations (latitude, longitude, name)
+LOCATIONS = [
+    (40.7128, -74.0060, "new_york"),
+    (34.0522, -118.2437, "los_angeles"),
+    (41.8781, -87.6298, "chicago")
+]
+
+# AirNow parameter names mapped to canonical parameter names
+PARAMETER_NAMES = {
+    "PM2.5": "pm25",
+    "PM10": "pm10",
+    "O3": "o3",
+    "OZONE": "o3",
+    "NO2": "no2",
+    "SO2": "so2",
+    "CO": "co"
+}
+
+# UTC offsets (hours) of the time zone abbreviations AirNow reports
+TIMEZONE_OFFSETS = {
+    "EST": -5, "EDT": -4,
+    "CST": -6, "CDT": -5,
+    "MST": -7, "MDT": -6,
+    "PST": -8, "PDT": -7,
+    "AKST": -9, "AKDT": -8,
+    "HST": -10
+}
+
+# AirNow current observations only carry AQI values, so the value column
+# holds the AQI with unit "AQI"; observation times are local to the station
+SCHEMA = Schema("airnow", {
+    "station_id": join("airnow:", field("ReportingArea"), ":", field("StateCode")),
+    "station_name": field("ReportingArea"),
+    "latitude": field("Latitude"),
+    "longitude": field("Longitude"),
+    "unit": const("AQI"),
+    "timestamp": join(strip(field("DateObserved")), " ", field("HourObserved"), ":00"),
+    "value": field("AQI"),
+    "aqi": field("AQI"),
+    "parameter": lookup(PARAMETER_NAMES, upper(field("ParameterName")))
+}, timestamp_format="%Y-%m-%d %H:%M", utc_offset=lookup(TIMEZONE_OFFSETS, field("LocalTimeZone"), const(0)))
+
+def request_key(latitude, longitude, distance=25):
+    """Watermark key of the observation request for a location"""
+    return f"latLong:{latitude},{longitude},{distance}"
 
 def fetch_airnow_data(api_key, latitude, longitude, distance=25):
     """
@@ -28,9 +81,16 @@ def fetch_airnow_data(api_key, latitude, longitude, distance=25):
     - distance (int): Distance in miles to look for monitors (default: 25)
     
     Returns:
-    - DataFrame containing the air quality data
+    - DataFrame with the canonical measurement columns (empty if nothing
+      changed since the last request or no monitor reported), or None if
+      the request failed
+    
+    Raises:
+    - http_client.CircuitOpen / DeadlineExceeded, so the run stops asking
     """
-    base_url = "https://www.airnowapi.org/aq/observation/latLong/current/"
+    import pandas as pd
+    import requests
+    import http_client
     
     params = {
         "format": "application/json",
@@ -40,62 +100,76 @@ def fetch_airnow_data(api_key, latitude, longitude, distance=25):
         "API_KEY": api_key
     }
     
+    key = request_key(latitude, longitude, distance)
+    
     try:
-        response = requests.get(base_url, params=params)
+        response = http_client.get(BASE_URL, params=params,
+                                   headers=watermarks.conditional_headers(key))
         response.raise_for_status()  # Raise an exception for HTTP errors
         
-        data = response.json()
+        if not watermarks.check_response(key, response):
+            print(f"No new data for location: {latitude}, {longitude}")
+            return pd.DataFrame()
         
-        if not data:
+        df, _ = normalize_body(SCHEMA, response.content)
+        
+        if df.empty:
             print(f"No data found for location: {latitude}, {longitude}")
-            return None
         
-        # Convert to DataFrame
-        df = pd.json_normalize(data)
         return df
     
-    except requests.exceptions.RequestException as e:
+    except (http_client.CircuitOpen, http_client.DeadlineExceeded):
+        raise
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Error fetching data: {e}")
         return None
 
-def save_data(df, location_name):
+def to_measurements(records):
     """
-    Save the air quality data to a CSV file.
+    Map AirNow observations onto the canonical measurement columns.
     
     Parameters:
-    - df (DataFrame): The data to save
-    - location_name (str): Name of the location for the filename
+    - records (list): Observation dictionaries as returned by the AirNow API
+    
+    Returns:
+    - DataFrame with the columns expected by storage.MeasurementStore
     """
-    if df is None or df.empty:
-        print("No data to save.")
-        return
+    return normalize(SCHEMA, records)
+
+def save_data(df, request_keys=()):
+    """
+    Append the air quality data to the measurement store, skipping
+    observations that are not newer than the stored watermarks.
+    
+    Parameters:
+    - df (DataFrame): The data to save, as returned by fetch_airnow_data
+    - request_keys (iterable): request_key() of the requests df came from;
+      their response validators are kept once the data is stored
     
-    # Create data directory if it doesn't exist
-    os.makedirs("air_quality_data", exist_ok=True)
+    Returns:
+    - Number of rows written
+    """
+    from http_client import check_deadline
+    from ingest import ingest
+    from storage import store
     
-    # Create filename with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"air_quality_data/airnow_{location_name}_{timestamp}.csv"
+    if df is None or df.empty:
+        print("No data to save.")
+        return 0
     
-    # Save to CSV
-    df.to_csv(filename, index=False)
-    print(f"Data saved to {filename}")
+    with metrics.span("normalize"):
+        measurements = watermarks.filter_new(df)
+    check_deadline("storing AirNow data")
+    rows = ingest(measurements)
+    watermarks.commit(measurements, request_keys)
+    print(f"{rows} new measurements saved to {store.root}")
+    return rows
 
 def main():
-    # Replace with your actual API key
-    API_KEY = "YOUR_AIRNOW_API_KEY"
-    
-    # Example locations (latitude, longitude, name)
-    locations = [
-        (40.7128, -74.0060, "new_york"),
-        (34.0522, -118.2437, "los_angeles"),
-        (41.8781, -87.6298, "chicago")
-    ]
-    
-    for lat, lon, name in locations:
+    for lat, lon, name in LOCATIONS:
         print(f"Fetching data for {name}...")
         df = fetch_airnow_data(API_KEY, lat, lon)
-        save_data(df, name)
+        save_data(df, [request_key(lat, lon)])
         print(f"Completed for {name}\n")
 
 if __name__ == "__main__":
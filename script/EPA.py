@@ -1,11 +1,123 @@
 #!/usr/bin/env python3
+"""
+Historical Air Quality Data Fetcher for the EPA AQS API
+This script fetches sample data for monitoring sites from EPA's Air Quality
+System and appends it to the shared measurement store.
 
+Requirements:
+- requests
+- pandas
+- pyarrow
+
+Install with: pip install requests pandas pyarrow
+"""
 
-import requests
-import pandas as pd
 from datetime import datetime, timedelta
+import json
 import os
-import time
+import threading
+from metrics import metrics
+from normalize import Schema, field, join, lookup, normalize, normalize_body
+from watermarks import WatermarkStore
+
+BASE_URL = "https://aqs.epa.gov/data/api/sampleData/bysite"
+
+# Requests allowed in flight at once during a backfill
+BACKFILL_WORKERS = 4
+
+# Completed (site, parameter, chunk) keys of the current backfill
+CHECKPOINT_FILE = "air_quality_data/epa_backfill_checkpoint.json"
+
+# Last-seen measurement times per (site, parameter)
+watermarks = WatermarkStore("epa")
+
+# Your EPA API credentials
+EMAIL = "your_registered_email@example.com"
+API_KEY = "YOUR_EPA_API_KEY"
+
+# Common air quality parameters
+PARAMETERS = {
+    "Ozone": "44201",
+    "PM2.5": "88101",
+    "PM10": "81102",
+    "NO2": "42602",
+    "SO2": "42401",
+    "CO": "42101"
+}
+
+# List of monitoring sites (state, county, site)
+MONITORING_SITES = [
+    # New York, Queens College site
+    {"state": "36", "county": "081", "site": "0124", "name": "Queens_NY"},
+    # California, Los Angeles-North Main Street site
+    {"state": "06", "county": "037", "site": "1103", "name": "LosAngeles_CA"},
+    # Texas, Houston Deer Park site
+    {"state": "48", "county": "201", "site": "1039", "name": "Houston_TX"}
+]
+
+# AQS parameter codes mapped to canonical parameter names
+PARAMETER_NAMES = {
+    "44201": "o3",
+    "88101": "pm25",
+    "81102": "pm10",
+    "42602": "no2",
+    "42401": "so2",
+    "42101": "co"
+}
+
+# AQS unit descriptions mapped to short unit names
+UNIT_NAMES = {
+    "Parts per million": "ppm",
+    "Parts per billion": "ppb",
+    "Micrograms/cubic meter (LC)": "µg/m³",
+    "Micrograms/cubic meter (25 C)": "µg/m³"
+}
+
+# AQS sample records mapped onto the canonical measurement columns
+SCHEMA = Schema("epa", {
+    "station_id": join("aqs:", field("state_code"), "-", field("county_code"), "-", field("site_number")),
+    "latitude": field("latitude"),
+    "longitude": field("longitude"),
+    "unit": lookup(UNIT_NAMES, field("units_of_measure"), field("units_of_measure")),
+    "timestamp": join(field("date_gmt"), " ", field("time_gmt")),
+    "value": field("sample_measurement"),
+    "parameter": lookup(PARAMETER_NAMES, join(field("parameter_code")), join(field("parameter_code")))
+}, records="Data", timestamp_format="%Y-%m-%d %H:%M")
+
+def default_date_range(days=30):
+    """
+    Return the (start_date, end_date) pair covering the past `days` days.
+    
+    Parameters:
+    - days (int): Number of days to look back (default: 30)
+    
+    Returns:
+    - Tuple of start and end dates in YYYYMMDD format
+    """
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=days)
+    return start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d")
+
+def incremental_start_date(site, parameter_code, start_date):
+    """
+    Move a start date forward to the newest day already stored for a site.
+    
+    AQS only filters by whole days, so the watermark day itself is fetched
+    again and save_data drops the rows that were already stored.
+    
+    Parameters:
+    - site (dict): Site dictionary with "state", "county" and "site" keys
+    - parameter_code (str): Five-digit parameter code
+    - start_date (str): Earliest date wanted, in YYYYMMDD format
+    
+    Returns:
+    - Start date in YYYYMMDD format
+    """
+    key = f"aqs:{site['state']}-{site['county']}-{site['site']}|{PARAMETER_NAMES.get(parameter_code, parameter_code)}"
+    last_seen = watermarks.get(key)
+    if last_seen is None:
+        return start_date
+    return max(start_date, last_seen.strftime("%Y%m%d"))
 
 def fetch_epa_data(email, api_key, state_code, county_code, site_code, 
                    parameter_code, start_date, end_date):
@@ -23,9 +135,33 @@ def fetch_epa_data(email, api_key, state_code, county_code, site_code,
     - end_date (str): End date in YYYYMMDD format
     
     Returns:
-    - DataFrame containing the historical air quality data
+    - DataFrame with the canonical measurement columns (empty if AQS has no
+      data for the range), or None if the request failed
+    """
+    df = fetch_epa_measurements(email, api_key, state_code, county_code, site_code,
+                                parameter_code, start_date, end_date)
+    
+    if df is not None and df.empty:
+        print(f"No data found for the specified parameters.")
+    
+    return df
+
+def fetch_epa_measurements(email, api_key, state_code, county_code, site_code,
+                           parameter_code, start_date, end_date):
     """
-    base_url = "https://aqs.epa.gov/data/api/sampleData/bysite"
+    Fetch sample records from EPA's AQS API as canonical measurements.
+    
+    Takes the same parameters as fetch_epa_data.
+    
+    Returns:
+    - DataFrame with the canonical measurement columns (empty if AQS has no
+      data for the range), or None if the request failed
+    
+    Raises:
+    - http_client.CircuitOpen / DeadlineExceeded, so the run stops asking
+    """
+    import requests
+    import http_client
     
     params = {
         "email": email,
@@ -39,103 +175,234 @@ def fetch_epa_data(email, api_key, state_code, county_code, site_code,
     }
     
     try:
-        response = requests.get(base_url, params=params)
+        response = http_client.get(BASE_URL, params=params)
         response.raise_for_status()
         
-        data = response.json()
+        df, envelope = normalize_body(SCHEMA, response.content)
+        header = envelope['Header'][0]
+        status = header['status']
         
-        if data['Header'][0]['status'] != 'Success':
-            print(f"Error: {data['Header'][0]['message']}")
-            return None
+        if status.startswith('No data matched'):
+            return df.iloc[:0]
         
-        if not data['Data']:
-            print(f"No data found for the specified parameters.")
+        if status != 'Success':
+            print(f"Error: {header.get('message', status)}")
             return None
         
-        # Convert to DataFrame
-        df = pd.DataFrame(data['Data'])
         return df
     
-    except requests.exceptions.RequestException as e:
+    except (http_client.CircuitOpen, http_client.DeadlineExceeded):
+        raise
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Error fetching data: {e}")
         return None
 
-def save_data(df, state_code, county_code, site_code, parameter_code, start_date, end_date):
+def to_measurements(records):
     """
-    Save the historical air quality data to a CSV file.
+    Map AQS sample records onto the canonical measurement columns.
     
     Parameters:
-    - df (DataFrame): The data to save
-    - state_code (str): Two-digit state code
-    - county_code (str): Three-digit county code
-    - site_code (str): Four-digit site code
-    - parameter_code (str): Five-digit parameter code
-    - start_date (str): Start date in YYYYMMDD format
-    - end_date (str): End date in YYYYMMDD format
+    - records (list): Sample dictionaries from the "Data" list of an AQS response
+    
+    Returns:
+    - DataFrame with the columns expected by storage.MeasurementStore
     """
+    return normalize(SCHEMA, records)
+
+def save_data(df, only_new=True):
+    """
+    Append the historical air quality data to the measurement store.
+    
+    Parameters:
+    - df (DataFrame): The data to save, as returned by fetch_epa_data
+    - only_new (bool): Skip samples that are not newer than the stored
+      watermarks (disable for backfills of older history)
+    
+    Returns:
+    - Number of rows written
+    """
+    from http_client import check_deadline
+    from ingest import ingest
+    from storage import store
+    
     if df is None or df.empty:
         print("No data to save.")
-        return
+        return 0
+    
+    measurements = df
+    if only_new:
+        with metrics.span("normalize"):
+            measurements = watermarks.filter_new(measurements)
+    check_deadline("storing EPA data")
+    rows = ingest(measurements)
+    watermarks.commit(measurements)
+    print(f"{rows} measurements saved to {store.root}")
+    return rows
+
+def date_chunks(start_date, end_date, chunk_days=None):
+    """
+    Split a date range into chunks the AQS API accepts.
+    
+    AQS rejects requests whose dates span more than one calendar year, so
+    chunks always break at year boundaries, and optionally every chunk_days.
+    
+    Parameters:
+    - start_date (str): Start date in YYYYMMDD format
+    - end_date (str): End date in YYYYMMDD format
+    - chunk_days (int, optional): Maximum number of days per chunk
+    
+    Returns:
+    - List of (start_date, end_date) tuples in YYYYMMDD format
+    """
+    start = datetime.strptime(start_date, "%Y%m%d")
+    end = datetime.strptime(end_date, "%Y%m%d")
+    
+    chunks = []
+    while start <= end:
+        chunk_end = min(end, datetime(start.year, 12, 31))
+        if chunk_days:
+            chunk_end = min(chunk_end, start + timedelta(days=chunk_days - 1))
+        chunks.append((start.strftime("%Y%m%d"), chunk_end.strftime("%Y%m%d")))
+        start = chunk_end + timedelta(days=1)
+    return chunks
+
+def load_checkpoint(path):
+    """Return the set of completed backfill keys stored at path."""
+    try:
+        with open(path) as f:
+            return set(json.load(f)["completed"])
+    except (OSError, ValueError, KeyError):
+        return set()
+
+def save_checkpoint(path, completed):
+    """Atomically write the set of completed backfill keys to path."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"completed": sorted(completed)}, f)
+    os.replace(tmp_path, path)
+
+def backfill_epa(email, api_key, sites, parameter_codes, start_date, end_date,
+                 checkpoint_path=CHECKPOINT_FILE, workers=BACKFILL_WORKERS,
+                 chunk_days=None):
+    """
+    Backfill AQS history for many sites and parameters, resuming after interruptions.
+    
+    The range is split with date_chunks and every (site, parameter, chunk)
+    runs on a thread pool; the shared rate-limit scheduler keeps request
+    starts within the AQS quota. Each chunk that completes (including chunks with
+    no data) is recorded in the checkpoint file, and chunks already recorded
+    there are skipped, so rerunning the same backfill continues where it stopped.
+    
+    Parameters:
+    - email (str): Your registered email with EPA
+    - api_key (str): Your EPA API key
+    - sites (list): Site dictionaries with "state", "county" and "site" keys
+    - parameter_codes (list): Five-digit parameter codes
+    - start_date (str): Start date in YYYYMMDD format
+    - end_date (str): End date in YYYYMMDD format
+    - checkpoint_path (str): Where completed chunk keys are recorded
+    - workers (int): Number of chunks fetched concurrently
+    - chunk_days (int, optional): Maximum number of days per chunk
     
-    # Create data directory if it doesn't exist
-    os.makedirs("air_quality_data", exist_ok=True)
+    Returns:
+    - Dictionary with counts of completed, skipped and failed chunks
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
     
-    # Create filename with location and date info
-    filename = f"air_quality_data/epa_{state_code}_{county_code}_{site_code}_{parameter_code}_{start_date}_{end_date}.csv"
+    completed = load_checkpoint(checkpoint_path)
+    checkpoint_lock = threading.Lock()
     
-    # Save to CSV
-    df.to_csv(filename, index=False)
-    print(f"Data saved to {filename}")
+    tasks = []
+    skipped = 0
+    for site in sites:
+        for code in parameter_codes:
+            for chunk_start, chunk_end in date_chunks(start_date, end_date, chunk_days):
+                key = f"{site['state']}-{site['county']}-{site['site']}:{code}:{chunk_start}-{chunk_end}"
+                if key in completed:
+                    skipped += 1
+                else:
+                    tasks.append((key, site, code, chunk_start, chunk_end))
+    
+    print(f"Backfilling {len(tasks)} chunks ({skipped} already done)...")
+    
+    def run_task(key, site, code, chunk_start, chunk_end):
+        from http_client import check_deadline
+        
+        check_deadline(f"backfilling {key}")
+        df = fetch_epa_measurements(
+            email, api_key,
+            site["state"], site["county"], site["site"],
+            code, chunk_start, chunk_end
+        )
+        if df is None:
+            return False
+        if not df.empty:
+            save_data(df, only_new=False)
+        with checkpoint_lock:
+            completed.add(key)
+            save_checkpoint(checkpoint_path, completed)
+        return True
+    
+    done = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_task, *task): task[0] for task in tasks}
+        for future in as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"Error backfilling {futures[future]}: {e}")
+                ok = False
+            if ok:
+                done += 1
+            else:
+                failed += 1
+    
+    print(f"Backfill finished: {done} completed, {skipped} skipped, {failed} failed")
+    return {"completed": done, "skipped": skipped, "failed": failed}
 
 def main():
-    # Your EPA API credentials
-    EMAIL = "your_registered_email@example.com"
-    API_KEY = "YOUR_EPA_API_KEY"
-    
-    # Common air quality parameters
-    parameters = {
-        "Ozone": "44201",
-        "PM2.5": "88101",
-        "PM10": "81102",
-        "NO2": "42602",
-        "SO2": "42401",
-        "CO": "42101"
-    }
+    import argparse
     
-    # List of monitoring sites (state, county, site)
-    monitoring_sites = [
-        # New York, Queens College site
-        {"state": "36", "county": "081", "site": "0124", "name": "Queens_NY"},
-        # California, Los Angeles-North Main Street site
-        {"state": "06", "county": "037", "site": "1103", "name": "LosAngeles_CA"},
-        # Texas, Houston Deer Park site
-        {"state": "48", "county": "201", "site": "1039", "name": "Houston_TX"}
-    ]
-    
-    # Date range (past 30 days)
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=30)
+    parser = argparse.ArgumentParser(description="Fetch EPA AQS air quality data")
+    parser.add_argument("--backfill", action="store_true",
+                        help="Backfill a date range with resumable, concurrent chunks")
+    parser.add_argument("--start", help="Backfill start date (YYYYMMDD)")
+    parser.add_argument("--end", help="Backfill end date (YYYYMMDD, default: today)")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS,
+                        help="Chunks fetched concurrently during a backfill")
+    parser.add_argument("--chunk-days", type=int,
+                        help="Maximum days per backfill chunk (default: up to a calendar year)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE,
+                        help="Checkpoint file recording completed chunks")
+    args = parser.parse_args()
+    
+    if args.backfill:
+        if not args.start:
+            parser.error("--backfill requires --start")
+        backfill_epa(
+            EMAIL, API_KEY, MONITORING_SITES, list(PARAMETERS.values()),
+            args.start, args.end or datetime.now().strftime("%Y%m%d"),
+            checkpoint_path=args.checkpoint, workers=args.workers,
+            chunk_days=args.chunk_days
+        )
+        return
     
-    start_date_str = start_date.strftime("%Y%m%d")
-    end_date_str = end_date.strftime("%Y%m%d")
+    start_date_str, end_date_str = default_date_range()
     
-    for site in monitoring_sites:
-        for param_name, param_code in parameters.items():
+    for site in MONITORING_SITES:
+        for param_name, param_code in PARAMETERS.items():
             print(f"Fetching {param_name} data for {site['name']}...")
             
             df = fetch_epa_data(
                 EMAIL, API_KEY, 
                 site["state"], site["county"], site["site"],
-                param_code, start_date_str, end_date_str
-            )
-            
-            save_data(
-                df, site["state"], site["county"], site["site"],
-                param_code, start_date_str, end_date_str
+                param_code, incremental_start_date(site, param_code, start_date_str),
+                end_date_str
             )
             
-            # Add a short delay to avoid hitting rate limits
-            time.sleep(2)
+            save_data(df)
             
         print(f"Completed for {site['name']}\n")
 
@@ -7,36 +7,89 @@ open air quality data from around the world.
 Requirements:
 - requests
 - pandas
+- pyarrow
 
-Install with: pip install requests pandas
+Install with: pip install requests pandas pyarrow
 """
 
-import requests
-import pandas as pd
-from datetime import datetime
-import os
-import time
+from datetime import datetime, timedelta, timezone
+from metrics import metrics
+from normalize import Schema, field, join, normalize, normalize_body
+from watermarks import WatermarkStore
 
-def fetch_openaq_data(country, city=None, parameter=None, limit=1000):
+# Last-seen measurement times per station and per query
+watermarks = WatermarkStore("openaq")
+
+BASE_URL = "https://api.openaq.org/v2/measurements"
+
+# Default time window covered by a streaming fetch
+LOOKBACK_DAYS = 7
+
+# Results requested per page while streaming
+PAGE_SIZE = 1000
+
+# OpenAQ measurement results mapped onto the canonical measurement columns
+SCHEMA = Schema("openaq", {
+    "station_id": join("openaq:", field("locationId")),
+    "station_name": field("location"),
+    "latitude": field("coordinates", "latitude"),
+    "longitude": field("coordinates", "longitude"),
+    "unit": field("unit"),
+    "timestamp": field("date", "utc"),
+    "value": field("value"),
+    "parameter": field("parameter")
+}, records="results")
+
+# List of countries and cities to fetch data for
+LOCATIONS = [
+    {"country": "US", "city": "Los Angeles"},
+    {"country": "IN", "city": "Delhi"},
+    {"country": "CN", "city": "Beijing"},
+    {"country": "GB", "city": "London"}
+]
+
+# List of parameters to fetch
+PARAMETERS = ["pm25", "pm10", "no2", "o3"]
+
+def iter_openaq_pages(country, city=None, parameter=None, date_from=None,
+                      date_to=None, page_size=PAGE_SIZE, max_pages=None, sort="desc"):
     """
-    Fetch air quality data from OpenAQ API.
+    Yield OpenAQ measurements one page at a time.
+    
+    Pages are requested lazily, so only one page is held in memory at a time.
+    Instead of numbering pages through the whole window, which runs into
+    the API's page limit on long windows, every request starts at the
+    newest (or, sorting descending, oldest) timestamp seen so far; rows at
+    that timestamp that were already yielded are skipped. Page numbers are
+    only used to step through more than page_size rows sharing a single
+    timestamp. Iteration stops at the first short or empty page, or after
+    max_pages.
     
     Parameters:
     - country (str): Two-letter country code (e.g., 'US', 'IN', 'CN')
     - city (str, optional): City name
     - parameter (str, optional): Pollution parameter (pm25, pm10, co, so2, no2, o3, bc)
-    - limit (int): Maximum number of results to retrieve
+    - date_from (datetime, optional): Start of the time window
+    - date_to (datetime, optional): End of the time window
+    - page_size (int): Number of results per page
+    - max_pages (int, optional): Stop after this many pages
+    - sort (str): 'asc' for oldest first, 'desc' for newest first
     
-    Returns:
-    - DataFrame containing the air quality data
+    Yields:
+    - DataFrame with the canonical measurement columns for each page
+    
+    Raises:
+    - requests.exceptions.RequestException if a page cannot be fetched
     """
-    base_url = "https://api.openaq.org/v2/measurements"
+    import pandas as pd
+    import http_client
     
     params = {
         "country": country,
-        "limit": limit,
+        "limit": page_size,
         "has_geo": "true",  # Only include results with coordinates
-        "order_by": "datetime"
+        "order_by": "datetime",
+        "sort": sort
     }
     
     if city:
@@ -45,74 +98,200 @@ def fetch_openaq_data(country, city=None, parameter=None, limit=1000):
     if parameter:
         params["parameter"] = parameter
     
-    try:
-        response = requests.get(base_url, params=params)
+    if date_from:
+        params["date_from"] = date_from.isoformat()
+    
+    if date_to:
+        params["date_to"] = date_to.isoformat()
+    
+    # The window edge that moves along with the pages
+    edge = "date_from" if sort == "asc" else "date_to"
+    boundary = None
+    seen = set()  # Rows at the boundary timestamp that were already yielded
+    page = 1
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        params["page"] = page
+        response = http_client.get(BASE_URL, params=params)
         response.raise_for_status()
+        pages += 1
+        
+        measurements, _ = normalize_body(SCHEMA, response.content)
+        if measurements.empty:
+            return
         
-        data = response.json()
+        timestamps = pd.to_datetime(measurements["timestamp"], utc=True)
+        keys = list(zip(measurements["station_id"], measurements["parameter"], timestamps))
+        fresh = [key not in seen for key in keys]
+        if any(fresh):
+            yield measurements[fresh]
         
-        if not data['results']:
+        if len(measurements) < page_size:
+            return
+        
+        newest = timestamps.max() if sort == "asc" else timestamps.min()
+        if boundary is not None and newest == boundary:
+            # The whole page shares the boundary timestamp: step through it by page
+            seen.update(keys)
+            page += 1
+        else:
+            boundary = newest
+            seen = {key for key in keys if key[2] == boundary}
+            params[edge] = boundary.isoformat()
+            page = 1
+
+def fetch_openaq_data(country, city=None, parameter=None, limit=1000):
+    """
+    Fetch air quality data from OpenAQ API.
+    
+    Parameters:
+    - country (str): Two-letter country code (e.g., 'US', 'IN', 'CN')
+    - city (str, optional): City name
+    - parameter (str, optional): Pollution parameter (pm25, pm10, co, so2, no2, o3, bc)
+    - limit (int): Maximum number of results to retrieve
+    
+    Returns:
+    - DataFrame with the canonical measurement columns, or None if the
+      request failed or returned nothing
+    
+    Raises:
+    - http_client.CircuitOpen / DeadlineExceeded, so the run stops asking
+    """
+    import requests
+    import http_client
+    
+    try:
+        df = next(iter_openaq_pages(country, city, parameter,
+                                    page_size=limit, max_pages=1), None)
+        
+        if df is None:
             print(f"No data found for country: {country}, city: {city}")
             return None
         
-        # Convert to DataFrame
-        df = pd.json_normalize(data['results'])
         return df
     
-    except requests.exceptions.RequestException as e:
+    except (http_client.CircuitOpen, http_client.DeadlineExceeded):
+        raise
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Error fetching data: {e}")
         return None
 
-def save_data(df, country, city=None, parameter=None):
+def to_measurements(records):
     """
-    Save the air quality data to a CSV file.
+    Map OpenAQ measurement results onto the canonical measurement columns.
     
     Parameters:
-    - df (DataFrame): The data to save
-    - country (str): Country code
-    - city (str, optional): City name
-    - parameter (str, optional): Pollution parameter
+    - records (list): Result dictionaries from the "results" list of an
+      OpenAQ response
+    
+    Returns:
+    - DataFrame with the columns expected by storage.MeasurementStore
+    """
+    return normalize(SCHEMA, records)
+
+def save_data(df):
     """
+    Append the air quality data to the measurement store, skipping
+    measurements that are not newer than the stored watermarks.
+    
+    Parameters:
+    - df (DataFrame): The data to save, as returned by fetch_openaq_data
+    
+    Returns:
+    - Number of rows written
+    """
+    from http_client import check_deadline
+    from ingest import ingest
+    from storage import store
+    
     if df is None or df.empty:
         print("No data to save.")
-        return
+        return 0
+    
+    with metrics.span("normalize"):
+        measurements = watermarks.filter_new(df)
+    check_deadline("storing OpenAQ data")
+    rows = ingest(measurements)
+    watermarks.commit(measurements)
+    print(f"{rows} new measurements saved to {store.root}")
+    return rows
+
+def stream_openaq_data(country, city=None, parameter=None, date_from=None,
+                       date_to=None, page_size=PAGE_SIZE):
+    """
+    Fetch every page in a time window and store each one as it arrives.
+    
+    Each page is normalized on its own and appended to the measurement store
+    straight away, so peak memory is one page regardless of how many
+    measurements the window holds. The window starts no earlier than the
+    newest measurement already stored for the same query, and rows at or
+    before their station's watermark are skipped. Pages are read oldest
+    first so the watermarks stay correct if the stream is interrupted.
+    
+    Parameters:
+    - country (str): Two-letter country code
+    - city (str, optional): City name
+    - parameter (str, optional): Pollution parameter
+    - date_from (datetime, optional): Start of the window (default: LOOKBACK_DAYS ago)
+    - date_to (datetime, optional): End of the window (default: now)
+    - page_size (int): Number of results per page
+    
+    Returns:
+    - Number of rows written, or None if a request failed before the
+      window was read to the end (pages stored until then are kept)
     
-    # Create data directory if it doesn't exist
-    os.makedirs("air_quality_data", exist_ok=True)
+    Raises:
+    - http_client.CircuitOpen / DeadlineExceeded, so the run stops asking
+    """
+    import pandas as pd
+    import requests
+    import http_client
+    from ingest import ingest
+    from storage import store
+    
+    date_to = date_to or datetime.now(timezone.utc)
+    date_from = date_from or date_to - timedelta(days=LOOKBACK_DAYS)
+    
+    query_key = f"query:{country}:{city or ''}:{parameter or ''}"
+    last_seen = watermarks.get(query_key)
+    if last_seen is not None and last_seen > date_from:
+        date_from = last_seen.to_pydatetime()
+    
+    rows = 0
     
-    # Create filename with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    city_str = f"_{city}" if city else ""
-    param_str = f"_{parameter}" if parameter else ""
-    filename = f"air_quality_data/openaq_{country}{city_str}{param_str}_{timestamp}.csv"
+    try:
+        for page in iter_openaq_pages(country, city, parameter, date_from,
+                                      date_to, page_size, sort="asc"):
+            with metrics.span("normalize"):
+                measurements = watermarks.filter_new(page)
+            http_client.check_deadline("storing OpenAQ page")
+            rows += ingest(measurements)
+            if not measurements.empty:
+                watermarks.advance(query_key, pd.to_datetime(measurements["timestamp"], utc=True).max())
+            watermarks.commit(measurements)
+    
+    except (http_client.CircuitOpen, http_client.DeadlineExceeded):
+        raise
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error fetching data: {e}")
+        if rows:
+            print(f"{rows} measurements saved to {store.root} before the error")
+        return None
     
-    # Save to CSV
-    df.to_csv(filename, index=False)
-    print(f"Data saved to {filename}")
+    if rows == 0:
+        print(f"No new data for country: {country}, city: {city}")
+    else:
+        print(f"{rows} measurements saved to {store.root}")
+    return rows
 
 def main():
-    # List of countries and cities to fetch data for
-    locations = [
-        {"country": "US", "city": "Los Angeles"},
-        {"country": "IN", "city": "Delhi"},
-        {"country": "CN", "city": "Beijing"},
-        {"country": "GB", "city": "London"}
-    ]
-    
-    # List of parameters to fetch
-    parameters = ["pm25", "pm10", "no2", "o3"]
-    
-    for location in locations:
+    for location in LOCATIONS:
         country = location["country"]
         city = location.get("city")
         
-        for param in parameters:
+        for param in PARAMETERS:
             print(f"Fetching {param} data for {city}, {country}...")
-            df = fetch_openaq_data(country, city, param)
-            save_data(df, country, city, param)
-            
-            # Add a short delay to avoid hitting rate limits
-            time.sleep(1)
+            stream_openaq_data(country, city, param)
         
         print(f"Completed for {city}, {country}\n")
 
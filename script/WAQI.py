@@ -1,27 +1,221 @@
 #!/usr/bin/env python3
 """
 Air Quality Data Scraper for WAQI (World Air Quality Index)
-This script scrapes air pollution data from the WAQI website, which provides
-real-time air quality information for cities around the world.
+This script fetches air pollution data from the WAQI JSON feed, which provides
+real-time air quality information for cities around the world. When the feed
+has no data for a city it falls back to scraping the aqicn.org city page.
 
 Requirements:
 - requests
-- beautifulsoup4
 - pandas
+- pyarrow
 
-Install with: pip install requests beautifulsoup4 pandas
+Install with: pip install requests pandas pyarrow
 """
 
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
-import json
+import html
+import re
 from datetime import datetime
-import os
-import time
-import random
+from urllib.parse import quote
+from metrics import metrics
+from normalize import Schema, field, normalize
+from watermarks import WatermarkStore
+
+FEED_URL = "https://api.waqi.info/feed/{station}/"
+
+# Replace with your WAQI API token; "demo" only covers a few cities
+API_TOKEN = "demo"
+
+# Cities fetched concurrently by fetch_waqi_batch
+BATCH_WORKERS = 8
+
+# Last-seen measurement times and response validators for WAQI
+watermarks = WatermarkStore("waqi")
+
+# List of cities to scrape
+CITIES = [
+    "Beijing",
+    "Delhi",
+    "London",
+    "Los Angeles",
+    "Mexico City",
+    "Mumbai",
+    "Paris",
+    "São Paulo",
+    "Shanghai",
+    "Tokyo"
+]
+
+# Pollutant names in the WAQI table mapped to canonical parameter names
+PARAMETER_NAMES = {
+    "pm2.5": "pm25",
+    "pm25": "pm25",
+    "pm10": "pm10",
+    "o3": "o3",
+    "no2": "no2",
+    "so2": "so2",
+    "co": "co"
+}
+
+# Weather readings in the WAQI feed mapped to canonical parameter names and units
+WEATHER_NAMES = {
+    "t": ("temperature", "°C"),
+    "h": ("humidity", "%"),
+    "w": ("wind_speed", "m/s"),
+    "p": ("pressure", "hPa"),
+    "r": ("precipitation", "mm")
+}
+
+# Flattened WAQI readings (one per pollutant or weather value) mapped onto
+# the canonical measurement columns
+SCHEMA = Schema("waqi", {
+    "station_id": field("station_id"),
+    "station_name": field("city"),
+    "latitude": field("latitude"),
+    "longitude": field("longitude"),
+    "unit": field("unit"),
+    "timestamp": field("timestamp"),
+    "value": field("value"),
+    "aqi": field("aqi"),
+    "parameter": field("parameter")
+})
 
 def fetch_waqi_data(city):
+    """
+    Fetch air quality data for a city, preferring the WAQI JSON feed.
+    
+    Parameters:
+    - city (str): Name of the city
+    
+    Returns:
+    - Dictionary containing the air quality data, or None if neither the
+      feed nor the page could be read
+    """
+    data = fetch_waqi_feed(city)
+    if data is None:
+        data = scrape_waqi_page(city)
+    return data
+
+def fetch_waqi_feed(city, token=API_TOKEN):
+    """
+    Fetch air quality data for a city from the WAQI JSON feed.
+    
+    Parameters:
+    - city (str): Name of the city, or a station id such as '@8399'
+    - token (str): WAQI API token
+    
+    Returns:
+    - Dictionary containing the air quality data, or None if the feed has none
+    
+    A feed response identical to the previous one for the same city is not
+    parsed again; {'city': city, 'unchanged': True} is returned instead.
+    Parsed data carries the 'request_key' of its response, whose validators
+    save_data keeps once the data is stored.
+    
+    Raises:
+    - http_client.CircuitOpen / DeadlineExceeded, so the run stops asking
+    """
+    import requests
+    import http_client
+    
+    station = city if city.startswith("@") else quote(city.lower())
+    request_key = f"feed:{station}"
+    
+    try:
+        response = http_client.get(FEED_URL.format(station=station), params={"token": token},
+                                   headers=watermarks.conditional_headers(request_key))
+        response.raise_for_status()
+        
+        if not watermarks.check_response(request_key, response):
+            return {'city': city, 'unchanged': True}
+        
+        with metrics.span("parse"):
+            payload = response.json()
+    
+    except (http_client.CircuitOpen, http_client.DeadlineExceeded):
+        raise
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error fetching feed for {city}: {e}")
+        return None
+    
+    if payload.get("status") != "ok" or not isinstance(payload.get("data"), dict):
+        print(f"No feed data for {city}: {payload.get('data')}")
+        return None
+    
+    feed = payload["data"]
+    feed_time = feed.get("time") or {}
+    geo = (feed.get("city") or {}).get("geo") or [None, None]
+    
+    data = {
+        'city': city,
+        'aqi': feed.get("aqi"),
+        'timestamp': feed_time.get("iso") or feed_time.get("s") or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'latitude': geo[0],
+        'longitude': geo[1],
+        'request_key': request_key
+    }
+    
+    for pollutant, reading in (feed.get("iaqi") or {}).items():
+        data[pollutant] = reading.get("v")
+    
+    return data
+
+def fetch_waqi_batch(cities, workers=BATCH_WORKERS):
+    """
+    Fetch several cities concurrently.
+    
+    Parameters:
+    - cities (list): City names or station ids
+    - workers (int): Number of cities fetched at once
+    
+    Returns:
+    - List of data dictionaries for the cities that returned data, in input order
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(fetch_waqi_data, cities))
+    return [data for data in results if data]
+
+# Targeted patterns for the two elements read from an aqicn.org city page
+_AQI_VALUE_PATTERN = re.compile(r'<div[^>]*\bid=["\']aqiwgtvalue["\'][^>]*>(.*?)</div>', re.S | re.I)
+_AQI_TABLE_PATTERN = re.compile(r'<table[^>]*\bid=["\']aqitable["\'][^>]*>(.*?)</table>', re.S | re.I)
+_ROW_PATTERN = re.compile(r'<tr[^>]*>(.*?)</tr>', re.S | re.I)
+_CELL_PATTERN = re.compile(r'<td[^>]*>(.*?)</td>', re.S | re.I)
+_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+def _text(fragment):
+    """Strip tags and entities from an HTML fragment."""
+    return html.unescape(_TAG_PATTERN.sub('', fragment)).strip()
+
+def extract_waqi_page(page):
+    """
+    Extract the AQI value and pollutant table from an aqicn.org city page.
+    
+    Only the #aqiwgtvalue element and the #aqitable rows are located with
+    targeted patterns; the rest of the page is never parsed.
+    
+    Parameters:
+    - page (str): HTML of the city page
+    
+    Returns:
+    - Tuple of (aqi value, {pollutant: value}), or None if the AQI is missing
+    """
+    aqi_match = _AQI_VALUE_PATTERN.search(page)
+    if not aqi_match:
+        return None
+    
+    pollutants = {}
+    table_match = _AQI_TABLE_PATTERN.search(page, aqi_match.end()) or _AQI_TABLE_PATTERN.search(page)
+    if table_match:
+        for row in _ROW_PATTERN.findall(table_match.group(1)):
+            cols = _CELL_PATTERN.findall(row)
+            if len(cols) >= 2:
+                pollutants[_text(cols[0]).lower()] = _text(cols[1])
+    
+    return _text(aqi_match.group(1)), pollutants
+
+def scrape_waqi_page(city):
     """
     Scrape air quality data from WAQI website for a specific city.
     
@@ -29,8 +223,15 @@ def fetch_waqi_data(city):
     - city (str): Name of the city
     
     Returns:
-    - Dictionary containing the air quality data
+    - Dictionary containing the air quality data, or None if the page could
+      not be read
+    
+    Raises:
+    - http_client.CircuitOpen / DeadlineExceeded, so the run stops asking
     """
+    import requests
+    import http_client
+    
     # Format city name for URL
     city_formatted = city.lower().replace(" ", "-")
     url = f"https://aqicn.org/city/{city_formatted}/"
@@ -43,18 +244,16 @@ def fetch_waqi_data(city):
     }
     
     try:
-        response = requests.get(url, headers=headers)
+        response = http_client.get(url, headers=headers)
         response.raise_for_status()
         
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Extract AQI value
-        aqi_div = soup.find('div', {'id': 'aqiwgtvalue'})
-        if not aqi_div:
+        with metrics.span("parse"):
+            extracted = extract_waqi_page(response.text)
+        if not extracted:
             print(f"Could not find AQI value for {city}")
             return None
         
-        aqi_value = aqi_div.text.strip()
+        aqi_value, pollutants = extracted
         
         # Extract pollutant data
         data = {
@@ -62,79 +261,93 @@ def fetch_waqi_data(city):
             'aqi': aqi_value,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
-        
-        # Find detailed pollutant data
-        pollutant_table = soup.find('table', {'id': 'aqitable'})
-        if pollutant_table:
-            rows = pollutant_table.find_all('tr')
-            for row in rows:
-                cols = row.find_all('td')
-                if len(cols) >= 2:
-                    pollutant = cols[0].text.strip().lower()
-                    value = cols[1].text.strip()
-                    data[pollutant] = value
+        data.update(pollutants)
         
         return data
     
+    except (http_client.CircuitOpen, http_client.DeadlineExceeded):
+        raise
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data for {city}: {e}")
         return None
 
-def save_data_to_csv(data_list):
+def to_measurements(data_list):
     """
-    Save a list of air quality data dictionaries to a CSV file.
+    Map scraped WAQI records onto the canonical measurement columns.
+    
+    The overall AQI becomes parameter "aqi"; every pollutant in the table
+    becomes its own row. WAQI reports pollutant sub-indices, so values are
+    stored with unit "AQI". Weather readings from the feed are stored as
+    rows of their own with their physical units and no AQI.
+    
+    Parameters:
+    - data_list (list): Dictionaries as returned by fetch_waqi_data
+    
+    Returns:
+    - DataFrame with the columns expected by storage.MeasurementStore
+    """
+    import pandas as pd
+    
+    local_tz = datetime.now().astimezone().tzinfo
+    rows = []
+    
+    for data in data_list:
+        if data.get('unchanged'):
+            continue
+        timestamp = pd.Timestamp(data["timestamp"])
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize(local_tz)
+        base = {
+            "station_id": f"waqi:{data['city']}",
+            "city": data["city"],
+            "latitude": data.get("latitude"),
+            "longitude": data.get("longitude"),
+            "timestamp": timestamp.isoformat()
+        }
+        readings = [("aqi", "AQI", data["aqi"])]
+        readings += [(parameter, "AQI", data[key]) for key, parameter in PARAMETER_NAMES.items() if key in data]
+        readings += [(parameter, unit, data[key]) for key, (parameter, unit) in WEATHER_NAMES.items() if key in data]
+        for parameter, unit, value in readings:
+            rows.append({**base, "parameter": parameter, "unit": unit, "value": value,
+                         "aqi": value if unit == "AQI" else None})
+    
+    df = normalize(SCHEMA, rows)
+    return df.dropna(subset=["value"])
+
+def save_data(data_list):
+    """
+    Append a list of air quality data dictionaries to the measurement store,
+    skipping readings that are not newer than the stored watermarks.
     
     Parameters:
     - data_list (list): List of dictionaries containing air quality data
+    
+    Returns:
+    - Number of rows written
     """
+    from http_client import check_deadline
+    from ingest import ingest
+    from storage import store
+    
     if not data_list:
         print("No data to save.")
-        return
-    
-    # Create data directory if it doesn't exist
-    os.makedirs("air_quality_data", exist_ok=True)
-    
-    # Create filename with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"air_quality_data/waqi_data_{timestamp}.csv"
+        return 0
     
-    # Convert to DataFrame and save to CSV
-    df = pd.DataFrame(data_list)
-    df.to_csv(filename, index=False)
-    print(f"Data saved to {filename}")
+    with metrics.span("normalize"):
+        measurements = watermarks.filter_new(to_measurements(data_list))
+    check_deadline("storing WAQI data")
+    rows = ingest(measurements)
+    watermarks.commit(measurements, [data['request_key'] for data in data_list if data.get('request_key')])
+    print(f"{rows} new measurements saved to {store.root}")
+    return rows
 
 def main():
-    # List of cities to scrape
-    cities = [
-        "Beijing",
-        "Delhi",
-        "London",
-        "Los Angeles",
-        "Mexico City",
-        "Mumbai",
-        "Paris",
-        "São Paulo",
-        "Shanghai",
-        "Tokyo"
-    ]
-    
-    data_list = []
-    
-    for city in cities:
-        print(f"Scraping data for {city}...")
-        data = fetch_waqi_data(city)
-        
-        if data:
-            data_list.append(data)
-            print(f"Successfully scraped data for {city}")
-        
-        # Random delay between requests to avoid overloading the server
-        delay = random.uniform(3, 7)
-        print(f"Waiting {delay:.2f} seconds before next request...")
-        time.sleep(delay)
+    print(f"Fetching data for {len(CITIES)} cities...")
+    data_list = fetch_waqi_batch(CITIES)
+    print(f"Fetched data for {len(data_list)} of {len(CITIES)} cities")
     
-    print("\nSaving all data to CSV...")
-    save_data_to_csv(data_list)
+    print("\nSaving all data...")
+    save_data(data_list)
     print("Done!")
 
 if __name__ == "__main__":
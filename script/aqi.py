@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Vectorized US EPA Air Quality Index engine.
+Converts arrays of pollutant concentrations into sub-indices, an overall
+AQI, the dominant pollutant and the AQI category, using the EPA breakpoint
+tables (with the 2024 PM2.5 revision). Averaging helpers cover the PM
+NowCast and the 8-hour O3/CO means. Every function works on whole NumPy
+arrays, so millions of rows are handled in one pass.
+
+Expected units: PM2.5 and PM10 in µg/m³, O3 and CO in ppm, NO2 and SO2 in ppb.
+to_standard_units converts from other common units.
+
+Requirements:
+- numpy
+
+Install with: pip install numpy
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# AQI index range of every category band
+INDEX_BANDS = [(0, 50), (51, 100), (101, 150), (151, 200), (201, 300), (301, 500)]
+
+# Concentration breakpoints (low, high) per band; None where a band is undefined
+BREAKPOINTS = {
+    "pm25": [(0.0, 9.0), (9.1, 35.4), (35.5, 55.4), (55.5, 125.4), (125.5, 225.4), (225.5, 325.4)],
+    "pm10": [(0, 54), (55, 154), (155, 254), (255, 354), (355, 424), (425, 604)],
+    "o3_8h": [(0.000, 0.054), (0.055, 0.070), (0.071, 0.085), (0.086, 0.105), (0.106, 0.200), None],
+    "o3_1h": [None, None, (0.125, 0.164), (0.165, 0.204), (0.205, 0.404), (0.405, 0.604)],
+    "co": [(0.0, 4.4), (4.5, 9.4), (9.5, 12.4), (12.5, 15.4), (15.5, 30.4), (30.5, 50.4)],
+    "so2": [(0, 35), (36, 75), (76, 185), (186, 304), (305, 604), (605, 1004)],
+    "no2": [(0, 53), (54, 100), (101, 360), (361, 649), (650, 1249), (1250, 2049)]
+}
+
+# Decimal places concentrations are truncated to before lookup
+TRUNCATION = {
+    "pm25": 1,
+    "pm10": 0,
+    "o3_8h": 3,
+    "o3_1h": 3,
+    "co": 1,
+    "so2": 0,
+    "no2": 0
+}
+
+# Tables that may be extrapolated past their top breakpoint ("beyond the AQI")
+EXTRAPOLATE = {"pm25", "pm10", "co", "so2", "no2", "o3_1h"}
+
+# Accepted aliases for the table names above
+ALIASES = {"o3": "o3_8h", "pm2.5": "pm25"}
+
+CATEGORIES = [
+    "Good",
+    "Moderate",
+    "Unhealthy for Sensitive Groups",
+    "Unhealthy",
+    "Very Unhealthy",
+    "Hazardous"
+]
+
+CATEGORY_COLORS = ["#00E400", "#FFFF00", "#FF7E00", "#FF0000", "#8F3F97", "#7E0023"]
+
+# Molecular weights (g/mol) used to convert gases from µg/m³ at 25 °C
+MOLECULAR_WEIGHTS = {"o3": 48.00, "no2": 46.01, "so2": 64.07, "co": 28.01}
+
+# Standard unit of every pollutant
+STANDARD_UNITS = {"pm25": "µg/m³", "pm10": "µg/m³", "o3": "ppm", "co": "ppm", "so2": "ppb", "no2": "ppb"}
+
+def _table(pollutant):
+    """Return (c_lo, c_hi, i_lo, i_hi) arrays for the defined bands of a pollutant."""
+    bands = [(bp, idx) for bp, idx in zip(BREAKPOINTS[pollutant], INDEX_BANDS) if bp is not None]
+    c_lo, c_hi = (np.array(v, dtype=np.float64) for v in zip(*(bp for bp, _ in bands)))
+    i_lo, i_hi = (np.array(v, dtype=np.float64) for v in zip(*(idx for _, idx in bands)))
+    return c_lo, c_hi, i_lo, i_hi
+
+_TABLES = {name: _table(name) for name in BREAKPOINTS}
+
+def truncate(pollutant, concentrations):
+    """
+    Truncate concentrations to the precision the breakpoint tables use.
+
+    Parameters:
+    - pollutant (str): Table name, e.g. 'pm25' or 'o3_8h'
+    - concentrations (array-like): Concentrations in standard units
+
+    Returns:
+    - float64 array of truncated concentrations
+    """
+    pollutant = ALIASES.get(pollutant, pollutant)
+    scale = 10.0 ** TRUNCATION[pollutant]
+    values = np.asarray(concentrations, dtype=np.float64)
+    # The small epsilon keeps values like 0.070 from truncating to 0.069
+    return np.floor(values * scale + 1e-9) / scale
+
+def sub_index(pollutant, concentrations):
+    """
+    Compute the AQI sub-index of one pollutant.
+
+    Parameters:
+    - pollutant (str): 'pm25', 'pm10', 'o3_8h' (or 'o3'), 'o3_1h', 'co', 'so2' or 'no2'
+    - concentrations (array-like): Concentrations in standard units
+
+    Returns:
+    - float64 array of sub-indices; NaN for missing, negative or out-of-table values
+    """
+    pollutant = ALIASES.get(pollutant, pollutant)
+    c_lo, c_hi, i_lo, i_hi = _TABLES[pollutant]
+    c = truncate(pollutant, concentrations)
+
+    band = np.searchsorted(c_hi, c, side="left")
+    beyond = band >= len(c_hi)
+    band = np.minimum(band, len(c_hi) - 1)
+
+    index = (i_hi[band] - i_lo[band]) / (c_hi[band] - c_lo[band]) * (c - c_lo[band]) + i_lo[band]
+    index = np.floor(index + 0.5)
+
+    invalid = np.isnan(c) | (c < c_lo[0]) | (c < 0)
+    if pollutant not in EXTRAPOLATE:
+        invalid |= beyond
+    return np.where(invalid, np.nan, index)
+
+def categorize(aqi_values):
+    """
+    Map AQI values to category indices.
+
+    Parameters:
+    - aqi_values (array-like): AQI values
+
+    Returns:
+    - int8 array of indices into CATEGORIES (-1 where the AQI is NaN)
+    """
+    values = np.asarray(aqi_values, dtype=np.float64)
+    upper = np.array([hi for _, hi in INDEX_BANDS[:-1]], dtype=np.float64)
+    categories = np.searchsorted(upper, values, side="left").astype(np.int8)
+    return np.where(np.isnan(values), np.int8(-1), categories)
+
+def category_names(category_indices):
+    """Return an object array of category names for category indices (None for -1)."""
+    names = np.array(CATEGORIES + [None], dtype=object)
+    return names[np.asarray(category_indices)]
+
+def compute_aqi(concentrations):
+    """
+    Compute sub-indices, overall AQI, dominant pollutant and category.
+
+    Ozone is evaluated on both the 8-hour and 1-hour tables when both are
+    given ('o3_8h' / 'o3' and 'o3_1h'), and the higher sub-index is used.
+
+    Parameters:
+    - concentrations (dict): Pollutant name -> array of concentrations in
+      standard units; all arrays must broadcast to the same shape
+
+    Returns:
+    - Dictionary with:
+      - 'sub_indices': pollutant -> sub-index array
+      - 'aqi': overall AQI array (NaN where no pollutant is available)
+      - 'dominant': object array of the pollutant driving the AQI
+      - 'category': int8 category index array
+    """
+    sub_indices = {ALIASES.get(name, name): sub_index(name, values)
+                   for name, values in concentrations.items()}
+    ozone = [sub_indices.pop(name) for name in ("o3_8h", "o3_1h") if name in sub_indices]
+    if ozone:
+        sub_indices["o3"] = np.fmax.reduce(np.broadcast_arrays(*ozone))
+
+    names = list(sub_indices)
+    stacked = np.stack(np.broadcast_arrays(*sub_indices.values()))
+    missing = np.isnan(stacked).all(axis=0)
+    filled = np.where(np.isnan(stacked), -np.inf, stacked)
+
+    aqi = np.where(missing, np.nan, filled.max(axis=0))
+    dominant = np.array(names, dtype=object)[filled.argmax(axis=0)]
+    dominant = np.where(missing, None, dominant)
+
+    return {
+        "sub_indices": sub_indices,
+        "aqi": aqi,
+        "dominant": dominant,
+        "category": categorize(aqi)
+    }
+
+def nowcast(hourly, min_weight=0.5):
+    """
+    Compute the EPA NowCast for blocks of 12 hourly concentrations.
+
+    Parameters:
+    - hourly (array-like): Array of shape (..., 12), oldest hour first and the
+      most recent hour last; missing hours are NaN
+    - min_weight (float): Lower bound of the weight factor (0.5 for PM)
+
+    Returns:
+    - float64 array of shape (...) with the NowCast concentration; NaN unless
+      at least two of the three most recent hours are valid
+    """
+    values = np.asarray(hourly, dtype=np.float64)[..., ::-1]
+    valid = ~np.isnan(values)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        high = np.nanmax(np.where(valid, values, -np.inf), axis=-1)
+        low = np.nanmin(np.where(valid, values, np.inf), axis=-1)
+        weight = np.where(high > 0, 1.0 - (high - low) / high, 1.0)
+    weight = np.maximum(weight, min_weight)
+
+    powers = weight[..., None] ** np.arange(values.shape[-1])
+    powers = np.where(valid, powers, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result = (powers * np.where(valid, values, 0.0)).sum(axis=-1) / powers.sum(axis=-1)
+
+    enough = valid[..., :3].sum(axis=-1) >= 2
+    return np.where(enough, result, np.nan)
+
+def rolling_nowcast(series, min_weight=0.5):
+    """
+    NowCast at every hour of an hourly series.
+
+    Parameters:
+    - series (array-like): Hourly concentrations along the last axis, oldest first
+    - min_weight (float): Lower bound of the weight factor (0.5 for PM)
+
+    Returns:
+    - float64 array of the same shape; the first 11 hours are NaN
+    """
+    values = np.asarray(series, dtype=np.float64)
+    padded = np.concatenate([np.full(values.shape[:-1] + (11,), np.nan), values], axis=-1)
+    result = nowcast(sliding_window_view(padded, 12, axis=-1), min_weight)
+    result[..., :11] = np.nan
+    return result
+
+def rolling_mean(series, window=8, min_periods=6):
+    """
+    Trailing rolling mean of an hourly series (e.g. 8-hour O3 and CO).
+
+    Parameters:
+    - series (array-like): Hourly concentrations along the last axis, oldest first
+    - window (int): Number of hours averaged
+    - min_periods (int): Valid hours required (EPA uses 6 of 8)
+
+    Returns:
+    - float64 array of the same shape; NaN where too few hours are valid
+    """
+    values = np.asarray(series, dtype=np.float64)
+    padded = np.concatenate([np.full(values.shape[:-1] + (window - 1,), np.nan), values], axis=-1)
+    windows = sliding_window_view(padded, window, axis=-1)
+    counts = (~np.isnan(windows)).sum(axis=-1)
+    sums = np.nansum(windows, axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return np.where(counts >= min_periods, means, np.nan)
+
+def to_standard_units(pollutant, values, unit):
+    """
+    Convert concentrations to the units the breakpoint tables use.
+
+    Parameters:
+    - pollutant (str): Canonical pollutant name ('pm25', 'o3', 'no2', ...)
+    - values (array-like): Concentrations
+    - unit (str): Unit of values ('µg/m³', 'ppm' or 'ppb')
+
+    Returns:
+    - float64 array in STANDARD_UNITS[pollutant]
+
+    Raises:
+    - ValueError for a unit that cannot be converted
+    """
+    values = np.asarray(values, dtype=np.float64)
+    target = STANDARD_UNITS[pollutant]
+    unit = unit.replace("ug/m3", "µg/m³").replace("µg/m3", "µg/m³")
+    if unit == target:
+        return values
+
+    # Express everything in ppb first
+    if unit == "ppm":
+        ppb = values * 1000.0
+    elif unit == "ppb":
+        ppb = values
+    elif unit == "µg/m³" and pollutant in MOLECULAR_WEIGHTS:
+        ppb = values * 24.45 / MOLECULAR_WEIGHTS[pollutant]
+    else:
+        raise ValueError(f"Cannot convert {pollutant} from {unit} to {target}")
+    return ppb / 1000.0 if target == "ppm" else ppb
+
+def measurement_standard_values(measurements):
+    """
+    Convert every row of a canonical measurement frame to standard units.
+
+    Parameters:
+    - measurements (DataFrame): Canonical columns 'parameter', 'unit' and 'value'
+
+    Returns:
+    - float64 array aligned with the rows of measurements; NaN for rows
+      reported as AQI and for parameters or units that cannot be converted
+    """
+    result = np.full(len(measurements), np.nan)
+    parameters = measurements["parameter"].fillna("").astype(str).to_numpy()
+    units = measurements["unit"].fillna("").astype(str).to_numpy()
+    values = measurements["value"].to_numpy(dtype=np.float64)
+
+    for pollutant in STANDARD_UNITS:
+        selected = parameters == pollutant
+        for unit in np.unique(units[selected]):
+            rows = selected & (units == unit)
+            try:
+                result[rows] = to_standard_units(pollutant, values[rows], unit)
+            except ValueError:
+                continue
+    return result
+
+def measurement_sub_indices(measurements, standard_values=None):
+    """
+    Compute the AQI sub-index of every row of a canonical measurement frame.
+
+    Rows already reported as AQI (unit 'AQI') keep their value; rows whose
+    parameter or unit cannot be converted get NaN. Ozone uses the 8-hour table.
+
+    Parameters:
+    - measurements (DataFrame): Canonical columns 'parameter', 'unit' and 'value'
+    - standard_values (array, optional): Result of measurement_standard_values,
+      if already computed
+
+    Returns:
+    - float64 array aligned with the rows of measurements
+    """
+    if standard_values is None:
+        standard_values = measurement_standard_values(measurements)
+    result = np.full(len(measurements), np.nan)
+    parameters = measurements["parameter"].fillna("").astype(str).to_numpy()
+
+    reported = (measurements["unit"] == "AQI").to_numpy()
+    result[reported] = measurements["value"].to_numpy(dtype=np.float64)[reported]
+
+    for pollutant in STANDARD_UNITS:
+        rows = (parameters == pollutant) & ~reported
+        result[rows] = sub_index(pollutant, standard_values[rows])
+    return result
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Per-source circuit breakers for the air quality source fetchers.
+A breaker counts consecutive failed requests to one provider. Once
+FAILURE_THRESHOLD requests in a row have failed it opens, and requests to
+that provider are refused straight away for OPEN_SECONDS. After that, one
+trial request is let through: if it succeeds the breaker closes again,
+otherwise it stays open for another period.
+
+Breaker states are saved between runs, so a provider that is down is not
+retried by every short-lived fetcher process.
+"""
+
+import json
+import os
+import threading
+import time
+
+# Persisted breaker states, keyed by source
+BREAKER_FILE = "air_quality_data/breakers.json"
+
+# Consecutive failures that open a breaker
+FAILURE_THRESHOLD = 5
+
+# Seconds an open breaker refuses requests before letting a trial through
+OPEN_SECONDS = 300
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker of one provider."""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.lock = threading.Lock()
+        self.failures = state.get("failures", 0)
+        self.opened_at = state.get("opened_at")
+        self.last_failure = state.get("last_failure")
+        self.last_success = state.get("last_success")
+        self.trial = False
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half_open' (cooled down, waiting for a trial)."""
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.time() - self.opened_at < OPEN_SECONDS else "half_open"
+
+    def is_open(self):
+        """True while the breaker refuses every request."""
+        with self.lock:
+            return self.state == "open" or (self.state == "half_open" and self.trial)
+
+    def allow(self):
+        """
+        Ask whether a request may be sent.
+
+        A half-open breaker lets exactly one trial request through until
+        its outcome is recorded.
+
+        Returns:
+        - True if the request may be sent
+        """
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self):
+        """Close the breaker after a successful request."""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+            self.last_success = time.time()
+
+    def release(self):
+        """Give back a trial permit whose request was never judged (e.g. cut short by a deadline)."""
+        with self.lock:
+            self.trial = False
+
+    def record_failure(self):
+        """Count a failed request, opening the breaker at the threshold or after a failed trial."""
+        with self.lock:
+            now = time.time()
+            self.failures += 1
+            self.last_failure = now
+            if self.trial or self.failures >= FAILURE_THRESHOLD:
+                self.opened_at = now
+            self.trial = False
+
+    def snapshot(self):
+        """JSON-serializable state of the breaker."""
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opened_at": self.opened_at,
+                "last_failure": self.last_failure,
+                "last_success": self.last_success
+            }
+
+class BreakerBoard:
+    """Lazily created breakers keyed by source, persisted to one file."""
+
+    def __init__(self, path=BREAKER_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.states = json.load(f)
+        except (OSError, ValueError):
+            self.states = {}
+        self.breakers = {}
+
+    def get(self, source):
+        """
+        Return the breaker of a source, creating it on first use.
+
+        Parameters:
+        - source (str): Source name (e.g. "airnow") or host
+
+        Returns:
+        - CircuitBreaker
+        """
+        with self.lock:
+            breaker = self.breakers.get(source)
+            if breaker is None:
+                breaker = CircuitBreaker(self.states.get(source))
+                self.breakers[source] = breaker
+            return breaker
+
+    def snapshot(self):
+        """States of every breaker seen in this process or a previous one."""
+        with self.lock:
+            states = dict(self.states)
+            breakers = dict(self.breakers)
+        states.update({source: breaker.snapshot() for source, breaker in breakers.items()})
+        return states
+
+    def save(self):
+        """Atomically write the breaker states to disk."""
+        states = self.snapshot()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(states, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+# Breakers shared by every fetcher in this process
+breakers = BreakerBoard()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Streaming correlation statistics between weather and pollutant readings.
+Weather readings are paired with the pollutant AQI sub-indices reported by
+the same station for the same hour. Every station, weather parameter and
+pollutant keeps running co-moment accumulators (count, means, squared
+deviations and co-deviation) for all time and for each day. New batches
+are merged in with the parallel Welford update, so each observation costs
+O(1) and the full history is never reread. Pearson r, slopes and counts
+for all time or a rolling window are computed on demand.
+
+Requirements:
+- numpy
+- pandas
+
+Install with: pip install numpy pandas
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from aqi import STANDARD_UNITS, measurement_sub_indices
+
+# File holding the accumulators
+CORRELATION_FILE = "air_quality_data/correlations.npz"
+
+# Weather parameters as stored in the measurement frames, with their units
+WEATHER_UNITS = {
+    "temperature": "°C",
+    "humidity": "%",
+    "wind_speed": "m/s",
+    "pressure": "hPa",
+    "precipitation": "mm"
+}
+
+# Pollutants correlated against the weather; "aqi" is the overall index
+POLLUTANTS = tuple(STANDARD_UNITS) + ("aqi",)
+
+# Rolling windows in days, built from the daily accumulators
+WINDOWS = {"7d": 7, "30d": 30}
+
+# Moment columns: count, mean of x, mean of y, sum of squared x deviations,
+# sum of squared y deviations, sum of co-deviations
+N, MEAN_X, MEAN_Y, M2_X, M2_Y, C_XY = range(6)
+
+def merge_moments(a, b):
+    """
+    Combine two sets of co-moment accumulators (Chan et al. parallel update).
+
+    Parameters:
+    - a (array): (rows, 6) accumulators
+    - b (array): (rows, 6) accumulators of the same keys
+
+    Returns:
+    - (rows, 6) accumulators covering both
+    """
+    n = a[:, N] + b[:, N]
+    safe = np.where(n > 0, n, 1)
+    dx = b[:, MEAN_X] - a[:, MEAN_X]
+    dy = b[:, MEAN_Y] - a[:, MEAN_Y]
+    weight = a[:, N] * b[:, N] / safe
+    merged = np.empty_like(a)
+    merged[:, N] = n
+    merged[:, MEAN_X] = a[:, MEAN_X] + dx * b[:, N] / safe
+    merged[:, MEAN_Y] = a[:, MEAN_Y] + dy * b[:, N] / safe
+    merged[:, M2_X] = a[:, M2_X] + b[:, M2_X] + dx * dx * weight
+    merged[:, M2_Y] = a[:, M2_Y] + b[:, M2_Y] + dy * dy * weight
+    merged[:, C_XY] = a[:, C_XY] + b[:, C_XY] + dx * dy * weight
+    return merged
+
+def remove_moments(total, part):
+    """
+    Inverse of merge_moments: the accumulators of total without part.
+
+    Parameters:
+    - total (array): (rows, 6) accumulators that part was merged into
+    - part (array): (rows, 6) accumulators to take out
+
+    Returns:
+    - (rows, 6) accumulators of the rest (all zero where nothing is left)
+    """
+    n = total[:, N] - part[:, N]
+    safe = np.where(n > 0, n, 1)
+    mean_x = (total[:, N] * total[:, MEAN_X] - part[:, N] * part[:, MEAN_X]) / safe
+    mean_y = (total[:, N] * total[:, MEAN_Y] - part[:, N] * part[:, MEAN_Y]) / safe
+    dx = part[:, MEAN_X] - mean_x
+    dy = part[:, MEAN_Y] - mean_y
+    weight = n * part[:, N] / np.where(total[:, N] > 0, total[:, N], 1)
+    rest = np.empty_like(total)
+    rest[:, N] = n
+    rest[:, MEAN_X] = mean_x
+    rest[:, MEAN_Y] = mean_y
+    rest[:, M2_X] = np.maximum(total[:, M2_X] - part[:, M2_X] - dx * dx * weight, 0)
+    rest[:, M2_Y] = np.maximum(total[:, M2_Y] - part[:, M2_Y] - dy * dy * weight, 0)
+    rest[:, C_XY] = total[:, C_XY] - part[:, C_XY] - dx * dy * weight
+    rest[n <= 0] = 0
+    return rest
+
+def batch_moments(keys, x, y):
+    """
+    Accumulators of paired observations grouped by key.
+
+    Parameters:
+    - keys (array): Key of every observation
+    - x (array): Weather values
+    - y (array): Pollutant values
+
+    Returns:
+    - Tuple of (unique keys, (len(unique), 6) accumulators)
+    """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    count = np.bincount(inverse, minlength=len(unique)).astype(np.float64)
+    mean_x = np.bincount(inverse, x, len(unique)) / count
+    mean_y = np.bincount(inverse, y, len(unique)) / count
+    dx = x - mean_x[inverse]
+    dy = y - mean_y[inverse]
+    moments = np.column_stack([
+        count, mean_x, mean_y,
+        np.bincount(inverse, dx * dx, len(unique)),
+        np.bincount(inverse, dy * dy, len(unique)),
+        np.bincount(inverse, dx * dy, len(unique))
+    ])
+    return unique, moments
+
+def describe(moments):
+    """
+    Summarize one set of accumulators.
+
+    Returns:
+    - Dictionary with 'n', 'r' (Pearson correlation), 'slope' and 'intercept'
+      of the least-squares line of pollutant on weather; r and the line are
+      None with fewer than 2 observations or no variation
+    """
+    n = int(moments[N])
+    result = {"n": n, "r": None, "slope": None, "intercept": None}
+    if n < 2 or moments[M2_X] <= 0:
+        return result
+    slope = moments[C_XY] / moments[M2_X]
+    result["slope"] = round(float(slope), 4)
+    result["intercept"] = round(float(moments[MEAN_Y] - slope * moments[MEAN_X]), 4)
+    if moments[M2_Y] > 0:
+        r = moments[C_XY] / np.sqrt(moments[M2_X] * moments[M2_Y])
+        result["r"] = round(float(np.clip(r, -1, 1)), 4)
+    return result
+
+class Accumulators:
+    """Co-moment accumulators stored as one array row per key."""
+
+    def __init__(self):
+        self.keys = []
+        self.index = {}
+        self.moments = np.zeros((0, 6))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys, moments):
+        """Merge accumulators of unique keys, adding rows for new keys."""
+        rows = np.empty(len(keys), dtype=np.int64)
+        new = []
+        for i, key in enumerate(keys.tolist()):
+            row = self.index.get(key)
+            if row is None:
+                row = len(self.keys)
+                self.index[key] = row
+                self.keys.append(key)
+                new.append(key)
+            rows[i] = row
+        if new:
+            self.moments = np.vstack([self.moments, np.zeros((len(new), 6))])
+        self.moments[rows] = merge_moments(self.moments[rows], moments)
+
+    def subtract(self, keys, moments):
+        """Take accumulators of unique keys back out; keys without a row are ignored."""
+        rows = np.array([self.index.get(key, -1) for key in keys.tolist()], dtype=np.int64)
+        known = rows >= 0
+        if known.any():
+            self.moments[rows[known]] = remove_moments(self.moments[rows[known]], moments[known])
+
+    def select(self, keep):
+        """Drop every row where the boolean mask keep is False."""
+        self.keys = [key for key, k in zip(self.keys, keep.tolist()) if k]
+        self.index = {key: row for row, key in enumerate(self.keys)}
+        self.moments = self.moments[keep]
+
+    def combine(self, matches):
+        """Merge every row whose key satisfies matches into one accumulator."""
+        combined = np.zeros((1, 6))
+        for key, row in zip(self.keys, self.moments):
+            if matches(key):
+                combined = merge_moments(combined, row[None, :])
+        return combined[0]
+
+def _daily_cutoff():
+    """Day (YYYY-MM-DD) on or before which daily accumulators are no longer kept."""
+    return (datetime.now(timezone.utc) - timedelta(days=max(WINDOWS.values()))).strftime("%Y-%m-%d")
+
+class CorrelationStore:
+    """
+    All-time and daily weather/pollutant accumulators for every station.
+
+    All-time keys are "station|weather|pollutant"; daily keys append the UTC
+    date. Daily rows older than the longest window are dropped.
+    """
+
+    def __init__(self, path=CORRELATION_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.all_time = Accumulators()
+        self.daily = Accumulators()
+        self._cutoff = None
+        try:
+            with np.load(path) as data:
+                for name in ("all_time", "daily"):
+                    accumulators = getattr(self, name)
+                    accumulators.keys = data[f"{name}_keys"].tolist()
+                    accumulators.moments = data[f"{name}_moments"]
+                    accumulators.index = {key: row for row, key in enumerate(accumulators.keys)}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        """Atomically write the accumulators to disk."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp.npz"
+        with self.lock:
+            np.savez_compressed(tmp_path,
+                                all_time_keys=np.array(self.all_time.keys, dtype=str),
+                                all_time_moments=self.all_time.moments,
+                                daily_keys=np.array(self.daily.keys, dtype=str),
+                                daily_moments=self.daily.moments)
+        os.replace(tmp_path, self.path)
+
+    def pairs(self, measurements):
+        """
+        Pair weather readings with pollutant sub-indices of the same station and hour.
+
+        Parameters:
+        - measurements (DataFrame): Canonical measurement columns
+
+        Returns:
+        - DataFrame with station_id, weather, pollutant, hour, x and y
+        """
+        columns = ["station_id", "weather", "pollutant", "hour", "x", "y"]
+        frame = measurements[["station_id", "parameter", "timestamp"]].copy()
+        frame["hour"] = pd.to_datetime(frame["timestamp"], utc=True).dt.floor("h")
+        frame["value"] = pd.to_numeric(measurements["value"], errors="coerce").to_numpy()
+
+        weather = frame[frame["parameter"].isin(WEATHER_UNITS)]
+        if weather.empty:
+            return pd.DataFrame(columns=columns)
+        pollutant = frame[frame["parameter"].isin(POLLUTANTS)].copy()
+        pollutant["value"] = measurement_sub_indices(measurements.loc[pollutant.index])
+
+        keys = ["station_id", "hour", "parameter"]
+        weather = weather.dropna(subset=["hour", "value"]).groupby(keys, as_index=False)["value"].mean()
+        pollutant = pollutant.dropna(subset=["hour", "value"]).groupby(keys, as_index=False)["value"].mean()
+        paired = weather.merge(pollutant, on=["station_id", "hour"], suffixes=("_x", "_y"))
+        paired = paired.rename(columns={"parameter_x": "weather", "parameter_y": "pollutant",
+                                        "value_x": "x", "value_y": "y"})
+        return paired[columns]
+
+    def update(self, measurements, save=True):
+        """
+        Fold newly stored measurements into the accumulators.
+
+        Only weather and pollutant readings that arrive in the same batch for
+        the same station and hour are paired. Call this once per stored batch.
+
+        Parameters:
+        - measurements (DataFrame): Canonical measurement columns
+        - save (bool): Persist the accumulators afterwards
+
+        Returns:
+        - Number of weather/pollutant pairs folded in
+        """
+        if measurements is None or measurements.empty:
+            return 0
+        paired = self.pairs(measurements)
+        if paired.empty:
+            return 0
+
+        with self.lock:
+            self._fold(paired, "add")
+            cutoff = _daily_cutoff()
+            if cutoff != self._cutoff and len(self.daily):
+                self._cutoff = cutoff
+                self.daily.select(np.array([key.rsplit("|", 1)[1] > cutoff for key in self.daily.keys], dtype=bool))
+
+        if save:
+            self.save()
+        return len(paired)
+
+    def revise(self, removed, remaining, save=True):
+        """
+        Take measurements deleted from the store back out of the accumulators.
+
+        The station-hours of the removed rows are paired twice: with the
+        removed rows, as they were folded in, and without them, as the store
+        now holds them. The first pairs are subtracted and the second added.
+
+        Parameters:
+        - removed (DataFrame): Canonical measurement rows deleted from the store
+        - remaining (DataFrame): Stored rows of the same stations and hours
+        - save (bool): Persist the accumulators afterwards
+
+        Returns:
+        - Number of weather/pollutant pairs taken out
+        """
+        if removed is None or removed.empty:
+            return 0
+        before = self.pairs(pd.concat([remaining, removed], ignore_index=True))
+        if before.empty:
+            return 0
+        after = self.pairs(remaining.reset_index(drop=True)) if not remaining.empty else before.iloc[:0]
+
+        with self.lock:
+            self._fold(before, "subtract")
+            if not after.empty:
+                self._fold(after, "add")
+
+        if save:
+            self.save()
+        return len(before) - len(after)
+
+    def _fold(self, paired, method):
+        """Add or subtract the moments of pairs in the all-time and daily accumulators (caller holds the lock)."""
+        prefix = (paired["station_id"].astype(str) + "|" + paired["weather"] + "|"
+                  + paired["pollutant"]).to_numpy(dtype=str)
+        days = paired["hour"].dt.strftime("%Y-%m-%d").to_numpy(dtype=str)
+        x = paired["x"].to_numpy(dtype=np.float64)
+        y = paired["y"].to_numpy(dtype=np.float64)
+
+        getattr(self.all_time, method)(*batch_moments(prefix, x, y))
+        recent = days > _daily_cutoff()
+        if recent.any():
+            daily_keys = np.char.add(np.char.add(prefix[recent], "|"), days[recent])
+            getattr(self.daily, method)(*batch_moments(daily_keys, x[recent], y[recent]))
+
+    def correlation(self, weather, pollutant="pm25", station_ids=None, window="all"):
+        """
+        Correlation between one weather parameter and one pollutant.
+
+        Stations are pooled by merging their accumulators.
+
+        Parameters:
+        - weather (str): One of WEATHER_UNITS
+        - pollutant (str): One of POLLUTANTS
+        - station_ids (iterable, optional): Stations to include (default: all)
+        - window (str): 'all' or one of WINDOWS
+
+        Returns:
+        - Dictionary as returned by describe, plus 'weather', 'pollutant' and 'window'
+        """
+        if window != "all" and window not in WINDOWS:
+            raise ValueError(f"Unknown window: {window} (expected 'all' or one of {', '.join(WINDOWS)})")
+        wanted = None if station_ids is None else set(station_ids)
+        suffix = f"|{weather}|{pollutant}"
+
+        if window == "all":
+            def matches(key):
+                station, _, rest = key.partition("|")
+                return "|" + rest == suffix and (wanted is None or station in wanted)
+            accumulators = self.all_time
+        else:
+            start = (datetime.now(timezone.utc) - timedelta(days=WINDOWS[window])).strftime("%Y-%m-%d")
+            def matches(key):
+                head, day = key.rsplit("|", 1)
+                station, _, rest = head.partition("|")
+                return day > start and "|" + rest == suffix and (wanted is None or station in wanted)
+            accumulators = self.daily
+
+        with self.lock:
+            moments = accumulators.combine(matches)
+        return {"weather": weather, "pollutant": pollutant, "window": window, **describe(moments)}
+
+    def table(self, pollutant="pm25", station_ids=None, window="all"):
+        """Correlations of every weather parameter with one pollutant."""
+        return [self.correlation(weather, pollutant, station_ids, window) for weather in WEATHER_UNITS]
+
+    def rebuild(self, store, batch_days=31):
+        """
+        Recompute every accumulator from the full measurement store.
+
+        Parameters:
+        - store (MeasurementStore): Store to scan
+        - batch_days (int): Days of partitions read at a time
+
+        Returns:
+        - Number of pairs folded in
+        """
+        with self.lock:
+            self.all_time = Accumulators()
+            self.daily = Accumulators()
+        dates = sorted({date for _, _, date in store.partitions()})
+        pairs = 0
+        for i in range(0, len(dates), batch_days):
+            chunk = dates[i:i + batch_days]
+            end = (pd.Timestamp(chunk[-1]) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+            pairs += self.update(store.query(start=chunk[0], end=end), save=False)
+        self.save()
+        return pairs
+
+# Accumulators shared by every fetcher in this process
+correlations = CorrelationStore()
+
+def main():
+    import argparse
+    from storage import store
+
+    parser = argparse.ArgumentParser(description="Weather/pollutant correlation statistics")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute all accumulators from the measurement store")
+    parser.add_argument("--pollutant", default="pm25", help="Pollutant to report")
+    parser.add_argument("--window", default="all", help="'all' or one of: " + ", ".join(WINDOWS))
+    args = parser.parse_args()
+
+    if args.rebuild:
+        pairs = correlations.rebuild(store)
+        print(f"Rebuilt correlations from {pairs} weather/pollutant pairs")
+    for row in correlations.table(args.pollutant, window=args.window):
+        print(f"{row['weather']:>14}: r={row['r']} slope={row['slope']} n={row['n']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Vectorized exposure scoring for commute routes.
+Scores every route against every combination of path variant, departure
+time and transport mode in one pass over NumPy arrays, then keeps the top-k
+alternatives per route by exposure reduction. Exposure is the average PM2.5
+along the trip multiplied by the minutes spent travelling.
+
+Requirements:
+- numpy
+
+Install with: pip install numpy
+"""
+
+import numpy as np
+
+# Path variants: name -> (label, distance factor, PM2.5 factor)
+PATHS = {
+    "direct": (None, 1.0, 1.0),
+    "low_pollution": ("Less polluted route", 1.15, 0.65)
+}
+
+# Departure times: name -> (label, PM2.5 factor relative to the usual departure)
+DEPARTURES = {
+    "usual": (None, 1.0),
+    "off_peak": ("Travel during off-peak hours", 0.75)
+}
+
+# Transport modes: name -> (label, minutes per km, PM2.5 factor inside the vehicle)
+MODES = {
+    "car": (None, 6.0, 1.0),
+    "public_transport": ("Use different transport mode", 7.0, 0.5)
+}
+
+# PM10 is estimated from PM2.5 with this ratio
+PM10_RATIO = 1.6
+
+# Exposure units are (µg/m³ × minutes) / EXPOSURE_SCALE
+EXPOSURE_SCALE = 10
+
+def option_table(paths=PATHS, departures=DEPARTURES, modes=MODES):
+    """
+    Build the combinations of path, departure and mode as flat arrays.
+
+    The first entry of each table is the baseline, so option 0 is the
+    route as travelled today.
+
+    Parameters:
+    - paths (dict): Path variants as in PATHS
+    - departures (dict): Departure times as in DEPARTURES
+    - modes (dict): Transport modes as in MODES
+
+    Returns:
+    - Dictionary of arrays 'path', 'distance_factor', 'pm_factor',
+      'path_pm_factor', 'minutes_per_km' and a list 'labels' with the change
+      labels of every option
+    """
+    path_rows = list(paths.values())
+    departure_rows = list(departures.values())
+    mode_rows = list(modes.values())
+
+    p, d, m = np.meshgrid(np.arange(len(path_rows)), np.arange(len(departure_rows)),
+                          np.arange(len(mode_rows)), indexing="ij")
+    p, d, m = p.ravel(), d.ravel(), m.ravel()
+
+    path_distance = np.array([row[1] for row in path_rows])
+    path_pm = np.array([row[2] for row in path_rows])
+    departure_pm = np.array([row[1] for row in departure_rows])
+    mode_minutes = np.array([row[1] for row in mode_rows])
+    mode_pm = np.array([row[2] for row in mode_rows])
+
+    labels = [
+        [label for label in (path_rows[i][0], departure_rows[j][0], mode_rows[k][0]) if label]
+        for i, j, k in zip(p, d, m)
+    ]
+
+    return {
+        "path": p,
+        "distance_factor": path_distance[p],
+        "pm_factor": path_pm[p] * departure_pm[d] * mode_pm[m],
+        "path_pm_factor": path_pm[p],
+        "minutes_per_km": mode_minutes[m],
+        "labels": labels
+    }
+
+def score_options(distance_km, avg_pm25, options):
+    """
+    Score every route against every option.
+
+    Parameters:
+    - distance_km (array-like): Route distances, shape (R,)
+    - avg_pm25 (array-like): Average PM2.5 along each route, shape (R,)
+    - options (dict): Option arrays as returned by option_table; the factor
+      arrays may have shape (O,) or (R, O) for per-route factors, and an
+      optional (R, O) boolean 'available' mask excludes options
+
+    Returns:
+    - Dictionary of (R, O) arrays: 'distance_km', 'avg_pm25', 'minutes',
+      'total_exposure', 'exposure_reduction', 'reduction_percent',
+      'extra_time_mins' and 'available', all relative to option 0
+    """
+    distance = np.asarray(distance_km, dtype=np.float64)[:, None]
+    pm25 = np.asarray(avg_pm25, dtype=np.float64)[:, None]
+
+    distance = distance * options["distance_factor"]
+    pm25 = pm25 * options["pm_factor"]
+    minutes = distance * options["minutes_per_km"]
+    exposure = pm25 * minutes / EXPOSURE_SCALE
+
+    baseline = exposure[:, :1]
+    reduction = baseline - exposure
+    with np.errstate(invalid="ignore", divide="ignore"):
+        percent = np.where(baseline > 0, 100 * reduction / baseline, 0.0)
+
+    return {
+        "distance_km": distance,
+        "avg_pm25": pm25,
+        "minutes": minutes,
+        "total_exposure": exposure,
+        "exposure_reduction": reduction,
+        "reduction_percent": percent,
+        "extra_time_mins": minutes.astype(np.int64) - minutes[:, :1].astype(np.int64),
+        "available": np.broadcast_to(options.get("available", True), exposure.shape)
+    }
+
+def top_alternatives(scores, k=3):
+    """
+    Pick the k options with the largest exposure reduction for every route.
+
+    Parameters:
+    - scores (dict): Arrays as returned by score_options
+    - k (int): Alternatives kept per route
+
+    Returns:
+    - (R, k) int array of option indices, best first (option 0 is never
+      chosen; unavailable options only fill up rows with too few choices)
+    """
+    reduction = np.where(scores["available"], scores["exposure_reduction"], -np.inf)
+    reduction[:, 0] = -np.inf
+    k = min(k, reduction.shape[1] - 1)
+    if k <= 0:
+        return np.empty((reduction.shape[0], 0), dtype=np.int64)
+
+    best = np.argpartition(-reduction, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(reduction, best, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(best, order, axis=1)
+
+def _route_path_factors(routes, options, path_names):
+    """Expand option factors to (R, O) arrays using each route's measured path variants."""
+    shape = (len(routes), len(options["path"]))
+    distance_factor = np.tile(options["distance_factor"], (shape[0], 1))
+    pm_factor = np.tile(options["pm_factor"], (shape[0], 1))
+    available = np.ones(shape, dtype=bool)
+
+    for r, route in enumerate(routes):
+        for name, variant in (route.get("paths") or {}).items():
+            columns = options["path"] == path_names.index(name)
+            if variant is None:
+                available[r, columns] = False
+                continue
+            distance_factor[r, columns] = variant["distance_km"] / route["distance_km"]
+            pm_factor[r, columns] = (options["pm_factor"][columns] / options["path_pm_factor"][columns]
+                                     * variant["avg_pm25"] / route["avg_pm25"])
+
+    return {**options, "distance_factor": distance_factor, "pm_factor": pm_factor,
+            "available": available}
+
+def optimize_routes(routes, k=3, paths=PATHS, departures=DEPARTURES, modes=MODES):
+    """
+    Score routes and build the route optimization records.
+
+    Parameters:
+    - routes (list): Dictionaries with at least 'id', 'distance_km' and 'avg_pm25';
+      an optional 'paths' entry maps path variant names to the measured
+      {'distance_km', 'avg_pm25'} of that variant (or None if the route has
+      no such variant), replacing the fixed factors of PATHS for that route
+    - k (int): Alternatives kept per route
+    - paths, departures, modes (dict): Option tables (see PATHS, DEPARTURES, MODES)
+
+    Returns:
+    - List of {'base_route', 'alternatives'} dictionaries; base routes are
+      completed with their PM10, travel time and exposure
+    """
+    if not routes:
+        return []
+
+    options = option_table(paths, departures, modes)
+    if any(route.get("paths") for route in routes):
+        options = _route_path_factors(routes, options, list(paths))
+    scores = score_options([route["distance_km"] for route in routes],
+                           [route["avg_pm25"] for route in routes], options)
+    chosen = top_alternatives(scores, k)
+
+    # Round the whole matrices once instead of per field
+    distance = np.round(scores["distance_km"], 1)
+    pm25 = scores["avg_pm25"].astype(np.int64)
+    pm10 = (scores["avg_pm25"] * PM10_RATIO).astype(np.int64)
+    minutes = scores["minutes"].astype(np.int64)
+    exposure = scores["total_exposure"].astype(np.int64)
+    reduction = exposure[:, :1] - exposure
+    percent = np.round(scores["reduction_percent"]).astype(np.int64)
+    extra = scores["extra_time_mins"]
+
+    results = []
+    for r, route in enumerate(routes):
+        base_route = {key: value for key, value in route.items() if key != "paths"}
+        base_route.setdefault("avg_pm10", round(float(route["avg_pm25"]) * PM10_RATIO, 1))
+        base_route["exposure_time_mins"] = int(minutes[r, 0])
+        base_route["total_exposure"] = int(exposure[r, 0])
+
+        alternatives = []
+        for rank, o in enumerate((o for o in chosen[r] if scores["available"][r, o]), start=1):
+            labels = options["labels"][o]
+            alternatives.append({
+                "id": f"{route['id']}_alt{rank}",
+                "name": f"Alternative {rank}: {labels[0]}" + "".join(f", {label[0].lower()}{label[1:]}" for label in labels[1:]),
+                "distance_km": float(distance[r, o]),
+                "avg_pm25": int(pm25[r, o]),
+                "avg_pm10": int(pm10[r, o]),
+                "exposure_time_mins": int(minutes[r, o]),
+                "reduction_percent": int(percent[r, o]),
+                "extra_time_mins": int(extra[r, o]),
+                "total_exposure": int(exposure[r, o]),
+                "exposure_reduction": int(reduction[r, o])
+            })
+
+        results.append({
+            "base_route": base_route,
+            "alternatives": alternatives
+        })
+    return results
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Short-term AQI forecasts from lightweight per-station models.
+Each station gets a multi-output ridge regression that maps the last 24
+hourly AQI values and the hour of day to the next 24 hourly AQI values.
+Models are trained from the measurement store on a schedule. Forecasts for
+every station come from one batched matrix product over the recent hourly
+rollups, and are cached until a new observation changes the inputs.
+
+Weather series are not stored by any source yet, so the models use
+pollutant lags and time of day only.
+
+Requirements:
+- numpy
+- pandas
+
+Install with: pip install numpy pandas
+"""
+
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from aqi import measurement_sub_indices
+
+# File holding the trained model weights
+MODEL_FILE = "air_quality_data/forecast/models.npz"
+
+# Hours of history fed to a model, and hours predicted
+LAGS = 24
+HORIZON = 24
+
+# Ridge penalty (the intercept is not penalized)
+RIDGE_ALPHA = 10.0
+
+# Training window, minimum usable samples per station, and retraining interval
+TRAIN_DAYS = 60
+MIN_SAMPLES = 72
+RETRAIN_INTERVAL = timedelta(hours=24)
+
+# Gaps of up to this many hours are forward-filled
+MAX_GAP_HOURS = 3
+
+# Parameter forecast by default
+PARAMETER = "pm25"
+
+def _hour_features(hours):
+    """Cyclic hour-of-day features for an array of hours (0-23)."""
+    angle = 2 * np.pi * np.asarray(hours, dtype=np.float64) / 24
+    return np.column_stack([np.sin(angle), np.cos(angle)])
+
+def design_matrix(windows, hours):
+    """
+    Build model inputs from lag windows.
+
+    Parameters:
+    - windows (array): (n, LAGS) hourly values, oldest first
+    - hours (array): Hour of day of the last value of every window
+
+    Returns:
+    - (n, 1 + LAGS + 2) array: intercept, lags, hour features
+    """
+    return np.column_stack([np.ones(len(windows)), windows, _hour_features(hours)])
+
+FEATURES = 1 + LAGS + 2
+
+def hourly_frame(series):
+    """Reindex a wide hourly table onto a gap-free hourly index and fill short gaps."""
+    if series.empty:
+        return series
+    index = pd.date_range(series.index.min(), series.index.max(), freq="h")
+    return series.reindex(index).ffill(limit=MAX_GAP_HOURS)
+
+def fit_station(values, hours):
+    """
+    Fit one station's multi-output ridge model.
+
+    Parameters:
+    - values (array): Gap-free hourly series (NaN where missing)
+    - hours (array): Hour of day of every value
+
+    Returns:
+    - (FEATURES, HORIZON) weight array, or None with too few samples
+    """
+    if len(values) < LAGS + HORIZON + MIN_SAMPLES:
+        return None
+    windows = sliding_window_view(values[:-HORIZON], LAGS)
+    targets = sliding_window_view(values[LAGS:], HORIZON)
+    usable = ~(np.isnan(windows).any(axis=1) | np.isnan(targets).any(axis=1))
+    if usable.sum() < MIN_SAMPLES:
+        return None
+
+    X = design_matrix(windows[usable], hours[LAGS - 1:len(values) - HORIZON][usable])
+    Y = targets[usable]
+    penalty = RIDGE_ALPHA * np.eye(FEATURES)
+    penalty[0, 0] = 0.0
+    return np.linalg.solve(X.T @ X + penalty, X.T @ Y)
+
+class ForecastEngine:
+    """Per-station ridge models with batched inference and a prediction cache."""
+
+    def __init__(self, path=MODEL_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stations = []
+        self.weights = np.zeros((0, FEATURES, HORIZON))
+        self.trained_at = None
+        self._cache = (None, None)
+        self._training = False
+        try:
+            with np.load(path) as data:
+                self.stations = data["stations"].tolist()
+                self.weights = data["weights"]
+                self.trained_at = datetime.fromtimestamp(float(data["trained_at"]), timezone.utc)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        """Atomically write the model weights to disk."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp.npz"
+        with self.lock:
+            np.savez_compressed(tmp_path, stations=np.array(self.stations, dtype=str),
+                                weights=self.weights, trained_at=self.trained_at.timestamp())
+        os.replace(tmp_path, self.path)
+
+    def train(self, series):
+        """
+        Train one model per station column.
+
+        Parameters:
+        - series (DataFrame): Hourly AQI, UTC DatetimeIndex, one column per station
+
+        Returns:
+        - Number of stations with a model
+        """
+        series = hourly_frame(series)
+        hours = series.index.hour.to_numpy() if len(series) else np.empty(0)
+        stations, weights = [], []
+        for station in series.columns:
+            fitted = fit_station(series[station].to_numpy(dtype=np.float64), hours)
+            if fitted is not None:
+                stations.append(station)
+                weights.append(fitted)
+
+        with self.lock:
+            self.stations = stations
+            self.weights = np.array(weights).reshape(len(weights), FEATURES, HORIZON)
+            self.trained_at = datetime.now(timezone.utc)
+            self._cache = (None, None)
+        self.save()
+        return len(stations)
+
+    def train_from_store(self, store, parameter=PARAMETER, days=TRAIN_DAYS):
+        """
+        Train from the last `days` days of the measurement store.
+
+        Returns:
+        - Number of stations with a model
+        """
+        start = datetime.now(timezone.utc) - timedelta(days=days)
+        measurements = store.query(parameter=parameter, start=start,
+                                   columns=["station_id", "timestamp", "unit", "value", "parameter"])
+        if measurements.empty:
+            return 0
+        measurements["aqi"] = measurement_sub_indices(measurements)
+        measurements["hour"] = pd.to_datetime(measurements["timestamp"], utc=True).dt.floor("h")
+        series = measurements.pivot_table(index="hour", columns="station_id", values="aqi", aggfunc="mean")
+        return self.train(series)
+
+    def retrain_due(self):
+        """True if the models have never been trained or are older than RETRAIN_INTERVAL."""
+        return self.trained_at is None or datetime.now(timezone.utc) - self.trained_at >= RETRAIN_INTERVAL
+
+    def retrain_if_due(self, store, parameter=PARAMETER):
+        """
+        Retrain from the store when the schedule says so.
+
+        Returns:
+        - Number of stations trained, or None if no retraining was due or one is already running
+        """
+        with self.lock:
+            if self._training or not self.retrain_due():
+                return None
+            self._training = True
+        try:
+            started = time.time()
+            trained = self.train_from_store(store, parameter)
+            print(f"Trained forecast models for {trained} stations in {time.time() - started:.2f} seconds")
+            return trained
+        finally:
+            with self.lock:
+                self._training = False
+
+    def predict(self, recent, now=None):
+        """
+        Forecast the hours ahead for every station in one batch.
+
+        The models forecast the HORIZON hours after the newest observation.
+        Steps before the current hour are dropped, so after a gap in
+        ingestion only the hours still ahead are returned, and nothing once
+        the newest observation is HORIZON or more hours old.
+
+        Parameters:
+        - recent (DataFrame): Recent hourly AQI, UTC DatetimeIndex, one
+          column per station; the last LAGS hours are used
+        - now (Timestamp, optional): Current time (default: now, UTC)
+
+        Returns:
+        - DataFrame with one row per forecast hour (UTC) from the current
+          hour on and one column per station that has a model and complete
+          recent data; results are cached until the inputs change
+        """
+        with self.lock:
+            stations, weights = list(self.stations), self.weights
+        if not stations or recent.empty:
+            return pd.DataFrame()
+
+        recent = hourly_frame(recent).reindex(columns=stations)
+        last = recent.index[-1]
+        current = (pd.Timestamp.now(tz="UTC") if now is None else pd.Timestamp(now)).floor("h")
+        if last + pd.Timedelta(hours=HORIZON) < current:
+            return pd.DataFrame()
+        windows = recent.iloc[-LAGS:].to_numpy(dtype=np.float64).T
+        if windows.shape[1] < LAGS:
+            return pd.DataFrame()
+        complete = ~np.isnan(windows).any(axis=1)
+
+        key = hashlib.sha1(windows[complete].tobytes() + str(last).encode() + str(self.trained_at).encode()).hexdigest()
+        cached_key, cached = self._cache
+        if cached_key == key:
+            return cached[cached.index >= current]
+
+        X = design_matrix(windows[complete], np.full(complete.sum(), last.hour))
+        predictions = np.einsum("sf,sfh->hs", X, weights[complete])
+        result = pd.DataFrame(np.clip(predictions, 0, None),
+                              index=pd.date_range(last + pd.Timedelta(hours=1), periods=HORIZON, freq="h"),
+                              columns=[s for s, ok in zip(stations, complete) if ok])
+        self._cache = (key, result)
+        return result[result.index >= current]
+
+    def forecast(self, rollups, station_ids=None, parameter=PARAMETER, now=None):
+        """
+        Forecast from the hourly AQI rollups.
+
+        Parameters:
+        - rollups (RollupStore): Source of the recent hourly series
+        - station_ids (iterable, optional): Stations to forecast (default: all with a model)
+        - parameter (str): Parameter whose AQI is forecast
+        - now (datetime, optional): Current time (default: now, UTC)
+
+        Returns:
+        - DataFrame as returned by predict
+        """
+        now = now or datetime.now(timezone.utc)
+        start = (now - timedelta(hours=LAGS + MAX_GAP_HOURS)).strftime("%Y-%m-%dT%H")
+        wanted = self.stations if station_ids is None else [s for s in station_ids if s in set(self.stations)]
+        if not wanted:
+            return pd.DataFrame()
+        recent = rollups.series("hour", wanted, parameter, metric="aqi", start=start)
+        if recent.empty:
+            return pd.DataFrame()
+        recent.index = pd.to_datetime(recent.index, format="%Y-%m-%dT%H", utc=True)
+        return self.predict(recent, now)
+
+# Engine shared by every caller in this process
+engine = ForecastEngine()
+
+def main():
+    import argparse
+    from rollups import rollups
+    from storage import store
+
+    parser = argparse.ArgumentParser(description="Train and run AQI forecast models")
+    parser.add_argument("--train", action="store_true", help="Retrain every station model now")
+    parser.add_argument("--days", type=int, default=TRAIN_DAYS, help="Days of history to train on")
+    args = parser.parse_args()
+
+    if args.train:
+        trained = engine.train_from_store(store, days=args.days)
+        print(f"Trained forecast models for {trained} stations")
+
+    predictions = engine.forecast(rollups)
+    if predictions.empty:
+        print("No forecasts available")
+    else:
+        print(predictions.round(0).to_string())
+
+if __name__ == "__main__":
+    main()
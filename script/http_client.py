@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP client for the air quality source fetchers.
+Keeps one pooled keep-alive session per host, applies connect/read timeouts
+to every request, takes a permit from the shared rate-limit scheduler before
+each attempt, and retries 429/5xx responses and connection errors with
+jittered exponential backoff. Every attempt's latency, status and size are
+recorded in the shared metrics registry.
+
+Requests made inside a deadline() block never outlive it: timeouts are cut
+to the time left and retries stop when their backoff would not fit. Each
+source's circuit breaker refuses requests while the provider keeps failing,
+and an attempt that is slower than the host's usual tail latency is hedged
+with a duplicate request, the first answer winning.
+
+Requirements:
+- requests
+
+Install with: pip install requests
+"""
+
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from circuit import breakers
+from metrics import current_labels, metrics
+from rate_limit import scheduler
+
+# Client configuration; adjust before the first request to change defaults
+CLIENT_CONFIG = {
+    "connect_timeout": 5,  # Seconds to establish a connection
+    "read_timeout": 10,  # Seconds to wait for response data
+    "max_retries": 3,  # Retries after the first attempt
+    "backoff_base": 0.5,  # First retry waits around this many seconds
+    "backoff_cap": 30,  # Upper bound for a single wait
+    "pool_maxsize": 10,  # Keep-alive connections kept per host
+    "retry_statuses": (429, 500, 502, 503, 504),
+    "hedge": True,  # Send a duplicate of attempts slower than the host's usual latency
+    "hedge_quantile": 0.95,  # Latency quantile after which an attempt is hedged
+    "hedge_min_samples": 20,  # Latencies seen from a host before its attempts are hedged
+    "hedge_min_delay": 0.2,  # Never hedge an attempt sooner than this many seconds
+    "hedge_workers": 16  # Threads sending hedged attempts
+}
+
+# Successful request latencies remembered per host for the hedging delay
+LATENCY_WINDOW = 200
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """The deadline of the running refresh passed before a request could complete."""
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """The source's circuit breaker is open, so the request was not sent."""
+
+# Absolute time.monotonic() deadline of the job running in the current thread or task
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+@contextmanager
+def deadline(seconds):
+    """
+    Bound every request made inside the block to finish within `seconds`.
+
+    Nested blocks can only shorten the deadline. Work run in a copy of the
+    context (asyncio tasks, run_air_quality_apis.in_worker) inherits it, as
+    it does metric labels.
+    """
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining():
+    """Seconds left before the current deadline, or None outside a deadline() block."""
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+def check_deadline(step="continuing"):
+    """
+    Stop a job between steps once its deadline has passed.
+
+    Requests are cut short by the deadline on their own; jobs call this
+    before work that makes no request (parsing, storing, the next chunk).
+
+    Raises:
+    - DeadlineExceeded if the current deadline has passed
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline passed before {step}")
+
+# One session per host so every host gets its own connection pool
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(host):
+    """
+    Return the shared session for a host, creating it on first use.
+
+    Parameters:
+    - host (str): Host name (netloc) the session talks to
+
+    Returns:
+    - requests.Session with a keep-alive connection pool
+    """
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            # Retries are handled in get() so backoff can honour Retry-After
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=CLIENT_CONFIG["pool_maxsize"],
+                max_retries=0
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return session
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header into seconds.
+
+    Parameters:
+    - value (str): Header value, either delta-seconds or an HTTP date
+
+    Returns:
+    - Number of seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Compute how long to wait before the next attempt.
+
+    Parameters:
+    - attempt (int): Zero-based index of the attempt that just failed
+    - retry_after (float, optional): Server-requested wait in seconds
+
+    Returns:
+    - Delay in seconds
+    """
+    if retry_after is not None:
+        return min(retry_after, CLIENT_CONFIG["backoff_cap"])
+    delay = min(CLIENT_CONFIG["backoff_base"] * (2 ** attempt), CLIENT_CONFIG["backoff_cap"])
+    # Jitter keeps parallel workers from retrying in lockstep
+    return delay * random.uniform(0.5, 1.5)
+
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+def record_latency(host, seconds):
+    """Remember the latency of a successful request to a host."""
+    with _latencies_lock:
+        window = _latencies.get(host)
+        if window is None:
+            window = _latencies[host] = deque(maxlen=LATENCY_WINDOW)
+        window.append(seconds)
+
+def hedge_delay(host):
+    """
+    Seconds after which an attempt to a host gets a hedged duplicate.
+
+    Returns:
+    - The host's CLIENT_CONFIG["hedge_quantile"] latency (at least
+      hedge_min_delay), or None if hedging is off or too few latencies are known
+    """
+    if not CLIENT_CONFIG["hedge"]:
+        return None
+    with _latencies_lock:
+        samples = sorted(_latencies.get(host, ()))
+    if len(samples) < CLIENT_CONFIG["hedge_min_samples"]:
+        return None
+    index = min(int(len(samples) * CLIENT_CONFIG["hedge_quantile"]), len(samples) - 1)
+    return max(samples[index], CLIENT_CONFIG["hedge_min_delay"])
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+def _get_hedge_pool():
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=CLIENT_CONFIG["hedge_workers"],
+                                             thread_name_prefix="hedge")
+        return _hedge_pool
+
+def _close_when_done(future):
+    """Close the response of an attempt that lost the race once it arrives."""
+    def close(f):
+        if not f.cancelled() and f.exception() is None:
+            f.result().close()
+    future.add_done_callback(close)
+
+def send(session, host, url, source, **kwargs):
+    """
+    Send one attempt, hedged when it is slower than the host's usual latency.
+
+    Hedges are only sent while the host's rate limit has a permit to spare
+    and the deadline leaves room for them, so they never cost quota the
+    regular attempts need.
+
+    Parameters:
+    - session (requests.Session): Session of the host
+    - host (str): Host name, for the latency history and rate limit
+    - url (str): Request URL
+    - source (dict): Extra metric labels of the request
+    - **kwargs: Passed to session.get
+
+    Returns:
+    - requests.Response of whichever copy answered first
+
+    Raises:
+    - requests.exceptions.RequestException if every copy failed
+    """
+    delay = hedge_delay(host)
+    left = remaining()
+    if delay is None or (left is not None and delay >= left):
+        return session.get(url, **kwargs)
+
+    pool = _get_hedge_pool()
+    first = pool.submit(session.get, url, **kwargs)
+    done, _ = wait([first], timeout=delay)
+    if done or not scheduler.acquire(host, timeout=0):
+        return first.result()
+
+    metrics.increment("air_quality_hedged_requests_total", result="sent", **source)
+    hedge = pool.submit(session.get, url, **kwargs)
+    pending = {first, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    _close_when_done(other)
+                if future is hedge:
+                    metrics.increment("air_quality_hedged_requests_total", result="won", **source)
+                return future.result()
+            error = future.exception()
+    raise error
+
+def get(url, params=None, headers=None, timeout=None, max_retries=None):
+    """
+    Send a GET request through the shared pooled session for its host.
+
+    Parameters:
+    - url (str): Request URL
+    - params (dict, optional): Query string parameters
+    - headers (dict, optional): Extra request headers
+    - timeout (tuple, optional): (connect, read) timeout in seconds
+    - max_retries (int, optional): Override CLIENT_CONFIG["max_retries"]
+
+    Returns:
+    - requests.Response of the last attempt; callers still check the status
+
+    Raises:
+    - CircuitOpen if the source's circuit breaker refuses the request
+    - DeadlineExceeded if the deadline passes before an attempt can be sent
+    - requests.exceptions.RequestException once connection errors or
+      timeouts persist past the last retry
+    """
+    if timeout is None:
+        timeout = (CLIENT_CONFIG["connect_timeout"], CLIENT_CONFIG["read_timeout"])
+    if max_retries is None:
+        max_retries = CLIENT_CONFIG["max_retries"]
+
+    host = urlparse(url).netloc
+    session = get_session(host)
+    job_labels = current_labels()
+    # Requests outside a labelled job are attributed to their host
+    source = {} if "source" in job_labels else {"source": host}
+    breaker_name = job_labels.get("source", host)
+    breaker = breakers.get(breaker_name)
+    if not breaker.allow():
+        metrics.increment("air_quality_circuit_rejections_total", **source)
+        raise CircuitOpen(f"Circuit breaker of {breaker_name} is open, not requesting {host}")
+
+    def fits(delay):
+        left = remaining()
+        return left is None or delay < left
+
+    with metrics.span("fetch", **source):
+        for attempt in range(max_retries + 1):
+            if attempt:
+                metrics.increment("air_quality_retries_total", **source)
+            left = remaining()
+            if left is None:
+                scheduler.acquire(host)
+            elif left <= 0 or not scheduler.acquire(host, timeout=left):
+                breaker.release()
+                raise DeadlineExceeded(f"Deadline passed before requesting {host}")
+            left = remaining()
+            attempt_timeout = timeout if left is None else tuple(min(t, max(left, 0.001)) for t in timeout)
+            started = time.perf_counter()
+            try:
+                response = send(session, host, url, source, params=params, headers=headers,
+                                timeout=attempt_timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                metrics.observe("air_quality_request_seconds", time.perf_counter() - started, **source)
+                metrics.increment("air_quality_requests_total", status="error", **source)
+                delay = backoff_delay(attempt)
+                if attempt == max_retries or not fits(delay):
+                    if fits(0):
+                        breaker.record_failure()
+                    else:
+                        # Cut short by the deadline, which says nothing about the provider
+                        breaker.release()
+                    raise
+                time.sleep(delay)
+                continue
+
+            elapsed = time.perf_counter() - started
+            metrics.observe("air_quality_request_seconds", elapsed, **source)
+            metrics.increment("air_quality_requests_total", status=str(response.status_code), **source)
+            metrics.increment("air_quality_request_bytes_total", len(response.content), **source)
+
+            if response.status_code == 429:
+                # Pause the whole host; the next acquire() waits out the delay
+                scheduler.throttle(host, backoff_delay(attempt, parse_retry_after(response.headers.get("Retry-After"))))
+            elif response.status_code < 400:
+                scheduler.record_success(host)
+
+            if response.status_code in CLIENT_CONFIG["retry_statuses"] and attempt < max_retries:
+                delay = 0.0 if response.status_code == 429 else backoff_delay(attempt)
+                if fits(delay):
+                    time.sleep(delay)
+                    response.close()
+                    continue
+
+            if response.status_code >= 500:
+                breaker.record_failure()
+            elif response.status_code == 429:
+                breaker.release()
+            else:
+                breaker.record_success()
+                record_latency(host, elapsed)
+            return response
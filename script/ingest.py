@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Single entry point for storing a batch of new measurements.
+Drops readings another source already holds for the same site, appends the
+rest to the measurement store and, when rows were written, folds them into
+the station index, the rollups and the weather/pollutant correlation
+statistics, so every fetcher keeps the derived data in step. Stored
+readings that the new batch supersedes are then deleted and taken back out
+of the rollups and correlations, so nothing is counted twice.
+
+Requirements:
+- pandas
+- pyarrow
+- numpy
+
+Install with: pip install pandas pyarrow numpy
+"""
+
+import pandas as pd
+
+from correlations import correlations
+from merge import merges
+from metrics import metrics
+from rollups import rollups
+from spatial import stations
+from storage import store
+
+def ingest(measurements):
+    """
+    Store a batch of measurements and update everything derived from it.
+    
+    Parameters:
+    - measurements (DataFrame): Canonical measurement columns, already
+      filtered against the watermarks
+    
+    Returns:
+    - Number of rows written
+    """
+    with metrics.span("merge"):
+        measurements = merges.merge(measurements)
+    with metrics.span("write"):
+        rows = store.append(measurements)
+    if rows:
+        metrics.increment("air_quality_rows_written_total", rows)
+        with metrics.span("index"):
+            stations.add_measurements(measurements)
+            rollups.update(measurements)
+            correlations.update(measurements)
+        if merges.superseded:
+            with metrics.span("purge"):
+                purge_superseded()
+        merges.save()
+    return rows
+
+def purge_superseded():
+    """
+    Delete the stored readings superseded by a more trusted source.
+    
+    Their contribution is subtracted from the rollups, and the
+    weather/pollutant pairs of their station-hours are recomputed.
+    
+    Returns:
+    - Number of rows removed
+    """
+    removed = merges.purge(store)
+    if removed.empty:
+        return 0
+    rollups.remove(removed)
+    
+    hours = pd.to_datetime(removed["timestamp"], utc=True).dt.floor("h")
+    remaining = store.query(station_id=removed["station_id"].unique().tolist(),
+                            start=hours.min(), end=hours.max() + pd.Timedelta(hours=1))
+    if not remaining.empty:
+        wanted = set(zip(removed["station_id"], hours))
+        remaining_hours = pd.to_datetime(remaining["timestamp"], utc=True).dt.floor("h")
+        remaining = remaining[[key in wanted for key in zip(remaining["station_id"], remaining_hours)]]
+    correlations.revise(removed, remaining)
+    
+    metrics.increment("air_quality_duplicates_purged_total", len(removed))
+    return len(removed)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Cross-source merge of new measurements before they are stored.
+A single monitor is often reported by several providers at once: AirNow
+and OpenAQ both carry EPA monitors, and WAQI republishes many of them.
+Every station is resolved to a site the first time it is seen: a station
+of another source within MATCH_RADIUS_KM, or within NAME_MATCH_RADIUS_KM
+with a matching name, belongs to that station's site. A hash index on
+(site, parameter, kind, time bucket) records which source holds every
+stored reading, where AQI-unit readings are a kind of their own, so a reading already held by a more trusted source is dropped,
+and one from a more trusted source supersedes the stored reading.
+Superseded rows are removed from the store by purge(), which ingest runs
+as soon as a batch supersedes anything.
+
+Requirements:
+- numpy
+- pandas
+
+Install with: pip install numpy pandas
+"""
+
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from metrics import metrics
+from spatial import stations
+
+# File holding the station sites and the reading index
+MERGE_FILE = "air_quality_data/merge_index.npz"
+
+# Sources from most to least trusted; unlisted sources rank last
+SOURCE_PRIORITY = ("epa", "airnow", "openaq", "waqi")
+
+# Stations of different sources this close together are the same site
+MATCH_RADIUS_KM = 0.3
+
+# Up to this distance, stations whose names share a word are the same site
+NAME_MATCH_RADIUS_KM = 2.0
+
+# Readings of one site, parameter and kind in the same bucket are duplicates
+BUCKET_MINUTES = 60
+
+# Unit of readings that report an AQI instead of a concentration; they only
+# compete with other AQI readings, never with concentrations
+AQI_UNIT = "AQI"
+
+# Readings older than this are dropped from the index
+RETENTION_DAYS = 14
+
+# New index entries are merged into the sorted arrays once this many are pending
+MERGE_THRESHOLD = 65536
+
+# Words too common in station names to identify a site
+_GENERIC_WORDS = {"station", "site", "monitor", "air", "quality", "aqi", "the", "and", "road", "street"}
+
+def name_words(name):
+    """Distinctive lower-case words of a station name."""
+    if not isinstance(name, str):
+        return set()
+    return {w for w in re.split(r"[^a-z0-9]+", name.lower()) if len(w) >= 3 and w not in _GENERIC_WORDS}
+
+def source_rank(source):
+    """Position of a source in SOURCE_PRIORITY (lower is more trusted)."""
+    try:
+        return SOURCE_PRIORITY.index(source)
+    except ValueError:
+        return len(SOURCE_PRIORITY)
+
+def bucket_numbers(timestamps, minutes=BUCKET_MINUTES):
+    """Number of the time bucket every UTC timestamp falls in (-1 where missing)."""
+    utc = pd.to_datetime(timestamps, utc=True)
+    numbers = (utc - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(minutes=minutes)
+    return numbers.fillna(-1).to_numpy(dtype=np.int64)
+
+class MergeIndex:
+    """
+    Site of every station and the source holding every recent reading.
+
+    Readings are keyed by an int64 of (series number << 32 | bucket), where a
+    series is one site, parameter and kind (concentration or AQI). Keys live in sorted arrays searched in
+    bulk; keys added since the last merge are kept in a pending dictionary.
+    """
+
+    def __init__(self, path=MERGE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sites = {}
+        self.series = {}
+        self.holders = []
+        self.holder_index = {}
+        self.keys = np.empty(0, dtype=np.int64)
+        self.ranks = np.empty(0, dtype=np.int8)
+        self.stations = np.empty(0, dtype=np.int32)
+        self.pending = {}
+        self.superseded = []
+        try:
+            with np.load(path) as data:
+                self.sites = dict(zip(data["site_stations"].tolist(), data["site_ids"].tolist()))
+                self.series = {name: i for i, name in enumerate(data["series"].tolist())}
+                self.holders = data["holders"].tolist()
+                self.keys, self.ranks, self.stations = data["keys"], data["ranks"], data["stations"]
+                self.pending = {key: (rank, holder) for key, rank, holder in data["pending"].tolist()}
+                self.superseded = [(station, source, parameter, int(bucket)) for station, source, parameter, bucket
+                                   in zip(*(data[f"superseded_{c}"].tolist()
+                                            for c in ("station", "source", "parameter", "bucket")))]
+        except (OSError, ValueError, KeyError):
+            pass
+        self.holder_index = {station_id: i for i, station_id in enumerate(self.holders)}
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+
+    def save(self):
+        """Atomically write the sites and the reading index to disk."""
+        with self.lock:
+            superseded = list(zip(*self.superseded)) or [(), (), (), ()]
+            pending = np.array([(key, rank, holder) for key, (rank, holder) in self.pending.items()],
+                               dtype=np.int64).reshape(-1, 3)
+            arrays = {
+                "site_stations": np.array(list(self.sites), dtype=str),
+                "site_ids": np.array(list(self.sites.values()), dtype=str),
+                "series": np.array(list(self.series), dtype=str),
+                "holders": np.array(self.holders, dtype=str),
+                "keys": self.keys, "ranks": self.ranks, "stations": self.stations, "pending": pending,
+                "superseded_station": np.array(superseded[0], dtype=str),
+                "superseded_source": np.array(superseded[1], dtype=str),
+                "superseded_parameter": np.array(superseded[2], dtype=str),
+                "superseded_bucket": np.array(superseded[3], dtype=np.int64)
+            }
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path)
+
+    def resolve(self, station):
+        """
+        Find the site of a station not seen before (caller holds the lock).
+
+        Parameters:
+        - station (dict): station_id, station_name, latitude, longitude, source
+
+        Returns:
+        - Site id: the site of a matching station of another source, or the
+          station's own id
+        """
+        lat, lon = station.get("latitude"), station.get("longitude")
+        if lat is None or lon is None or pd.isna(lat) or pd.isna(lon):
+            return station["station_id"]
+        words = name_words(station.get("station_name"))
+        for other in stations.within(float(lat), float(lon), NAME_MATCH_RADIUS_KM):
+            if other["source"] == station.get("source") or other["station_id"] == station["station_id"]:
+                continue
+            if other["distance_km"] <= MATCH_RADIUS_KM or words & name_words(other.get("station_name")):
+                return self.sites.get(other["station_id"], other["station_id"])
+        return station["station_id"]
+
+    def site_ids(self, measurements):
+        """Site of every row, resolving stations seen for the first time (caller holds the lock)."""
+        new = measurements[~measurements["station_id"].isin(self.sites)]
+        if not new.empty:
+            columns = ["station_id", "station_name", "latitude", "longitude", "source"]
+            for station in new[columns].drop_duplicates("station_id").to_dict("records"):
+                self.sites[station["station_id"]] = self.resolve(station)
+        return measurements["station_id"].map(self.sites)
+
+    def _series_numbers(self, names):
+        codes, unique = pd.factorize(names)
+        numbers = np.empty(len(unique), dtype=np.int64)
+        for i, name in enumerate(unique.tolist()):
+            number = self.series.get(name)
+            if number is None:
+                number = self.series[name] = len(self.series)
+            numbers[i] = number
+        return numbers[codes]
+
+    def _holder_numbers(self, station_ids):
+        codes, unique = pd.factorize(station_ids)
+        numbers = np.empty(len(unique), dtype=np.int32)
+        for i, station_id in enumerate(unique.tolist()):
+            number = self.holder_index.get(station_id)
+            if number is None:
+                number = self.holder_index[station_id] = len(self.holders)
+                self.holders.append(station_id)
+            numbers[i] = number
+        return numbers[codes]
+
+    def _lookup(self, keys):
+        """Rank and holder of stored keys (-1 where unknown)."""
+        ranks = np.full(len(keys), -1, dtype=np.int64)
+        holders = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.keys):
+            pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = self.keys[pos] == keys
+            ranks[found] = self.ranks[pos[found]]
+            holders[found] = self.stations[pos[found]]
+        if self.pending:
+            for i, key in enumerate(keys.tolist()):
+                entry = self.pending.get(key)
+                if entry is not None:
+                    ranks[i], holders[i] = entry
+        return ranks, holders
+
+    def _store(self, keys, ranks, holders):
+        """Record the holder of keys, overwriting stored entries in place."""
+        if len(self.keys):
+            pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = self.keys[pos] == keys
+            self.ranks[pos[found]] = ranks[found]
+            self.stations[pos[found]] = holders[found]
+            keys, ranks, holders = keys[~found], ranks[~found], holders[~found]
+        self.pending.update(zip(keys.tolist(), zip(ranks.tolist(), holders.tolist())))
+        if len(self.pending) >= MERGE_THRESHOLD:
+            self._merge()
+
+    def _merge(self):
+        """Fold pending keys into the sorted arrays and drop expired ones (caller holds the lock)."""
+        cutoff = (pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=RETENTION_DAYS) - pd.Timestamp(0, tz="UTC")) \
+            // pd.Timedelta(minutes=BUCKET_MINUTES)
+        keys, ranks, stations_ = self.keys, self.ranks, self.stations
+        if self.pending:
+            pending_keys = np.fromiter(self.pending, dtype=np.int64, count=len(self.pending))
+            entries = np.array(list(self.pending.values()), dtype=np.int64).reshape(-1, 2)
+            keys = np.concatenate([keys, pending_keys])
+            ranks = np.concatenate([ranks, entries[:, 0].astype(np.int8)])
+            stations_ = np.concatenate([stations_, entries[:, 1].astype(np.int32)])
+            self.pending = {}
+        keep = (keys & 0xFFFFFFFF) >= cutoff
+        order = np.argsort(keys[keep], kind="stable")
+        self.keys, self.ranks, self.stations = keys[keep][order], ranks[keep][order], stations_[keep][order]
+
+    def merge(self, measurements):
+        """
+        Drop readings already held by a more trusted source and claim the rest.
+
+        Within the batch, only the most trusted source's readings of a site,
+        parameter, kind and bucket are kept; an AQI reading never displaces
+        a concentration, or the other way round. Readings of the same source are never
+        duplicates of each other, since the watermarks already skip repeats.
+        A kept reading that beats the stored one is recorded for purge().
+
+        Parameters:
+        - measurements (DataFrame): Canonical measurement columns
+
+        Returns:
+        - DataFrame of the rows to store
+        """
+        if measurements is None or measurements.empty:
+            return measurements
+
+        with self.lock:
+            sites = self.site_ids(measurements).fillna(measurements["station_id"])
+            kinds = np.where(measurements["unit"].to_numpy() == AQI_UNIT, "|aqi", "")
+            series = self._series_numbers((sites + "|" + measurements["parameter"].astype(str) + kinds).to_numpy())
+            buckets = bucket_numbers(measurements["timestamp"])
+            keys = (series << 32) | (buckets & 0xFFFFFFFF)
+            sources = measurements["source"].astype(object)
+            ranks = sources.map({source: source_rank(source) for source in sources.unique()}).to_numpy(dtype=np.int64)
+
+            best = pd.Series(ranks).groupby(keys).transform("min").to_numpy()
+            held_ranks, held_by = self._lookup(keys)
+            # Rows without a timestamp are left for the store to reject
+            timed = buckets >= 0
+            keep = ~timed | ((ranks == best) & ((held_ranks < 0) | (held_ranks >= ranks)))
+
+            beaten = keep & timed & (held_ranks > ranks)
+            if beaten.any():
+                parameters = measurements["parameter"].to_numpy()
+                seen = set()
+                for i in np.flatnonzero(beaten).tolist():
+                    key, held = int(keys[i]), int(held_ranks[i])
+                    if key in seen or held >= len(SOURCE_PRIORITY):
+                        continue
+                    seen.add(key)
+                    self.superseded.append((self.holders[held_by[i]], SOURCE_PRIORITY[held],
+                                            parameters[i], key & 0xFFFFFFFF))
+
+            claim = keep & timed
+            holders = self._holder_numbers(measurements["station_id"].to_numpy()[claim])
+            self._store(keys[claim], ranks[claim], holders)
+
+        dropped = int((~keep).sum())
+        if dropped:
+            metrics.increment("air_quality_duplicates_dropped_total", dropped)
+        return measurements[keep]
+
+    def purge(self, store):
+        """
+        Remove superseded readings from the measurement store.
+
+        Parameters:
+        - store (MeasurementStore): Store holding the readings
+
+        Returns:
+        - DataFrame of the removed rows
+        """
+        with self.lock:
+            superseded, self.superseded = self.superseded, []
+        groups = {}
+        bucket = pd.Timedelta(minutes=BUCKET_MINUTES)
+        for station_id, source, parameter, number in superseded:
+            start = pd.Timestamp(0, tz="UTC") + number * bucket
+            groups.setdefault((source, parameter), []).append((station_id, start, start + bucket))
+        removed = [store.delete(source, parameter, ranges) for (source, parameter), ranges in groups.items()]
+        self.save()
+        if not removed:
+            return pd.DataFrame()
+        return pd.concat(removed, ignore_index=True)
+
+# Index shared by every fetcher in this process
+merges = MergeIndex()
+
+def main():
+    import argparse
+    from ingest import purge_superseded
+
+    parser = argparse.ArgumentParser(description="Cross-source station sites and duplicate readings")
+    parser.add_argument("--purge", action="store_true",
+                        help="Remove superseded readings left by an interrupted ingest")
+    args = parser.parse_args()
+
+    if args.purge:
+        removed = purge_superseded()
+        print(f"Removed {removed} superseded readings from the store, rollups and correlations")
+
+    shared = {}
+    for station_id, site in merges.sites.items():
+        if station_id != site:
+            shared.setdefault(site, []).append(station_id)
+    print(f"{len(merges.sites)} stations, {len(shared)} sites reported by more than one source")
+    for site, aliases in sorted(shared.items()):
+        print(f"  {site}: {', '.join(sorted(aliases))}")
+    print(f"{len(merges)} readings indexed, {len(merges.superseded)} waiting to be purged")
+
+if __name__ == "__main__":
+    main()
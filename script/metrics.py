@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+In-process metrics for the air quality pipeline.
+Counters and latency histograms are kept per label set and exported in the
+Prometheus text format, either as a file for a textfile collector or from
+the data service's /metrics endpoint, and summarized for metadata.json.
+
+Stage spans (fetch, parse, normalize, merge, write, build) and HTTP requests pick
+up the source and location labels of the job they run in, so callers only
+label a job once and every request and stage inside it is attributed.
+
+No external packages are required.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# Labels of the job running in the current thread or task
+_labels = contextvars.ContextVar("metric_labels", default={})
+
+# Help text of every metric, also the list of names rendered
+DESCRIPTIONS = {
+    "air_quality_stage_seconds": ("histogram", "Time spent in each pipeline stage"),
+    "air_quality_request_seconds": ("histogram", "Latency of HTTP requests to the data providers"),
+    "air_quality_requests_total": ("counter", "HTTP requests to the data providers by status"),
+    "air_quality_request_bytes_total": ("counter", "Response bytes received from the data providers"),
+    "air_quality_retries_total": ("counter", "HTTP request retries after errors or throttling"),
+    "air_quality_hedged_requests_total": ("counter", "Duplicate requests sent for slow attempts, and how many answered first"),
+    "air_quality_circuit_rejections_total": ("counter", "Requests refused because the source's circuit breaker was open"),
+    "air_quality_responses_total": ("counter", "Provider responses by whether their content changed"),
+    "air_quality_rows_written_total": ("counter", "Measurement rows written to the store"),
+    "air_quality_duplicates_dropped_total": ("counter", "Readings dropped as duplicates of another source's"),
+    "air_quality_duplicates_purged_total": ("counter", "Stored readings deleted after a more trusted source reported them"),
+    "air_quality_cache_requests_total": ("counter", "Dataset cache lookups by status")
+}
+
+@contextmanager
+def labels(**values):
+    """Attach labels (e.g. source, location) to every metric recorded inside the block."""
+    token = _labels.set({**_labels.get(), **{k: str(v) for k, v in values.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+def current_labels():
+    """Labels of the job running in the current context."""
+    return dict(_labels.get())
+
+def _quantile(buckets, counts, q):
+    """Estimate a quantile from cumulative histogram counts (as Prometheus does)."""
+    total = counts[-1]
+    if total == 0:
+        return None
+    rank = q * total
+    for i, cumulative in enumerate(counts):
+        if cumulative >= rank:
+            upper = buckets[i]
+            lower = buckets[i - 1] if i else 0.0
+            if upper == float("inf"):
+                return lower
+            below = counts[i - 1] if i else 0
+            inside = cumulative - below
+            return lower + (upper - lower) * ((rank - below) / inside if inside else 1.0)
+    return None
+
+class Registry:
+    """Thread-safe counters and histograms keyed by name and label set."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.now()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1, **extra):
+        """Add to a counter, labelled with the current job labels plus extra."""
+        key = (name, tuple(sorted({**_labels.get(), **extra}.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **extra):
+        """Record a value in a histogram, labelled like increment."""
+        key = (name, tuple(sorted({**_labels.get(), **extra}.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"counts": [0] * len(LATENCY_BUCKETS), "sum": 0.0}
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+
+    @contextmanager
+    def span(self, stage, **extra):
+        """Time a pipeline stage into air_quality_stage_seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("air_quality_stage_seconds", time.perf_counter() - start, stage=stage, **extra)
+
+    def reset(self):
+        """Forget every recorded value."""
+        with self.lock:
+            self.started = datetime.now()
+            self.counters = {}
+            self.histograms = {}
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+        - str
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: {"counts": list(h["counts"]), "sum": h["sum"]} for key, h in self.histograms.items()}
+
+        def label_text(pairs, extra=()):
+            pairs = list(pairs) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        lines = []
+        for name, (kind, description) in DESCRIPTIONS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (metric, pairs), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{label_text(pairs)} {value}")
+                continue
+            for (metric, pairs), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, histogram["counts"]):
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{label_text(pairs, [('le', le)])} {count}")
+                lines.append(f"{name}_sum{label_text(pairs)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{label_text(pairs)} {histogram['counts'][-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Atomically write the Prometheus text rendering to a file."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """
+        Summarize the metrics for metadata.json.
+
+        Returns:
+        - Dictionary with per-stage time, per-source and per-location request
+          figures (count, errors, retries, bytes, p50/p95 latency), hedged
+          requests, circuit breaker rejections and cache hit ratios
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: {"counts": list(h["counts"]), "sum": h["sum"]} for key, h in self.histograms.items()}
+
+        def merged(name, group_by):
+            groups = {}
+            for (metric, pairs), histogram in histograms.items():
+                if metric != name:
+                    continue
+                labels_ = dict(pairs)
+                group = groups.setdefault(tuple(labels_.get(k, "") for k in group_by),
+                                          {"counts": [0] * len(LATENCY_BUCKETS), "sum": 0.0})
+                group["counts"] = [a + b for a, b in zip(group["counts"], histogram["counts"])]
+                group["sum"] += histogram["sum"]
+            return groups
+
+        def counter_total(name, match):
+            return sum(value for (metric, pairs), value in counters.items()
+                       if metric == name and all(dict(pairs).get(k) == v for k, v in match.items()))
+
+        stages = {}
+        for (stage, source), h in sorted(merged("air_quality_stage_seconds", ("stage", "source")).items()):
+            entry = stages.setdefault(stage, {"seconds": 0.0, "count": 0, "by_source": {}})
+            entry["seconds"] = round(entry["seconds"] + h["sum"], 4)
+            entry["count"] += h["counts"][-1]
+            entry["by_source"][source or "unlabelled"] = round(h["sum"], 4)
+
+        sources = {}
+        for (source, location), h in sorted(merged("air_quality_request_seconds", ("source", "location")).items()):
+            source = source or "unlabelled"
+            match = {"source": source if source != "unlabelled" else None}
+            if location:
+                match["location"] = location
+            figures = {
+                "requests": h["counts"][-1],
+                "seconds": round(h["sum"], 4),
+                "p50_seconds": _round(_quantile(LATENCY_BUCKETS, h["counts"], 0.5)),
+                "p95_seconds": _round(_quantile(LATENCY_BUCKETS, h["counts"], 0.95)),
+                "bytes": counter_total("air_quality_request_bytes_total", match),
+                "retries": counter_total("air_quality_retries_total", match),
+                "errors": counter_total("air_quality_requests_total", {**match, "status": "error"})
+            }
+            entry = sources.setdefault(source, {"requests": 0, "seconds": 0.0, "bytes": 0, "retries": 0,
+                                                "errors": 0, "locations": {}})
+            for field in ("requests", "bytes", "retries", "errors"):
+                entry[field] += figures[field]
+            entry["seconds"] = round(entry["seconds"] + figures["seconds"], 4)
+            if location:
+                entry["locations"][location] = figures
+        for (source,), h in merged("air_quality_request_seconds", ("source",)).items():
+            sources[source or "unlabelled"]["p50_seconds"] = _round(_quantile(LATENCY_BUCKETS, h["counts"], 0.5))
+            sources[source or "unlabelled"]["p95_seconds"] = _round(_quantile(LATENCY_BUCKETS, h["counts"], 0.95))
+
+        responses = {}
+        for (metric, pairs), value in counters.items():
+            if metric == "air_quality_responses_total":
+                labels_ = dict(pairs)
+                entry = responses.setdefault(labels_.get("source", "unlabelled"), {"changed": 0, "unchanged": 0})
+                entry[labels_.get("result", "changed")] += value
+        for source, entry in responses.items():
+            total = entry["changed"] + entry["unchanged"]
+            sources.setdefault(source, {})["unchanged_ratio"] = round(entry["unchanged"] / total, 3) if total else None
+
+        cache = {}
+        for (metric, pairs), value in counters.items():
+            if metric == "air_quality_cache_requests_total":
+                status = dict(pairs).get("status", "miss")
+                cache[status] = cache.get(status, 0) + value
+        lookups = sum(cache.values())
+
+        return {
+            "since": self.started.isoformat(),
+            "stages": stages,
+            "sources": sources,
+            "rows_written": counter_total("air_quality_rows_written_total", {}),
+            "duplicates_dropped": counter_total("air_quality_duplicates_dropped_total", {}),
+            "duplicates_purged": counter_total("air_quality_duplicates_purged_total", {}),
+            "hedged_requests": {result: counter_total("air_quality_hedged_requests_total", {"result": result})
+                                for result in ("sent", "won")},
+            "circuit_rejections": counter_total("air_quality_circuit_rejections_total", {}),
+            "cache": {**cache, "hit_ratio": round(cache.get("hit", 0) / lookups, 3) if lookups else None}
+        }
+
+def _round(value):
+    return None if value is None else round(value, 4)
+
+# Registry shared by every fetcher in this process
+metrics = Registry()
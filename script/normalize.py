@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Schema-driven normalization of provider responses into measurement columns.
+Every source declares one Schema that says where each canonical column
+comes from in its raw JSON records. The key paths a schema reads are
+pulled out of all records in C-level passes, and the columns are then
+converted in bulk into typed arrays: float64 coordinates, float32
+values, millisecond UTC timestamps (int64 underneath) and Arrow-backed
+strings. No intermediate json_normalize frame with object columns is built.
+
+Responses of POOL_MIN_BYTES or more are decoded and normalized in a shared
+process pool, so a large page does not hold the GIL while other fetchers
+are waiting on the network.
+
+Requirements:
+- numpy
+- pandas
+- pyarrow
+
+Install with: pip install numpy pandas pyarrow
+
+NumPy and pandas are imported on first use, so the fetchers can declare
+their schemas without paying for them at startup.
+"""
+
+import json
+import os
+import threading
+from operator import itemgetter
+
+from metrics import metrics
+
+# Canonical measurement columns, in storage order
+COLUMNS = ("station_id", "station_name", "latitude", "longitude", "unit",
+           "timestamp", "value", "aqi", "source", "parameter")
+
+# Numeric column types after normalization
+FLOAT_COLUMNS = {"latitude": "float64", "longitude": "float64",
+                 "value": "float32", "aqi": "float32"}
+
+# Response bodies at least this large are normalized in the process pool
+POOL_MIN_BYTES = 4 * 1024 * 1024
+
+# Worker processes in the pool
+POOL_WORKERS = min(4, os.cpu_count() or 1)
+
+def field(*path):
+    """Spec for a (possibly nested) key of a record; missing keys give None."""
+    return ("field", path)
+
+def const(value):
+    """Spec for the same value in every row."""
+    return ("const", value)
+
+def join(*parts):
+    """Spec concatenating specs and literal strings, e.g. join("aqs:", field("site")); null if any part is."""
+    return ("join", parts)
+
+def lookup(mapping, spec, default=None):
+    """Spec mapping a value through a dictionary; unmapped values give the default spec (or None)."""
+    return ("lookup", mapping, spec, default if default is not None else const(None))
+
+def upper(spec):
+    """Spec upper-casing a string value."""
+    return ("upper", spec)
+
+def strip(spec):
+    """Spec stripping whitespace around a string value."""
+    return ("strip", spec)
+
+def _missing(value):
+    return value is None or value != value
+
+def _join(*values):
+    try:
+        return "".join(values)
+    except TypeError:
+        if any(_missing(value) for value in values):
+            return None
+        return "".join(value if isinstance(value, str) else str(value) for value in values)
+
+def _upper(value):
+    return value.upper() if isinstance(value, str) else value
+
+def _strip(value):
+    return value.strip() if isinstance(value, str) else value
+
+def _leaf_paths(spec):
+    """Key paths a spec reads from each record."""
+    kind = spec[0]
+    if kind == "field":
+        return [spec[1]]
+    if kind == "join":
+        return [path for part in spec[1] if not isinstance(part, str) for path in _leaf_paths(part)]
+    if kind == "lookup":
+        return _leaf_paths(spec[2]) + _leaf_paths(spec[3])
+    if kind in ("upper", "strip"):
+        return _leaf_paths(spec[1])
+    return []
+
+def _pull(records, key):
+    """Column of one key's values across a list of dictionaries."""
+    try:
+        return list(map(itemgetter(key), records))
+    except (KeyError, TypeError):
+        # Some records lack the key (or are not dictionaries); take the slow path
+        return [r.get(key) if isinstance(r, dict) else None for r in records]
+
+def extract(records, paths):
+    """
+    Pull the values at several key paths out of every record.
+
+    Every key is read with one C-level itemgetter pass over the records,
+    falling back to dict.get when a key is missing.
+
+    Parameters:
+    - records (list): Record dictionaries
+    - paths (iterable): Key path tuples, e.g. ("coordinates", "latitude")
+
+    Returns:
+    - Dictionary of key path -> sequence of values (None where missing)
+    """
+    paths = list(dict.fromkeys(paths))
+    firsts = list(dict.fromkeys(path[0] for path in paths))
+    if not firsts:
+        return {}
+    columns = {first: _pull(records, first) for first in firsts}
+    result = {}
+    for first in firsts:
+        nested = [path[1:] for path in paths if path[0] == first and len(path) > 1]
+        if nested:
+            for path, values in extract(columns[first], nested).items():
+                result[(first,) + path] = values
+        if (first,) in paths:
+            result[(first,)] = columns[first]
+    return result
+
+def _factorize(values):
+    """Codes and distinct values (nulls included) of a column."""
+    import numpy as np
+    import pandas as pd
+
+    try:
+        index = {value: i for i, value in enumerate(dict.fromkeys(values))}
+    except TypeError:
+        # Unhashable values such as nested lists
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return pd.factorize(array, use_na_sentinel=False)
+    uniques = np.empty(len(index), dtype=object)
+    uniques[:] = list(index)
+    return np.fromiter(map(index.__getitem__, values), dtype=np.intp, count=len(values)), uniques
+
+def _combine(parts, function):
+    """
+    Apply a function to every distinct combination of factorized columns.
+
+    Parameters:
+    - parts (list): (codes, distinct values) pairs
+    - function: Called once per distinct combination with one value per part
+
+    Returns:
+    - (codes, distinct results) pair
+    """
+    import numpy as np
+    import pandas as pd
+
+    key = np.zeros(len(parts[0][0]), dtype=np.int64)
+    for codes, uniques in parts:
+        key = key * len(uniques) + codes
+    codes, keys = pd.factorize(key)
+    indices = np.unravel_index(keys, [len(uniques) for _, uniques in parts])
+    uniques = np.empty(len(keys), dtype=object)
+    uniques[:] = [function(*values) for values in zip(*(u[i] for (_, u), i in zip(parts, indices)))]
+    return codes, uniques
+
+class Schema:
+    """
+    Mapping from one source's raw records to the canonical measurement columns.
+
+    Derived values (joins, lookups, case changes) and timestamps are worked
+    out once per distinct input, not once per record, so their cost grows
+    with the number of stations and hours in a response rather than its rows.
+
+    Parameters:
+    - source (str): Value of the source column
+    - fields (dict): Canonical column name -> spec (field, const, join, lookup,
+      upper, strip); columns without a spec are null
+    - records (str, optional): Key holding the record list in a response
+      body; None when the body is the list itself
+    - timestamp_format (str): Format of the timestamp strings, passed to
+      pandas.to_datetime; naive timestamps are taken as UTC
+    - utc_offset (spec, optional): Hours to subtract from naive local
+      timestamps to get UTC
+    """
+
+    def __init__(self, source, fields, records=None, timestamp_format="ISO8601", utc_offset=None):
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown measurement columns: {sorted(unknown)}")
+        self.source = source
+        self.fields = dict(fields)
+        self.records = records
+        self.timestamp_format = timestamp_format
+        self.utc_offset = utc_offset
+        specs = list(self.fields.values()) + ([utc_offset] if utc_offset is not None else [])
+        self.paths = list(dict.fromkeys(path for spec in specs for path in _leaf_paths(spec)))
+
+    def evaluate(self, spec, leaves, n):
+        """
+        Evaluate a spec over extracted columns.
+
+        Returns:
+        - (codes, distinct values) pair
+        """
+        import numpy as np
+
+        kind = spec[0]
+        if kind == "field":
+            return _factorize(leaves[spec[1]])
+        if kind == "const":
+            return np.zeros(n, dtype=np.intp), np.array([spec[1]], dtype=object)
+        if kind == "join":
+            parts = [self.evaluate(const(part) if isinstance(part, str) else part, leaves, n)
+                     for part in spec[1]]
+            return _combine(parts, _join)
+        if kind == "lookup":
+            mapping = spec[1]
+            return _combine([self.evaluate(spec[2], leaves, n), self.evaluate(spec[3], leaves, n)],
+                            lambda value, default: default if _missing(value) else mapping.get(value, default))
+        if kind == "upper":
+            return _combine([self.evaluate(spec[1], leaves, n)], _upper)
+        if kind == "strip":
+            return _combine([self.evaluate(spec[1], leaves, n)], _strip)
+        raise ValueError(f"Unknown field spec: {kind!r}")
+
+def _numbers(values, dtype):
+    """Convert a sequence of numbers, numeric strings and None into a typed array."""
+    import numpy as np
+    import pandas as pd
+
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype=dtype)
+
+def normalize(schema, records):
+    """
+    Normalize raw records with a schema.
+
+    Parameters:
+    - schema (Schema): Mapping of the records' source
+    - records (list): Raw record dictionaries
+
+    Returns:
+    - DataFrame with the canonical measurement columns, typed
+    """
+    import numpy as np
+    import pandas as pd
+
+    n = len(records)
+    leaves = extract(records, schema.paths) if n else {path: () for path in schema.paths}
+    columns = {}
+    for name in COLUMNS:
+        spec = schema.fields.get(name) or const(schema.source if name == "source" else None)
+        if name in FLOAT_COLUMNS:
+            if spec[0] == "field":
+                columns[name] = _numbers(leaves[spec[1]], FLOAT_COLUMNS[name])
+            else:
+                codes, uniques = schema.evaluate(spec, leaves, n)
+                columns[name] = _numbers(uniques, FLOAT_COLUMNS[name])[codes]
+        elif name == "timestamp":
+            codes, uniques = schema.evaluate(spec, leaves, n)
+            timestamps = pd.to_datetime(pd.Series(uniques, dtype=object), utc=True,
+                                        format=schema.timestamp_format, errors="coerce")
+            timestamps = timestamps.astype("datetime64[ms, UTC]").array.take(codes)
+            if schema.utc_offset is not None:
+                offset_codes, offsets = schema.evaluate(schema.utc_offset, leaves, n)
+                hours = np.nan_to_num(_numbers(offsets, "float64"))[offset_codes]
+                timestamps = timestamps - pd.to_timedelta(hours, unit="h")
+            columns[name] = timestamps
+        else:
+            codes, uniques = schema.evaluate(spec, leaves, n)
+            columns[name] = pd.array(uniques, dtype="str").take(codes)
+    return pd.DataFrame(columns, columns=list(COLUMNS))
+
+def split_body(schema, payload):
+    """
+    Separate the records of a decoded response from the rest of the body.
+
+    Returns:
+    - Tuple of (record list, remaining body or None)
+    """
+    if schema.records is None:
+        return (payload if isinstance(payload, list) else []), None
+    if not isinstance(payload, dict):
+        return [], payload
+    envelope = {key: value for key, value in payload.items() if key != schema.records}
+    return payload.get(schema.records) or [], envelope
+
+def _normalize_body(schema, body):
+    """Decode and normalize a response body (runs in pool workers)."""
+    records, envelope = split_body(schema, json.loads(body))
+    return normalize(schema, records), envelope
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned workers, since fetchers run on threads and forking those is unsafe
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def _discard_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def normalize_body(schema, body):
+    """
+    Decode a JSON response body and normalize its records.
+
+    Bodies of POOL_MIN_BYTES or more go to the process pool; smaller ones,
+    or all of them if the pool cannot start, are handled in this process.
+
+    Parameters:
+    - schema (Schema): Mapping of the response's source
+    - body (bytes): Raw response body
+
+    Returns:
+    - Tuple of (measurement DataFrame, rest of the body without the records)
+
+    Raises:
+    - ValueError if the body is not valid JSON
+    """
+    from concurrent.futures.process import BrokenProcessPool
+
+    if len(body) >= POOL_MIN_BYTES and POOL_WORKERS > 1:
+        try:
+            with metrics.span("normalize"):
+                return _get_pool().submit(_normalize_body, schema, body).result()
+        except (OSError, BrokenProcessPool) as e:
+            print(f"Normalizing in process, pool unavailable: {e}")
+            _discard_pool()
+
+    with metrics.span("parse"):
+        payload = json.loads(body)
+    with metrics.span("normalize"):
+        records, envelope = split_body(schema, payload)
+        return normalize(schema, records), envelope
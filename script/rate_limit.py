@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Shared rate-limit scheduler for the air quality source fetchers.
+Every provider host gets a token bucket configured with that provider's
+published quota. Fetchers acquire a permit before each request instead of
+sleeping for a fixed time, and 429 responses pause the host's bucket and
+temporarily lower its rate.
+
+The buckets are shared by every process on the machine: their state lives
+in QUOTA_FILE and is only read and updated under an exclusive lock on
+QUOTA_FILE + ".lock". A run spawned by the Next.js route next to the
+resident service, or two overlapping spawned runs, therefore draw from one
+quota per host. On platforms without fcntl (Windows) each process falls
+back to its own buckets.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bucket states shared between processes, keyed by host
+QUOTA_FILE = "air_quality_data/rate_limits.json"
+
+# Sustained requests per second and burst size for each provider host
+HOST_QUOTAS = {
+    "www.airnowapi.org": (500 / 3600, 50),  # 500 requests per hour per key
+    "aqs.epa.gov": (10 / 60, 1),  # 10 requests per minute, no bursts
+    "api.openaq.org": (2000 / 3600, 60),  # 60 per minute, 2000 per hour
+    "api.waqi.info": (1000, 1000),  # 1000 requests per second per token
+    "aqicn.org": (1 / 5, 1)  # Website scraping, one page every 5 seconds
+}
+
+# Quota for hosts not listed above
+DEFAULT_QUOTA = (5, 5)
+
+# A throttled host never drops below this fraction of its configured rate
+MIN_RATE_FRACTION = 1 / 16
+
+class QuotaFile:
+    """Token bucket states of every host, shared between processes through a locked file."""
+
+    def __init__(self, path=QUOTA_FILE):
+        self.path = path
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the file lock and yield the states of every host.
+
+        Changes made to the yielded dictionary are written back before the
+        lock is released.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as f:
+                        states = json.load(f)
+                except (OSError, ValueError):
+                    states = {}
+                yield states
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(states, f)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Callers reserve a token and sleep until it becomes available, so waiting
+    threads are served in order and never exceed the configured rate. With a
+    QuotaFile, the bucket state is loaded from and saved to that file around
+    every operation, so waiting processes are served in order too.
+    """
+
+    def __init__(self, rate, capacity, host=None, shared=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.host = host
+        self.shared = shared
+        # Wall-clock time when shared, as monotonic clocks differ between processes
+        self.clock = time.time if shared is not None else time.monotonic
+        self.updated = self.clock()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _synced(self):
+        # Call with self.lock held
+        if self.shared is None:
+            yield
+            return
+        with self.shared.locked() as states:
+            state = states.get(self.host)
+            if state is not None:
+                self.tokens = min(state["tokens"], self.capacity)
+                self.updated = state["updated"]
+                self.rate = min(state["rate"], self.max_rate)
+            yield
+            states[self.host] = {"tokens": self.tokens, "updated": self.updated, "rate": self.rate}
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, timeout=None):
+        """
+        Take one token and return how many seconds to wait before using it.
+
+        With a timeout, no token is taken and None is returned when the wait
+        would be longer.
+        """
+        with self.lock, self._synced():
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(self.updated - now, 0.0)
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            if timeout is not None and wait > timeout:
+                self.tokens += 1
+                return None
+            return wait
+
+    def acquire(self, timeout=None):
+        """
+        Block until a token is available.
+
+        Returns:
+        - False, without waiting, if no token is available within timeout seconds
+        """
+        wait = self.reserve(timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` and halve the refill rate."""
+        with self.lock, self._synced():
+            now = self.clock()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0)
+            self.updated = max(self.updated, now + seconds)
+            self.rate = max(self.rate / 2, self.max_rate * MIN_RATE_FRACTION)
+
+    def recover(self):
+        """Move the refill rate back towards its configured value after a success."""
+        if self.rate >= self.max_rate:
+            return  # Nothing to recover; avoids taking the shared lock on every success
+        with self.lock, self._synced():
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+class RateLimitScheduler:
+    """
+    Hands out request permits per host from lazily created token buckets.
+
+    Parameters:
+    - quotas (dict, optional): host -> (rate, capacity) (default: HOST_QUOTAS)
+    - state_file (str, optional): File sharing the buckets with other
+      processes (default: QUOTA_FILE); None keeps them in this process only
+    """
+
+    def __init__(self, quotas=None, state_file=QUOTA_FILE):
+        self.quotas = dict(HOST_QUOTAS if quotas is None else quotas)
+        self.shared = QuotaFile(state_file) if state_file and fcntl is not None else None
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, host):
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                rate, capacity = self.quotas.get(host, DEFAULT_QUOTA)
+                bucket = TokenBucket(rate, capacity, host, self.shared)
+                self.buckets[host] = bucket
+            return bucket
+
+    def acquire(self, host, timeout=None):
+        """
+        Block until a request to host is allowed.
+
+        Returns:
+        - False, without waiting, if no permit is available within timeout seconds
+        """
+        return self.bucket(host).acquire(timeout)
+
+    def throttle(self, host, seconds):
+        """Back off a host after a 429, e.g. for its Retry-After period."""
+        self.bucket(host).pause(seconds)
+
+    def record_success(self, host):
+        """Let a previously throttled host speed up again."""
+        self.bucket(host).recover()
+
+# Scheduler shared by every fetcher in this process (and, through QUOTA_FILE, with other processes)
+scheduler = RateLimitScheduler()
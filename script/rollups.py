@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+Incrementally maintained time-series rollups of the stored measurements.
+Every ingested batch updates hourly, daily, weekly and monthly aggregates
+per station, parameter and unit, plus hour-of-day and month-of-year
+profiles. Each aggregate holds the count, sum, min, max and a log-spaced
+histogram (for approximate percentiles) of both the concentration in
+standard units and the AQI sub-index. Dashboard views read these
+aggregates, so their cost does not grow with the raw history.
+
+Requirements:
+- numpy
+- pandas
+
+Install with: pip install numpy pandas
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from aqi import measurement_standard_values, measurement_sub_indices
+
+# Directory holding one file per rollup granularity
+ROLLUP_DIR = "air_quality_data/rollups"
+
+# Bucket start and label format of every granularity; profiles use local
+# solar time (UTC shifted by longitude / 15 hours) so hours line up with daylight
+GRANULARITIES = {
+    "hour": (lambda utc, local: utc.dt.floor("h"), "%Y-%m-%dT%H"),
+    "day": (lambda utc, local: utc.dt.floor("D"), "%Y-%m-%d"),
+    "week": (lambda utc, local: utc.dt.floor("D") - pd.to_timedelta(utc.dt.weekday, unit="D"), "%G-W%V"),
+    "month": (lambda utc, local: utc.dt.floor("D") - pd.to_timedelta(utc.dt.day - 1, unit="D"), "%Y-%m"),
+    "hour_of_day": (lambda utc, local: local.dt.floor("h"), "%H"),
+    "month_of_year": (lambda utc, local: local.dt.floor("D") - pd.to_timedelta(local.dt.day - 1, unit="D"), "%m")
+}
+
+# Buckets older than this are dropped (granularities not listed are kept forever)
+RETENTION = {
+    "hour": timedelta(days=14),
+    "day": timedelta(days=400)
+}
+
+# Aggregated metrics: concentration in standard units, and AQI sub-index
+METRICS = ("value", "aqi")
+
+# Histogram bin edges: [0, 0.01) then 10 log-spaced bins per decade up to 10^4
+BIN_EDGES = np.concatenate([[0.0], np.geomspace(0.01, 1e4, 61)])
+BINS = len(BIN_EDGES)
+
+PERCENTILES = (50, 90, 95)
+
+def bucket_labels(granularity, utc, local):
+    """
+    Bucket label of every timestamp.
+
+    Only the distinct bucket starts are formatted, which is much faster
+    than formatting every timestamp.
+
+    Parameters:
+    - granularity (str): One of GRANULARITIES
+    - utc (Series): UTC timestamps (no missing values)
+    - local (Series): Local solar timestamps of the same rows
+
+    Returns:
+    - Array of bucket label strings
+    """
+    start, label_format = GRANULARITIES[granularity]
+    starts = start(utc, local).to_numpy(dtype="datetime64[ns]")
+    unique, inverse = np.unique(starts, return_inverse=True)
+    return pd.DatetimeIndex(unique).strftime(label_format).to_numpy(dtype=str)[inverse]
+
+class Rollup:
+    """Aggregates of one granularity, stored as arrays with one row per key."""
+
+    def __init__(self):
+        self.keys = []
+        self.index = {}
+        self.count = np.zeros((0, 2), dtype=np.int64)
+        self.total = np.zeros((0, 2))
+        self.low = np.zeros((0, 2))
+        self.high = np.zeros((0, 2))
+        self.hist = np.zeros((0, 2, BINS), dtype=np.int32)
+        self._parts = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, keys):
+        """Row number of every key, appending rows for new keys."""
+        unique, inverse = np.unique(keys, return_inverse=True)
+        rows = np.empty(len(unique), dtype=np.int64)
+        new = 0
+        for i, key in enumerate(unique.tolist()):
+            row = self.index.get(key)
+            if row is None:
+                row = len(self.keys)
+                self.index[key] = row
+                self.keys.append(key)
+                new += 1
+            rows[i] = row
+        if new:
+            self.count = np.concatenate([self.count, np.zeros((new, 2), dtype=np.int64)])
+            self.total = np.concatenate([self.total, np.zeros((new, 2))])
+            self.low = np.concatenate([self.low, np.full((new, 2), np.inf)])
+            self.high = np.concatenate([self.high, np.full((new, 2), -np.inf)])
+            self.hist = np.concatenate([self.hist, np.zeros((new, 2, BINS), dtype=np.int32)])
+        return rows[inverse]
+
+    def add(self, keys, values):
+        """
+        Fold values into the aggregates of their keys.
+
+        Parameters:
+        - keys (array): Key of every row
+        - values (array): (rows, 2) array of concentration and AQI (NaN = missing)
+        """
+        rows = self.rows(keys)
+        for metric in range(2):
+            column = values[:, metric]
+            valid = ~np.isnan(column) & (column >= 0)
+            r, v = rows[valid], column[valid]
+            np.add.at(self.count[:, metric], r, 1)
+            np.add.at(self.total[:, metric], r, v)
+            np.minimum.at(self.low[:, metric], r, v)
+            np.maximum.at(self.high[:, metric], r, v)
+            bins = np.clip(np.searchsorted(BIN_EDGES, v, side="right") - 1, 0, BINS - 1)
+            np.add.at(self.hist[:, metric], (r, bins), 1)
+
+    def remove(self, keys, values):
+        """
+        Take values previously folded in with add() back out of their aggregates.
+
+        Count, sum and histogram are restored exactly. The true min and max
+        of what is left cannot be recovered, so they are narrowed to the
+        outermost non-empty histogram bins. Keys without a row (e.g. pruned
+        buckets) are ignored.
+
+        Parameters:
+        - keys (array): Key of every row
+        - values (array): (rows, 2) array of concentration and AQI (NaN = missing)
+        """
+        rows = np.array([self.index.get(key, -1) for key in keys.tolist()], dtype=np.int64)
+        known = rows >= 0
+        rows, values = rows[known], values[known]
+        upper_edges = np.append(BIN_EDGES[1:], np.inf)
+        for metric in range(2):
+            column = values[:, metric]
+            valid = ~np.isnan(column) & (column >= 0)
+            r, v = rows[valid], column[valid]
+            if not len(r):
+                continue
+            np.subtract.at(self.count[:, metric], r, 1)
+            np.subtract.at(self.total[:, metric], r, v)
+            bins = np.clip(np.searchsorted(BIN_EDGES, v, side="right") - 1, 0, BINS - 1)
+            np.subtract.at(self.hist[:, metric], (r, bins), 1)
+
+            touched = np.unique(r)
+            self.count[touched, metric] = np.maximum(self.count[touched, metric], 0)
+            hist = np.maximum(self.hist[touched, metric], 0)
+            self.hist[touched, metric] = hist
+            filled = hist > 0
+            left = filled.any(axis=1)
+            first = filled.argmax(axis=1)
+            last = BINS - 1 - filled[:, ::-1].argmax(axis=1)
+            self.low[touched, metric] = np.where(left, np.maximum(self.low[touched, metric], BIN_EDGES[first]), np.inf)
+            self.high[touched, metric] = np.where(left, np.minimum(self.high[touched, metric], upper_edges[last]), -np.inf)
+            self.total[touched, metric] = np.where(left, self.total[touched, metric], 0.0)
+
+    def parts(self):
+        """DataFrame of the station, parameter, unit and bucket of every row (cached)."""
+        if self._parts is None or len(self._parts) != len(self.keys):
+            known = 0 if self._parts is None else len(self._parts)
+            split = pd.Series(self.keys[known:], dtype=str).str.split("|", expand=True)
+            split = split.reindex(columns=range(4))
+            split.columns = ["station_id", "parameter", "unit", "bucket"]
+            split.index = range(known, len(self.keys))
+            self._parts = split if self._parts is None else pd.concat([self._parts, split])
+        return self._parts
+
+    def prune(self, bucket_cutoff):
+        """Drop every row whose bucket sorts before bucket_cutoff."""
+        keep = (self.parts()["bucket"] >= bucket_cutoff).to_numpy()
+        if keep.all():
+            return
+        self._parts = None
+        self.keys = [key for key, kept in zip(self.keys, keep) if kept]
+        self.index = {key: row for row, key in enumerate(self.keys)}
+        self.count, self.total = self.count[keep], self.total[keep]
+        self.low, self.high, self.hist = self.low[keep], self.high[keep], self.hist[keep]
+
+    def save(self, path):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+        np.savez_compressed(tmp_path, keys=np.array(self.keys, dtype=str), count=self.count,
+                            total=self.total, low=self.low, high=self.high, hist=self.hist)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        rollup = cls()
+        with np.load(path) as data:
+            rollup.keys = data["keys"].tolist()
+            rollup.count, rollup.total = data["count"], data["total"]
+            rollup.low, rollup.high, rollup.hist = data["low"], data["high"], data["hist"]
+        rollup.index = {key: row for row, key in enumerate(rollup.keys)}
+        return rollup
+
+def percentiles(hist, low, high, qs=PERCENTILES):
+    """
+    Estimate percentiles from histogram rows.
+
+    Within a bin, values are assumed to be spread evenly, and results are
+    clamped to the observed min and max.
+
+    Parameters:
+    - hist (array): (rows, BINS) histogram counts
+    - low (array): Observed minimum per row
+    - high (array): Observed maximum per row
+    - qs (tuple): Percentiles to estimate (0-100)
+
+    Returns:
+    - (rows, len(qs)) float array (NaN for empty rows)
+    """
+    cumulative = np.cumsum(hist, axis=1)
+    total = cumulative[:, -1]
+    # Empty rows carry inf/-inf bounds; clamp to 0 so the arithmetic stays finite
+    low = np.where(total > 0, low, 0.0)
+    high = np.where(total > 0, high, 0.0)
+    lower_edges = BIN_EDGES
+    upper_edges = np.append(BIN_EDGES[1:], np.inf)
+    result = np.full((len(hist), len(qs)), np.nan)
+    for j, q in enumerate(qs):
+        target = total * q / 100
+        bins = np.minimum((cumulative < target[:, None]).sum(axis=1), BINS - 1)
+        before = np.where(bins > 0, np.take_along_axis(cumulative, np.maximum(bins - 1, 0)[:, None], axis=1)[:, 0], 0)
+        inside = np.take_along_axis(hist, bins[:, None], axis=1)[:, 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(inside > 0, (target - before) / inside, 0.0)
+        lo = np.maximum(lower_edges[bins], low)
+        hi = np.minimum(upper_edges[bins], high)
+        result[:, j] = np.where(total > 0, lo + (hi - lo) * np.clip(fraction, 0, 1), np.nan)
+    return result
+
+def _keyed(measurements):
+    """
+    Rollup keys of every granularity and the (concentration, AQI) values of measurements.
+
+    Returns:
+    - Tuple of ({granularity: keys}, (rows, 2) values), or None if no row
+      has a timestamp
+    """
+    if measurements is None or measurements.empty:
+        return None
+
+    utc = pd.to_datetime(measurements["timestamp"], utc=True)
+    valid = utc.notna().to_numpy()
+    measurements, utc = measurements[valid], utc[valid]
+    if measurements.empty:
+        return None
+
+    offset = pd.to_numeric(measurements["longitude"], errors="coerce").fillna(0) / 15
+    local = utc + pd.to_timedelta(offset.to_numpy(), unit="h")
+    standard = measurement_standard_values(measurements)
+    values = np.column_stack([standard, measurement_sub_indices(measurements, standard)])
+
+    prefix = (measurements["station_id"].astype(str) + "|" + measurements["parameter"].astype(str)
+              + "|" + measurements["unit"].fillna("").astype(str) + "|").to_numpy(dtype=str)
+    return {name: np.char.add(prefix, bucket_labels(name, utc, local)) for name in GRANULARITIES}, values
+
+class RollupStore:
+    """All rollup granularities, updated together and persisted per granularity."""
+
+    def __init__(self, directory=ROLLUP_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.rollups = {}
+        for name in GRANULARITIES:
+            path = self.path(name)
+            try:
+                self.rollups[name] = Rollup.load(path)
+            except (OSError, ValueError, KeyError):
+                self.rollups[name] = Rollup()
+
+    def path(self, granularity):
+        return os.path.join(self.directory, f"{granularity}.npz")
+
+    def save(self):
+        """Atomically write every granularity to disk."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            for name, rollup in self.rollups.items():
+                rollup.save(self.path(name))
+
+    def update(self, measurements, save=True):
+        """
+        Fold newly stored measurements into every rollup.
+
+        Call this once per stored batch; measurements added twice are
+        counted twice.
+
+        Parameters:
+        - measurements (DataFrame): Canonical measurement columns
+        - save (bool): Persist the rollups afterwards
+
+        Returns:
+        - Number of measurements folded in
+        """
+        keyed = _keyed(measurements)
+        if keyed is None:
+            return 0
+        keys, values = keyed
+
+        with self.lock:
+            for name in GRANULARITIES:
+                self.rollups[name].add(keys[name], values)
+                if name in RETENTION:
+                    cutoff = pd.Series([datetime.now(timezone.utc) - RETENTION[name]])
+                    self.rollups[name].prune(bucket_labels(name, cutoff, cutoff)[0])
+
+        if save:
+            self.save()
+        return len(values)
+
+    def remove(self, measurements, save=True):
+        """
+        Take measurements deleted from the store back out of every rollup.
+
+        Parameters:
+        - measurements (DataFrame): Canonical measurement columns, as
+          previously passed to update()
+        - save (bool): Persist the rollups afterwards
+
+        Returns:
+        - Number of measurements taken out
+        """
+        keyed = _keyed(measurements)
+        if keyed is None:
+            return 0
+        keys, values = keyed
+
+        with self.lock:
+            for name in GRANULARITIES:
+                self.rollups[name].remove(keys[name], values)
+
+        if save:
+            self.save()
+        return len(values)
+
+    def summary(self, granularity, station_ids=None, parameter=None, metric="value",
+                start=None, end=None):
+        """
+        Combine the aggregates of several stations per bucket.
+
+        Parameters:
+        - granularity (str): One of GRANULARITIES
+        - station_ids (iterable, optional): Stations to include (default: all)
+        - parameter (str, optional): Parameter to include, e.g. 'pm25'
+        - metric (str): 'value' (standard units) or 'aqi'
+        - start (str, optional): First bucket label to include
+        - end (str, optional): Last bucket label to include
+
+        Returns:
+        - DataFrame indexed by bucket with count, mean, min, max, p50, p90 and p95
+        """
+        m = METRICS.index(metric)
+        with self.lock:
+            rollup = self.rollups[granularity]
+            parts = rollup.parts()
+            selected = np.ones(len(parts), dtype=bool)
+            if station_ids is not None:
+                selected &= parts["station_id"].isin(list(station_ids)).to_numpy()
+            if parameter is not None:
+                selected &= (parts["parameter"] == parameter).to_numpy()
+            if start is not None:
+                selected &= (parts["bucket"] >= start).to_numpy()
+            if end is not None:
+                selected &= (parts["bucket"] <= end).to_numpy()
+            rows = np.flatnonzero(selected)
+            buckets = parts["bucket"].to_numpy()[rows]
+            count, total = rollup.count[rows, m], rollup.total[rows, m]
+            low, high, hist = rollup.low[rows, m], rollup.high[rows, m], rollup.hist[rows, m]
+
+        columns = ["count", "mean", "min", "max"] + [f"p{q}" for q in PERCENTILES]
+        if len(rows) == 0:
+            return pd.DataFrame(columns=columns)
+
+        codes, labels = pd.factorize(pd.Series(buckets), sort=True)
+        n = len(labels)
+        merged_count = np.bincount(codes, weights=count, minlength=n)
+        merged_total = np.bincount(codes, weights=total, minlength=n)
+        merged_low = np.full(n, np.inf)
+        merged_high = np.full(n, -np.inf)
+        np.minimum.at(merged_low, codes, low)
+        np.maximum.at(merged_high, codes, high)
+        merged_hist = np.zeros((n, BINS), dtype=np.int64)
+        np.add.at(merged_hist, codes, hist)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = merged_total / merged_count
+        result = pd.DataFrame({
+            "count": merged_count.astype(np.int64),
+            "mean": mean,
+            "min": merged_low,
+            "max": merged_high
+        }, index=pd.Index(labels, name="bucket"))
+        result[[f"p{q}" for q in PERCENTILES]] = percentiles(merged_hist, merged_low, merged_high)
+        return result[result["count"] > 0]
+
+    def series(self, granularity, station_ids=None, parameter=None, metric="value", start=None):
+        """
+        Per-station means as a wide table.
+
+        Parameters:
+        - granularity (str): One of GRANULARITIES
+        - station_ids (iterable, optional): Stations to include (default: all)
+        - parameter (str, optional): Parameter to include, e.g. 'pm25'
+        - metric (str): 'value' (standard units) or 'aqi'
+        - start (str, optional): First bucket label to include
+
+        Returns:
+        - DataFrame indexed by bucket label with one column per station
+        """
+        m = METRICS.index(metric)
+        with self.lock:
+            rollup = self.rollups[granularity]
+            parts = rollup.parts()
+            selected = np.ones(len(parts), dtype=bool)
+            if station_ids is not None:
+                selected &= parts["station_id"].isin(list(station_ids)).to_numpy()
+            if parameter is not None:
+                selected &= (parts["parameter"] == parameter).to_numpy()
+            if start is not None:
+                selected &= (parts["bucket"] >= start).to_numpy()
+            rows = np.flatnonzero(selected)
+            frame = parts.iloc[rows][["station_id", "bucket"]].copy()
+            frame["count"] = rollup.count[rows, m]
+            frame["total"] = rollup.total[rows, m]
+
+        sums = frame.groupby(["bucket", "station_id"])[["count", "total"]].sum()
+        means = (sums["total"] / sums["count"].where(sums["count"] > 0)).unstack("station_id")
+        return means.sort_index()
+
+    def weekly_trend(self, station_ids=None, days=7):
+        """
+        Daily PM2.5 and PM10 means of the last `days` days.
+
+        Returns:
+        - List of {'day', 'PM25', 'PM10'} dictionaries, or None without data
+        """
+        today = datetime.now(timezone.utc).date()
+        start = (today - timedelta(days=days - 1)).isoformat()
+        pm25 = self.summary("day", station_ids, "pm25", start=start)["mean"]
+        pm10 = self.summary("day", station_ids, "pm10", start=start)["mean"]
+        if pm25.empty and pm10.empty:
+            return None
+
+        trend = []
+        for offset in range(days - 1, -1, -1):
+            day = today - timedelta(days=offset)
+            label = day.isoformat()
+            trend.append({
+                "day": day.strftime("%a"),
+                "PM25": _rounded(pm25.get(label)),
+                "PM10": _rounded(pm10.get(label))
+            })
+        return trend
+
+    def hourly_profile(self, station_ids=None, parameter="pm25", hours=None):
+        """
+        Mean concentration by local hour of day.
+
+        Parameters:
+        - station_ids (iterable, optional): Stations to include
+        - parameter (str): Parameter to profile
+        - hours (list, optional): Hours (0-23) to report (default: all with data)
+
+        Returns:
+        - Dictionary of hour -> mean, or None without data
+        """
+        profile = self.summary("hour_of_day", station_ids, parameter)["mean"]
+        if profile.empty:
+            return None
+        values = {int(bucket): _rounded(mean) for bucket, mean in profile.items()}
+        return {hour: values.get(hour) for hour in (hours if hours is not None else sorted(values))}
+
+    def seasonal_profile(self, station_ids=None, parameter="pm25"):
+        """
+        Mean AQI by month of year.
+
+        Returns:
+        - Dictionary of month number (1-12) -> mean AQI, or None without data
+        """
+        profile = self.summary("month_of_year", station_ids, parameter, metric="aqi")["mean"]
+        if profile.empty:
+            return None
+        return {int(bucket): _rounded(mean) for bucket, mean in profile.items()}
+
+    def rebuild(self, store, batch_days=31):
+        """
+        Recompute every rollup from the full measurement store.
+
+        Parameters:
+        - store (MeasurementStore): Store to scan
+        - batch_days (int): Days of partitions read at a time
+
+        Returns:
+        - Number of measurements folded in
+        """
+        with self.lock:
+            self.rollups = {name: Rollup() for name in GRANULARITIES}
+        dates = sorted({date for _, _, date in store.partitions()})
+        rows = 0
+        for i in range(0, len(dates), batch_days):
+            chunk = dates[i:i + batch_days]
+            end = (pd.Timestamp(chunk[-1]) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+            rows += self.update(store.query(start=chunk[0], end=end), save=False)
+        self.save()
+        return rows
+
+def _rounded(value):
+    return None if value is None or pd.isna(value) else int(round(float(value)))
+
+# Rollups shared by every fetcher in this process
+rollups = RollupStore()
+
+def main():
+    import argparse
+    from storage import store
+
+    parser = argparse.ArgumentParser(description="Maintain measurement rollups")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute all rollups from the measurement store")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rows = rollups.rebuild(store)
+        print(f"Rebuilt rollups from {rows} measurements")
+    for name, rollup in rollups.rollups.items():
+        print(f"{name}: {len(rollup)} aggregates")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Pollution-aware routing over a local road network.
+Loads a road-network file (nodes with coordinates, edges with length and
+typical speed) into compact adjacency arrays and answers shortest-time and
+least-exposure queries with A*. Each edge's PM2.5 is interpolated from the
+current station readings. Edge weights are cached and only recomputed when
+the readings change.
+
+Requirements:
+- numpy
+
+Install with: pip install numpy
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import threading
+
+import numpy as np
+
+from exposure import EXPOSURE_SCALE
+
+# Road network used when no file is given
+NETWORK_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "data", "road_network", "kathmandu.json")
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Inverse-distance weighting power and the distance (km) below which a station counts as on the edge
+IDW_POWER = 2
+IDW_MIN_DISTANCE_KM = 0.05
+
+COSTS = ("time", "exposure")
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between coordinate arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(h))
+
+def readings_digest(readings):
+    """Stable hash of station readings, used as the edge weight cache key."""
+    rows = sorted((float(r["latitude"]), float(r["longitude"]), float(r["pm25"])) for r in readings)
+    return hashlib.sha1(json.dumps(rows).encode("utf-8")).hexdigest()
+
+class RoadGraph:
+    """
+    Road network stored as compressed adjacency arrays.
+
+    Node i's outgoing edges are adj_edge[indptr[i]:indptr[i + 1]], leading to
+    the nodes in adj_node at the same positions.
+    """
+
+    def __init__(self, network):
+        nodes = network["nodes"]
+        self.ids = [node["id"] for node in nodes]
+        self.names = [node.get("name", node["id"]) for node in nodes]
+        self.lookup = {}
+        for i, node in enumerate(nodes):
+            self.lookup[node["id"].lower()] = i
+            self.lookup[self.names[i].lower()] = i
+        self.lat = np.array([node["lat"] for node in nodes], dtype=np.float64)
+        self.lon = np.array([node["lon"] for node in nodes], dtype=np.float64)
+
+        edges = network["edges"]
+        src = np.array([self.lookup[e["from"].lower()] for e in edges], dtype=np.int64)
+        dst = np.array([self.lookup[e["to"].lower()] for e in edges], dtype=np.int64)
+        self.length_km = np.array([e.get("length_km") or haversine_km(self.lat[s], self.lon[s], self.lat[d], self.lon[d])
+                                   for e, s, d in zip(edges, src, dst)], dtype=np.float64)
+        speed = np.array([e["speed_kmh"] for e in edges], dtype=np.float64)
+        self.minutes = self.length_km / speed * 60
+        self.max_speed_kmh = float(speed.max())
+        self.mid_lat = (self.lat[src] + self.lat[dst]) / 2
+        self.mid_lon = (self.lon[src] + self.lon[dst]) / 2
+
+        # Two-way roads appear once per direction in the adjacency arrays
+        two_way = np.array([not e.get("oneway", False) for e in edges])
+        edge_ids = np.arange(len(edges))
+        tails = np.concatenate([src, dst[two_way]])
+        heads = np.concatenate([dst, src[two_way]])
+        arc_edges = np.concatenate([edge_ids, edge_ids[two_way]])
+        order = np.argsort(tails, kind="stable")
+        self.adj_node = heads[order]
+        self.adj_edge = arc_edges[order]
+        self.indptr = np.searchsorted(tails[order], np.arange(len(nodes) + 1))
+
+        # Python lists are faster than NumPy scalars inside the search loop
+        self._adjacency = [list(zip(self.adj_node[self.indptr[i]:self.indptr[i + 1]].tolist(),
+                                    self.adj_edge[self.indptr[i]:self.indptr[i + 1]].tolist()))
+                           for i in range(len(nodes))]
+
+        self._lock = threading.Lock()
+        self._weights = (None, None)
+
+    @classmethod
+    def load(cls, path=NETWORK_FILE):
+        """Load a road network JSON file."""
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def node_index(self, node):
+        """
+        Resolve a node id or name (case-insensitive) to its index.
+
+        Raises:
+        - KeyError if the node is not in the network
+        """
+        try:
+            return self.lookup[str(node).lower()]
+        except KeyError:
+            raise KeyError(f"Unknown node: {node}") from None
+
+    def nearest_node(self, lat, lon):
+        """Return the id of the node closest to a coordinate."""
+        return self.ids[int(np.argmin(haversine_km(lat, lon, self.lat, self.lon)))]
+
+    def edge_pm25(self, readings):
+        """
+        Interpolate PM2.5 at every edge midpoint from station readings.
+
+        The result is cached by a hash of the readings, so repeated queries
+        with unchanged readings reuse it.
+
+        Parameters:
+        - readings (list): Dictionaries with 'latitude', 'longitude' and 'pm25'
+
+        Returns:
+        - float64 array with one PM2.5 value per edge
+        """
+        digest = readings_digest(readings)
+        with self._lock:
+            cached_digest, cached = self._weights
+            if cached_digest == digest:
+                return cached
+
+        lat = np.array([r["latitude"] for r in readings], dtype=np.float64)
+        lon = np.array([r["longitude"] for r in readings], dtype=np.float64)
+        pm25 = np.array([r["pm25"] for r in readings], dtype=np.float64)
+
+        distance = haversine_km(self.mid_lat[:, None], self.mid_lon[:, None], lat[None, :], lon[None, :])
+        weights = 1.0 / np.maximum(distance, IDW_MIN_DISTANCE_KM) ** IDW_POWER
+        values = (weights * pm25).sum(axis=1) / weights.sum(axis=1)
+
+        with self._lock:
+            self._weights = (digest, values)
+        return values
+
+    def edge_costs(self, cost, readings=None):
+        """
+        Return the per-edge cost array for a query.
+
+        Parameters:
+        - cost (str): 'time' (minutes) or 'exposure' (PM2.5 x minutes)
+        - readings (list, optional): Station readings, required for 'exposure'
+        """
+        if cost == "time":
+            return self.minutes
+        if cost == "exposure":
+            if not readings:
+                raise ValueError("Exposure routing needs station readings")
+            return self.edge_pm25(readings) * self.minutes / EXPOSURE_SCALE
+        raise ValueError(f"Unknown cost: {cost} (expected one of {', '.join(COSTS)})")
+
+    def shortest_path(self, start, end, cost="time", readings=None):
+        """
+        Find the cheapest path between two nodes with A*.
+
+        The heuristic is the straight-line distance driven at the network's
+        top speed (times the lowest edge exposure rate for exposure queries),
+        which never overestimates, so the path found is optimal.
+
+        Parameters:
+        - start (str): Start node id or name
+        - end (str): End node id or name
+        - cost (str): 'time' or 'exposure'
+        - readings (list, optional): Station readings (adds PM2.5 and exposure to the result)
+
+        Returns:
+        - Dictionary with 'path' (node ids), 'names', 'distance_km', 'minutes',
+          'avg_pm25' and 'total_exposure' (the last two only with readings),
+          or None if the nodes are not connected
+        """
+        source, target = self.node_index(start), self.node_index(end)
+        weights = self.edge_costs(cost, readings).tolist()
+
+        rate = 60 / self.max_speed_kmh
+        if cost == "exposure":
+            rate *= float(np.min(self.edge_pm25(readings))) / EXPOSURE_SCALE
+        heuristic = (haversine_km(self.lat, self.lon, self.lat[target], self.lon[target]) * rate).tolist()
+
+        best = {source: 0.0}
+        previous = {}
+        done = set()
+        queue = [(heuristic[source], 0.0, source)]
+        while queue:
+            _, spent, node = heapq.heappop(queue)
+            if node == target:
+                break
+            if node in done:
+                continue
+            done.add(node)
+            for neighbour, edge in self._adjacency[node]:
+                total = spent + weights[edge]
+                if total < best.get(neighbour, float("inf")):
+                    best[neighbour] = total
+                    previous[neighbour] = (node, edge)
+                    heapq.heappush(queue, (total + heuristic[neighbour], total, neighbour))
+        else:
+            return None
+
+        nodes, edges = [target], []
+        while nodes[-1] != source:
+            node, edge = previous[nodes[-1]]
+            nodes.append(node)
+            edges.append(edge)
+        nodes.reverse()
+        edges.reverse()
+        return self.describe_path(nodes, edges, readings)
+
+    def describe_path(self, nodes, edges, readings=None):
+        """Summarize a path given as node and edge indices."""
+        edges = np.array(edges, dtype=np.int64)
+        minutes = float(self.minutes[edges].sum())
+        result = {
+            "path": [self.ids[i] for i in nodes],
+            "names": [self.names[i] for i in nodes],
+            "distance_km": round(float(self.length_km[edges].sum()), 2),
+            "minutes": round(minutes, 1)
+        }
+        if readings:
+            exposure = float((self.edge_pm25(readings)[edges] * self.minutes[edges]).sum())
+            result["avg_pm25"] = round(exposure / minutes, 1) if minutes else 0.0
+            result["total_exposure"] = round(exposure / EXPOSURE_SCALE, 1)
+        return result
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+def load_graph(path=NETWORK_FILE):
+    """
+    Return the road graph for a network file, loading it once per process.
+
+    Parameters:
+    - path (str): Road network JSON file
+
+    Returns:
+    - RoadGraph
+    """
+    with _graphs_lock:
+        graph = _graphs.get(path)
+        if graph is None:
+            graph = RoadGraph.load(path)
+            _graphs[path] = graph
+        return graph
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Write-once snapshot files for the dashboard datasets.
+Each dataset is serialized once as compact JSON, hashed, and only written
+when its content changed. New content is published with an atomic rename,
+together with precompressed gzip (and, when the brotli package is
+installed, brotli) copies. A manifest.json next to the files records the
+ETag, size and available encodings of every snapshot, so the web server can
+answer conditional requests and serve the compressed bytes without
+touching the JSON. Each entry also records when its dataset was last
+built (generated_at), which is what cache freshness is judged by; a file
+without a manifest entry was not written by this module and has no known age.
+
+Several processes (the resident data service and refresh CLIs) may publish
+into the same directory. Writers hold an exclusive file lock while they
+re-read the manifest, replace the data files and write the manifest back,
+so neither entries nor file/manifest pairs get mixed up; read() takes the
+lock shared to get an entry and its bytes from the same publish. On
+platforms without fcntl (Windows) only threads of one process are
+coordinated.
+
+Requirements:
+- brotli (optional)
+
+Install with: pip install brotli
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MANIFEST_NAME = "manifest.json"
+
+# gzip level for the precompressed copies; they are written once and served many times
+GZIP_LEVEL = 9
+
+# File suffix of every precompressed encoding
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+def serialize(data):
+    """Compact UTF-8 JSON bytes of a dataset."""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def content_digest(body):
+    """Content hash of serialized bytes."""
+    return hashlib.sha256(body).hexdigest()
+
+def compress(body):
+    """Precompressed copies of a body, keyed by content encoding."""
+    copies = {"gzip": gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        copies["br"] = brotli.compress(body)
+    return copies
+
+def _write_atomic(path, body):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+
+class SnapshotDirectory:
+    """Snapshot files of one directory and their manifest."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.manifest = {}
+        self.manifest_mtime = None
+        self._reload()
+
+    def _reload(self, force=False):
+        # Pick up entries published by other processes; call with the lock held
+        # (or before the object is shared)
+        try:
+            mtime = os.path.getmtime(self.manifest_path)
+        except OSError:
+            return
+        if mtime == self.manifest_mtime and not force:
+            return
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            self.manifest_mtime = mtime
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        # Call inside _locked()
+        _write_atomic(self.manifest_path, serialize(self.manifest))
+        self.manifest_mtime = os.path.getmtime(self.manifest_path)
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        """
+        Hold the thread lock and the directory's file lock, with the manifest
+        re-read inside them (always when exclusive, on a newer mtime otherwise).
+        """
+        with self.lock:
+            if fcntl is None:
+                self._reload(force=exclusive)
+                yield
+                return
+            with open(self.manifest_path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    self._reload(force=exclusive)
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def entry(self, name):
+        """Manifest entry of a snapshot, or None if it was never published."""
+        with self._locked(exclusive=False):
+            entry = self.manifest.get(name)
+        if entry is None or not os.path.exists(os.path.join(self.directory, name)):
+            return None
+        return entry
+
+    def read(self, name, encoding=None):
+        """
+        Read a snapshot together with the manifest entry it was published with.
+
+        Parameters:
+        - name (str): File name inside the directory
+        - encoding (str, optional): Content encoding of the copy to read
+          ("br" or "gzip"); None reads the JSON itself
+
+        Returns:
+        - Tuple of (manifest entry, bytes), or (None, None) if the snapshot
+          (or that encoding of it) was never published
+        """
+        with self._locked(exclusive=False):
+            entry = self.manifest.get(name)
+            if entry is None or (encoding is not None and encoding not in entry["encodings"]):
+                return None, None
+            file_name = entry["encodings"][encoding]["file"] if encoding else name
+            try:
+                with open(os.path.join(self.directory, file_name), "rb") as f:
+                    return entry, f.read()
+            except OSError:
+                return None, None
+
+    def publish(self, name, data, digest=None):
+        """
+        Publish a dataset unless the same content is already on disk.
+
+        Parameters:
+        - name (str): File name inside the directory
+        - data: JSON-serializable dataset
+        - digest (str, optional): Precomputed identity of the content; when
+          given and unchanged, the dataset is not even serialized
+
+        Returns:
+        - Tuple of (manifest entry, True if files were written)
+        """
+        path = os.path.join(self.directory, name)
+        previous = self.entry(name)
+        if digest is not None and previous is not None and previous.get("digest") == digest:
+            return previous, False
+
+        body = serialize(data)
+        body_digest = content_digest(body)
+        digest = digest or body_digest
+        if previous is not None and previous.get("digest") == digest:
+            return previous, False
+
+        copies = compress(body)
+        entry = {
+            "etag": f'"{body_digest[:32]}"',
+            "digest": digest,
+            "bytes": len(body),
+            "encodings": {encoding: {"file": name + ENCODINGS[encoding], "bytes": len(copy)}
+                          for encoding, copy in copies.items()},
+            "updated": datetime.now().isoformat(),
+            "generated_at": time.time()
+        }
+        with self._locked():
+            current = self.manifest.get(name)
+            if current is not None and current.get("digest") == digest and os.path.exists(path):
+                # Another process published the same content meanwhile
+                return current, False
+            for encoding, suffix in ENCODINGS.items():
+                if encoding in copies:
+                    _write_atomic(path + suffix, copies[encoding])
+                elif os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            _write_atomic(path, body)
+            self.manifest[name] = entry
+            self._save()
+        return entry, True
+
+    def touch(self, name):
+        """
+        Record that a snapshot was rebuilt with unchanged content.
+
+        Returns:
+        - The updated manifest entry, or None if the snapshot was never published
+        """
+        with self._locked():
+            entry = self.manifest.get(name)
+            if entry is None:
+                return None
+            entry = self.manifest[name] = {**entry, "generated_at": time.time()}
+            self._save()
+        return entry
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+def snapshot_directory(directory):
+    """
+    Return the snapshot directory object for a path, creating it once per process.
+
+    Parameters:
+    - directory (str): Directory holding the snapshot files
+
+    Returns:
+    - SnapshotDirectory
+    """
+    key = os.path.abspath(directory)
+    with _directories_lock:
+        snapshots = _directories.get(key)
+        if snapshots is None:
+            os.makedirs(key, exist_ok=True)
+            snapshots = SnapshotDirectory(key)
+            _directories[key] = snapshots
+        return snapshots
+
+def publish(path, data, digest=None):
+    """
+    Publish a dataset to a snapshot file path.
+
+    Parameters:
+    - path (str): Destination JSON file
+    - data: JSON-serializable dataset
+    - digest (str, optional): Precomputed identity of the content
+
+    Returns:
+    - Tuple of (manifest entry, True if files were written)
+    """
+    directory, name = os.path.split(path)
+    return snapshot_directory(directory or ".").publish(name, data, digest)
+
+def touch(path):
+    """
+    Mark a published snapshot file as freshly built without rewriting it.
+
+    Parameters:
+    - path (str): Published JSON file
+
+    Returns:
+    - The updated manifest entry, or None if the file was never published
+    """
+    directory, name = os.path.split(path)
+    return snapshot_directory(directory or ".").touch(name)
+
+def generated_at(path):
+    """
+    When the dataset in a published snapshot file was last built.
+
+    Parameters:
+    - path (str): Published JSON file
+
+    Returns:
+    - Epoch seconds, or None for a file without a manifest entry (e.g. one
+      committed to the repository or written by an older version)
+    """
+    directory, name = os.path.split(path)
+    entry = snapshot_directory(directory or ".").entry(name)
+    return entry.get("generated_at") if entry else None
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Local spatial index of every monitoring station seen by the source fetchers.
+Stations from AirNow, EPA, OpenAQ and WAQI are bucketed into a fixed
+latitude/longitude grid kept in sorted NumPy arrays. Nearest-neighbour and
+radius queries only measure distances to stations in nearby cells, so
+"which monitors are near this point or route" never needs a network round
+trip. New stations go into a small pending buffer that is merged into the
+grid once it grows, instead of rebuilding the index on every addition.
+
+Requirements:
+- numpy
+
+Install with: pip install numpy
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+# File holding every station seen so far
+STATION_FILE = "air_quality_data/stations.json"
+
+# Grid cell size in degrees (about 55 km of latitude)
+CELL_DEGREES = 0.5
+
+# New stations are merged into the grid once this many are pending
+MERGE_THRESHOLD = 256
+
+# Below this many stations a brute-force scan is faster than the grid
+BRUTE_FORCE_LIMIT = 2048
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+COLUMNS = int(round(360 / CELL_DEGREES))
+
+def haversine_km(lat, lon, lats, lons):
+    """Great-circle distance in km from one point to arrays of points."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    h = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+def _rows(lats):
+    return np.floor((np.asarray(lats) + 90) / CELL_DEGREES).astype(np.int64)
+
+def _columns(lons):
+    return np.floor((np.asarray(lons) + 180) / CELL_DEGREES).astype(np.int64) % COLUMNS
+
+def cell_keys(lats, lons):
+    """Grid cell key of every coordinate."""
+    return _rows(lats) * COLUMNS + _columns(lons)
+
+class StationIndex:
+    """
+    Grid index of station coordinates with incremental additions.
+
+    Stations are numbered in insertion order. The grid holds the station
+    numbers sorted by cell key; stations added since the last merge are kept
+    in a pending list that every query scans directly.
+    """
+
+    def __init__(self, path=STATION_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = []
+        self.positions = {}
+        self.lat = np.empty(0)
+        self.lon = np.empty(0)
+        self.sources = np.empty(0, dtype=object)
+        self.sorted_keys = np.empty(0, dtype=np.int64)
+        self.sorted_ids = np.empty(0, dtype=np.int64)
+        self.pending = []
+
+        try:
+            with open(path) as f:
+                self.add(json.load(f), save=False)
+        except (OSError, ValueError):
+            pass
+
+    def __len__(self):
+        return len(self.records)
+
+    def save(self):
+        """Atomically write the known stations to disk."""
+        with self.lock:
+            records = list(self.records)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(records, f)
+        os.replace(tmp_path, self.path)
+
+    def add(self, stations, save=True):
+        """
+        Add stations that are not in the index yet.
+
+        Parameters:
+        - stations (iterable): Dictionaries with 'station_id', 'latitude' and
+          'longitude', plus optional 'station_name' and 'source'
+        - save (bool): Persist the index if anything was added
+
+        Returns:
+        - Number of stations added
+        """
+        added = []
+        with self.lock:
+            for station in stations:
+                station_id = station["station_id"]
+                lat, lon = station.get("latitude"), station.get("longitude")
+                if station_id in self.positions or lat is None or lon is None:
+                    continue
+                lat, lon = float(lat), float(lon)
+                if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                    continue
+                self.positions[station_id] = len(self.records)
+                self.records.append({
+                    "station_id": station_id,
+                    "station_name": station.get("station_name"),
+                    "latitude": lat,
+                    "longitude": lon,
+                    "source": station.get("source")
+                })
+                added.append((lat, lon, station.get("source")))
+
+            if added:
+                lats, lons, sources = zip(*added)
+                self.pending.extend(range(len(self.lat), len(self.lat) + len(added)))
+                self.lat = np.concatenate([self.lat, lats])
+                self.lon = np.concatenate([self.lon, lons])
+                self.sources = np.concatenate([self.sources, np.array(sources, dtype=object)])
+                if len(self.pending) >= MERGE_THRESHOLD:
+                    self._merge()
+
+        if added and save:
+            self.save()
+        return len(added)
+
+    def get(self, station_id):
+        """Return the record of a known station, or None."""
+        with self.lock:
+            position = self.positions.get(station_id)
+            return dict(self.records[position]) if position is not None else None
+
+    def add_measurements(self, measurements):
+        """
+        Add the stations of a canonical measurement frame.
+
+        Parameters:
+        - measurements (DataFrame): Rows with station_id, station_name,
+          latitude, longitude and source
+
+        Returns:
+        - Number of stations added
+        """
+        if measurements is None or measurements.empty:
+            return 0
+        columns = ["station_id", "station_name", "latitude", "longitude", "source"]
+        unique = measurements[columns].dropna(subset=["latitude", "longitude"]).drop_duplicates("station_id")
+        unique = unique[~unique["station_id"].isin(self.positions)]
+        return self.add(unique.to_dict("records"))
+
+    def _merge(self):
+        """Fold pending stations into the sorted grid arrays (caller holds the lock)."""
+        new_ids = np.array(self.pending, dtype=np.int64)
+        keys = np.concatenate([self.sorted_keys, cell_keys(self.lat[new_ids], self.lon[new_ids])])
+        ids = np.concatenate([self.sorted_ids, new_ids])
+        order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[order]
+        self.sorted_ids = ids[order]
+        self.pending = []
+
+    def _candidates(self, lat, lon, radius_km):
+        """Station numbers in the grid cells overlapping a circle, plus pending stations."""
+        lat_span = radius_km / KM_PER_DEGREE
+        lat_lo, lat_hi = max(lat - lat_span, -90.0), min(lat + lat_span, 90.0)
+        widest = max(abs(lat_lo), abs(lat_hi))
+        if widest >= 89.0 or len(self.lat) <= BRUTE_FORCE_LIMIT:
+            return np.arange(len(self.lat))
+
+        lon_span = lat_span / np.cos(np.radians(widest))
+        if lon_span >= 180:
+            return np.arange(len(self.lat))
+
+        rows = np.arange(_rows(lat_lo), _rows(lat_hi) + 1)
+        first, count = _columns(lon - lon_span), int(np.ceil(2 * lon_span / CELL_DEGREES)) + 2
+        columns = (first + np.arange(min(count, COLUMNS))) % COLUMNS
+        keys = (rows[:, None] * COLUMNS + columns[None, :]).ravel()
+
+        starts = np.searchsorted(self.sorted_keys, keys, side="left")
+        ends = np.searchsorted(self.sorted_keys, keys, side="right")
+        hits = [self.sorted_ids[s:e] for s, e in zip(starts, ends) if e > s]
+        return np.concatenate(hits + [np.array(self.pending, dtype=np.int64)])
+
+    def _select(self, candidates, lat, lon, source):
+        if source is not None and len(candidates):
+            candidates = candidates[self.sources[candidates] == source]
+        return candidates, haversine_km(lat, lon, self.lat[candidates], self.lon[candidates])
+
+    def within(self, lat, lon, radius_km, source=None):
+        """
+        Find every station within a radius.
+
+        Parameters:
+        - lat (float): Latitude of the query point
+        - lon (float): Longitude of the query point
+        - radius_km (float): Search radius in km
+        - source (str, optional): Only return stations of this source
+
+        Returns:
+        - List of station dictionaries with 'distance_km', nearest first
+        """
+        with self.lock:
+            candidates, distances = self._select(self._candidates(lat, lon, radius_km), lat, lon, source)
+            inside = distances <= radius_km
+            return self._records(candidates[inside], distances[inside])
+
+    def nearest(self, lat, lon, k=5, source=None, max_distance_km=None):
+        """
+        Find the k stations closest to a point.
+
+        The search radius starts at one grid cell and doubles until k
+        stations are found inside it, so only nearby cells are measured.
+
+        Parameters:
+        - lat (float): Latitude of the query point
+        - lon (float): Longitude of the query point
+        - k (int): Number of stations to return
+        - source (str, optional): Only return stations of this source
+        - max_distance_km (float, optional): Ignore stations further away
+
+        Returns:
+        - List of up to k station dictionaries with 'distance_km', nearest first
+        """
+        limit = max_distance_km if max_distance_km is not None else np.pi * EARTH_RADIUS_KM
+        with self.lock:
+            # Small indexes are scanned in one pass anyway, so search the whole limit at once
+            radius = limit if len(self.lat) <= BRUTE_FORCE_LIMIT else CELL_DEGREES * KM_PER_DEGREE
+            while True:
+                search = min(radius, limit)
+                candidates, distances = self._select(self._candidates(lat, lon, search), lat, lon, source)
+                inside = distances <= search
+                if inside.sum() >= k or search >= limit:
+                    break
+                radius *= 2
+
+            candidates, distances = candidates[inside], distances[inside]
+            if len(candidates) > k:
+                best = np.argpartition(distances, k - 1)[:k]
+                candidates, distances = candidates[best], distances[best]
+            return self._records(candidates, distances)
+
+    def near_path(self, points, radius_km, source=None):
+        """
+        Find the stations within a radius of any point along a path.
+
+        Parameters:
+        - points (list): (latitude, longitude) pairs along the path
+        - radius_km (float): Distance from the path in km
+        - source (str, optional): Only return stations of this source
+
+        Returns:
+        - List of station dictionaries with the distance to the closest point, nearest first
+        """
+        closest = {}
+        for lat, lon in points:
+            for station in self.within(lat, lon, radius_km, source):
+                seen = closest.get(station["station_id"])
+                if seen is None or station["distance_km"] < seen["distance_km"]:
+                    closest[station["station_id"]] = station
+        return sorted(closest.values(), key=lambda s: s["distance_km"])
+
+    def _records(self, candidates, distances):
+        order = np.argsort(distances, kind="stable")
+        return [{**self.records[i], "distance_km": round(float(d), 3)}
+                for i, d in zip(candidates[order].tolist(), distances[order].tolist())]
+
+# Index shared by every fetcher in this process
+stations = StationIndex()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Columnar measurement store shared by the air quality source fetchers.
+Measurements from every source are appended to one Parquet dataset,
+partitioned by source, parameter and date, with typed columns and zstd
+compression. Queries prune partitions and push filters down to the
+Parquet readers, so only the files and row groups that match are read.
+
+Requirements:
+- numpy
+- pandas
+- pyarrow
+
+Install with: pip install numpy pandas pyarrow
+"""
+
+import os
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Root directory of the measurement dataset
+STORE_DIR = "air_quality_data/measurements"
+
+# Canonical measurement columns, in storage order
+MEASUREMENT_SCHEMA = pa.schema([
+    ("station_id", pa.string()),
+    ("station_name", pa.string()),
+    ("latitude", pa.float64()),
+    ("longitude", pa.float64()),
+    ("unit", pa.string()),
+    ("timestamp", pa.timestamp("ms", tz="UTC")),
+    ("value", pa.float32()),
+    ("aqi", pa.float32()),
+    ("source", pa.string()),
+    ("parameter", pa.string()),
+    ("date", pa.string())
+])
+
+# Directory layout: source=<source>/parameter=<parameter>/date=<YYYY-MM-DD>
+PARTITIONING = ds.partitioning(
+    pa.schema([
+        ("source", pa.string()),
+        ("parameter", pa.string()),
+        ("date", pa.string())
+    ]),
+    flavor="hive"
+)
+
+PARQUET_OPTIONS = ds.ParquetFileFormat().make_write_options(compression="zstd")
+
+def _to_table(df):
+    """Coerce a DataFrame of canonical measurement columns into an Arrow table."""
+    df = df.reindex(columns=[f.name for f in MEASUREMENT_SCHEMA if f.name != "date"])
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
+    df = df.dropna(subset=["timestamp", "source", "parameter"])
+    df["date"] = df["timestamp"].dt.strftime("%Y-%m-%d")
+    return pa.Table.from_pandas(df, schema=MEASUREMENT_SCHEMA, preserve_index=False)
+
+def _day(value):
+    """Format a date, datetime or date string as a YYYY-MM-DD partition value."""
+    if isinstance(value, str):
+        return value[:10]
+    return value.strftime("%Y-%m-%d")
+
+def _utc(value):
+    """Convert a date, datetime or ISO string into a timezone-aware UTC timestamp."""
+    ts = pd.Timestamp(value)
+    return ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+
+class MeasurementStore:
+    """
+    Append-only Parquet dataset of canonical measurements.
+
+    Each append writes new files into the partitions it touches, so
+    concurrent writers never rewrite each other's files. compact() merges
+    the small files of every partition; the refresh run calls it once its
+    sources are done.
+    """
+
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        # Rewrites of a partition (delete, compact) must not interleave, or
+        # one would bring back rows the other removed
+        self.delete_lock = threading.Lock()
+
+    def append(self, df):
+        """
+        Append measurements to the dataset.
+
+        Parameters:
+        - df (DataFrame): Rows with the canonical measurement columns
+          (station_id, station_name, latitude, longitude, unit, timestamp,
+          value, aqi, source, parameter); missing columns are stored as null
+
+        Returns:
+        - Number of rows written
+        """
+        if df is None or df.empty:
+            return 0
+
+        table = _to_table(df)
+        if table.num_rows == 0:
+            return 0
+
+        os.makedirs(self.root, exist_ok=True)
+        ds.write_dataset(
+            table,
+            self.root,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_options=PARQUET_OPTIONS
+        )
+        return table.num_rows
+
+    def dataset(self):
+        """Return the underlying pyarrow dataset, or None if nothing is stored yet."""
+        if not os.path.isdir(self.root):
+            return None
+        return ds.dataset(self.root, format="parquet", partitioning=PARTITIONING,
+                          schema=MEASUREMENT_SCHEMA)
+
+    def query(self, source=None, parameter=None, start=None, end=None,
+              station_id=None, columns=None):
+        """
+        Read measurements matching the given filters.
+
+        Source, parameter and the date range prune whole partitions; the
+        timestamp and station filters are pushed down to the Parquet readers.
+
+        Parameters:
+        - source (str or list, optional): Source name(s), e.g. 'openaq'
+        - parameter (str or list, optional): Parameter name(s), e.g. 'pm25'
+        - start (datetime or str, optional): Inclusive start time
+        - end (datetime or str, optional): Exclusive end time
+        - station_id (str or list, optional): Station id(s)
+        - columns (list, optional): Columns to return (default: all)
+
+        Returns:
+        - DataFrame of matching measurements (empty if none)
+        """
+        dataset = self.dataset()
+        if dataset is None:
+            return pd.DataFrame(columns=columns or MEASUREMENT_SCHEMA.names)
+
+        expression = None
+
+        def add(condition):
+            nonlocal expression
+            expression = condition if expression is None else expression & condition
+
+        for name, value in (("source", source), ("parameter", parameter),
+                            ("station_id", station_id)):
+            if value is None:
+                continue
+            if isinstance(value, str):
+                add(ds.field(name) == value)
+            else:
+                add(ds.field(name).isin(list(value)))
+
+        if start is not None:
+            add(ds.field("date") >= _day(start))
+            add(ds.field("timestamp") >= pa.scalar(_utc(start), MEASUREMENT_SCHEMA.field("timestamp").type))
+        if end is not None:
+            add(ds.field("date") <= _day(end))
+            add(ds.field("timestamp") < pa.scalar(_utc(end), MEASUREMENT_SCHEMA.field("timestamp").type))
+
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+    def partitions(self):
+        """List the (source, parameter, date) partitions that hold data."""
+        dataset = self.dataset()
+        if dataset is None:
+            return []
+        found = set()
+        for fragment in dataset.get_fragments():
+            keys = ds.get_partition_keys(fragment.partition_expression)
+            found.add((keys.get("source"), keys.get("parameter"), keys.get("date")))
+        return sorted(found)
+
+    def delete(self, source, parameter, ranges):
+        """
+        Remove the readings of stations within time ranges.
+
+        Only the partitions of the days the ranges touch are rewritten.
+
+        Parameters:
+        - source (str): Source of the readings
+        - parameter (str): Parameter of the readings
+        - ranges (list): (station_id, start, end) tuples; readings of the
+          station with start <= timestamp < end are removed
+
+        Returns:
+        - DataFrame of the removed rows, with the canonical measurement columns
+        """
+        by_day = {}
+        for station_id, start, end in ranges:
+            start, end = _utc(start), _utc(end)
+            for day in {_day(start), _day(end - pd.Timedelta(milliseconds=1))}:
+                by_day.setdefault(day, []).append((station_id, start, end))
+
+        removed = []
+        for day, day_ranges in sorted(by_day.items()):
+            directory = os.path.join(self.root, f"source={source}", f"parameter={parameter}", f"date={day}")
+            with self.delete_lock:
+                if not os.path.isdir(directory):
+                    continue
+                paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                         if name.endswith(".parquet") and not name.startswith("_")]
+                if not paths:
+                    continue
+                table = ds.dataset(paths, format="parquet").to_table()
+                frame = table.select(["station_id", "timestamp"]).to_pandas()
+                timestamps = pd.to_datetime(frame["timestamp"], utc=True)
+                drop = np.zeros(len(frame), dtype=bool)
+                for station_id, start, end in day_ranges:
+                    drop |= ((frame["station_id"] == station_id) & (timestamps >= start) & (timestamps < end)).to_numpy()
+                if not drop.any():
+                    continue
+
+                name = uuid.uuid4().hex
+                kept = table.filter(pa.array(~drop))
+                if kept.num_rows:
+                    # Leading underscore keeps the partial file out of dataset discovery
+                    tmp_path = os.path.join(directory, f"_{name}.tmp")
+                    pq.write_table(kept, tmp_path, compression="zstd")
+                    os.replace(tmp_path, os.path.join(directory, f"part-{name}-0.parquet"))
+                for path in paths:
+                    os.remove(path)
+
+            rows = table.filter(pa.array(drop)).to_pandas()
+            # Partition columns live in the directory names, not in the files
+            rows["source"], rows["parameter"], rows["date"] = source, parameter, day
+            removed.append(rows)
+
+        if not removed:
+            return pd.DataFrame(columns=MEASUREMENT_SCHEMA.names)
+        return pd.concat(removed, ignore_index=True)
+
+    def compact(self, source=None):
+        """
+        Merge the files of each partition into a single file.
+
+        Every partition is rewritten under delete_lock, with its files
+        listed again inside the lock, so a concurrent delete() can neither
+        bring back the rows it removed nor lose the file it wrote. Files
+        appended meanwhile are left for the next compaction.
+
+        Parameters:
+        - source (str, optional): Only compact partitions of this source
+
+        Returns:
+        - Number of partitions rewritten
+        """
+        dataset = self.dataset()
+        if dataset is None:
+            return 0
+
+        directories = set()
+        for fragment in dataset.get_fragments():
+            keys = ds.get_partition_keys(fragment.partition_expression)
+            if source is None or keys.get("source") == source:
+                directories.add(os.path.dirname(fragment.path))
+
+        rewritten = 0
+        for directory in sorted(directories):
+            with self.delete_lock:
+                if not os.path.isdir(directory):
+                    continue
+                paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                         if name.endswith(".parquet") and not name.startswith("_")]
+                if len(paths) < 2:
+                    continue
+                table = ds.dataset(paths, format="parquet").to_table()
+                name = uuid.uuid4().hex
+                # Leading underscore keeps the partial file out of dataset discovery
+                tmp_path = os.path.join(directory, f"_{name}.tmp")
+                pq.write_table(table, tmp_path, compression="zstd")
+                os.replace(tmp_path, os.path.join(directory, f"part-{name}-0.parquet"))
+                for path in paths:
+                    os.remove(path)
+            rewritten += 1
+        return rewritten
+
+# Store shared by every fetcher in this process
+store = MeasurementStore()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Per-source watermarks for incremental fetching.
+Each source keeps the newest measurement time it has stored for every
+(station, parameter) pair, plus the ETag, Last-Modified and body digest of
+every request it makes. Fetchers use them to ask only for newer data, send
+conditional requests, and skip parsing and writes when nothing changed.
+
+The validators of a response with new content are only kept once its data
+has been stored (see commit), so a batch whose ingest failed or was cut
+short is fetched and parsed again on the next run instead of being skipped
+as unchanged.
+
+Several processes may refresh the same source. save() re-reads the file
+under an exclusive file lock and merges it with this process's state
+(newest watermark wins, validators this process updated win), so neither
+process loses the other's progress. On platforms without fcntl (Windows)
+the last writer wins.
+
+Requirements:
+- pandas
+
+Install with: pip install pandas
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from metrics import metrics
+
+# Directory holding one watermark file per source
+WATERMARK_DIR = "air_quality_data/watermarks"
+
+class WatermarkStore:
+    """Persisted watermarks and response validators of one source."""
+
+    def __init__(self, source, directory=WATERMARK_DIR):
+        self.source = source
+        self.path = os.path.join(directory, f"{source}.json")
+        self.lock = threading.Lock()
+        state = self._load()
+        self.marks = state.get("marks", {})
+        self.validators = state.get("validators", {})
+        # Validators of changed responses whose data has not been stored yet
+        self.pending = {}
+        # Request keys whose validators changed since the last save
+        self.updated = set()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """
+        Merge the watermarks with the file on disk and write them back atomically.
+
+        The file is re-read under an exclusive lock: every key keeps the
+        newer of the two watermarks, and validators this process updated
+        since its last save replace those on disk. Entries written by other
+        processes are picked up in memory as well.
+        """
+        import pandas as pd
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                disk = self._load()
+                with self.lock:
+                    marks = dict(disk.get("marks", {}))
+                    for key, mark in self.marks.items():
+                        if key not in marks or pd.Timestamp(mark) > pd.Timestamp(marks[key]):
+                            marks[key] = mark
+                    validators = dict(disk.get("validators", {}))
+                    for key, seen in self.validators.items():
+                        if key in self.updated or key not in validators:
+                            validators[key] = seen
+                    self.marks, self.validators = marks, validators
+                    self.updated = set()
+                    state = {"marks": dict(marks), "validators": dict(validators)}
+                tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(state, f, indent=2)
+                os.replace(tmp_path, self.path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key):
+        """
+        Return the watermark for a key.
+
+        Parameters:
+        - key (str): "<station_id>|<parameter>", or any query key
+
+        Returns:
+        - UTC pandas Timestamp of the newest stored measurement, or None
+        """
+        import pandas as pd
+
+        mark = self.marks.get(key)
+        return pd.Timestamp(mark) if mark else None
+
+    def advance(self, key, timestamp):
+        """Move a key's watermark forward to timestamp (never backwards)."""
+        import pandas as pd
+
+        timestamp = pd.Timestamp(timestamp)
+        timestamp = timestamp.tz_localize("UTC") if timestamp.tzinfo is None else timestamp.tz_convert("UTC")
+        with self.lock:
+            current = self.marks.get(key)
+            if current is None or timestamp > pd.Timestamp(current):
+                self.marks[key] = timestamp.isoformat()
+
+    def conditional_headers(self, request_key):
+        """
+        Build If-None-Match / If-Modified-Since headers for a request.
+
+        Parameters:
+        - request_key (str): Stable identifier of the request (URL plus parameters)
+
+        Returns:
+        - Dictionary of headers (empty for a request never seen before)
+        """
+        seen = self.validators.get(request_key, {})
+        headers = {}
+        if seen.get("etag"):
+            headers["If-None-Match"] = seen["etag"]
+        if seen.get("last_modified"):
+            headers["If-Modified-Since"] = seen["last_modified"]
+        return headers
+
+    def check_response(self, request_key, response):
+        """
+        Check whether a response carries new content.
+
+        A response is unchanged if the server answered 304 Not Modified or
+        the body is byte-identical to the last stored response for the same
+        request; its validators are then updated straight away. The
+        validators of a changed response are held back until commit() is
+        called with its request key, after its data has been stored.
+
+        Parameters:
+        - request_key (str): Identifier passed to conditional_headers
+        - response (requests.Response): The response to check
+
+        Returns:
+        - True if the response should be parsed, False if it is unchanged
+        """
+        if response.status_code == 304:
+            metrics.increment("air_quality_responses_total", source=self.source, result="unchanged")
+            return False
+
+        digest = hashlib.sha1(response.content).hexdigest()
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "digest": digest
+        }
+        with self.lock:
+            changed = self.validators.get(request_key, {}).get("digest") != digest
+            if changed:
+                self.pending[request_key] = validators
+            else:
+                self.validators[request_key] = validators
+                self.updated.add(request_key)
+                self.pending.pop(request_key, None)
+        metrics.increment("air_quality_responses_total", source=self.source,
+                          result="changed" if changed else "unchanged")
+        return changed
+
+    def filter_new(self, measurements):
+        """
+        Drop measurements at or before their (station, parameter) watermark.
+
+        Parameters:
+        - measurements (DataFrame): Canonical measurement columns
+
+        Returns:
+        - DataFrame with only the newer rows
+        """
+        import pandas as pd
+
+        if measurements is None or measurements.empty or not self.marks:
+            return measurements
+        keys = measurements["station_id"].astype(str) + "|" + measurements["parameter"].astype(str)
+        marks = pd.to_datetime(keys.map(self.marks), utc=True)
+        timestamps = pd.to_datetime(measurements["timestamp"], utc=True)
+        return measurements[marks.isna() | (timestamps > marks)]
+
+    def commit(self, measurements, request_keys=()):
+        """
+        Advance watermarks to the newest stored measurement of every
+        (station, parameter) pair, keep the validators of the responses the
+        measurements came from, and save them.
+
+        Call only after the measurements have been stored.
+
+        Parameters:
+        - measurements (DataFrame): Canonical measurements that were stored
+        - request_keys (iterable): Keys passed to check_response for the
+          responses whose data was stored
+        """
+        import pandas as pd
+
+        with self.lock:
+            for request_key in request_keys:
+                validators = self.pending.pop(request_key, None)
+                if validators is not None:
+                    self.validators[request_key] = validators
+                    self.updated.add(request_key)
+
+        if measurements is not None and not measurements.empty:
+            keys = measurements["station_id"].astype(str) + "|" + measurements["parameter"].astype(str)
+            newest = pd.to_datetime(measurements["timestamp"], utc=True).groupby(keys).max()
+            for key, timestamp in newest.items():
+                if pd.notna(timestamp):
+                    self.advance(key, timestamp)
+        self.save()
@@ -0,0 +1,18 @@
+"""
+Shared pytest setup for the Python pipeline tests.
+The helper modules in script/ are imported as plain modules, the same way
+the entry points import them.
+
+Usage:
+    python -m pytest -q
+"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_DIR = os.path.join(ROOT_DIR, "script")
+
+for path in (ROOT_DIR, SCRIPT_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
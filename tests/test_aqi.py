@@ -0,0 +1,93 @@
+"""Breakpoint lookups and NowCast of the AQI engine in aqi.py."""
+
+import numpy as np
+import pytest
+
+from aqi import categorize, category_names, compute_aqi, nowcast, rolling_mean, rolling_nowcast, sub_index
+
+@pytest.mark.parametrize("pollutant, concentration, expected", [
+    ("pm25", 0.0, 0),
+    ("pm25", 9.0, 50),
+    ("pm25", 9.1, 51),
+    ("pm25", 12.0, 56),
+    ("pm25", 35.4, 100),
+    ("pm25", 35.49, 100),  # Truncated to 35.4 before the lookup
+    ("pm25", 35.5, 101),
+    ("pm25", 225.4, 300),
+    ("pm10", 54, 50),
+    ("pm10", 155, 101),
+    ("o3_8h", 0.070, 100),
+    ("o3", 0.0705, 100),
+    ("o3_1h", 0.125, 101),
+    ("co", 9.5, 101),
+    ("so2", 75, 100),
+    ("no2", 101, 101)
+])
+def test_sub_index_at_breakpoints(pollutant, concentration, expected):
+    assert sub_index(pollutant, [concentration])[0] == expected
+
+def test_sub_index_extrapolates_only_where_allowed():
+    # PM2.5 above 325.4 continues the top band's line
+    assert sub_index("pm25", [425.3])[0] == 699
+    # 8-hour ozone has no band above 0.200 ppm
+    assert np.isnan(sub_index("o3_8h", [0.201])[0])
+
+def test_sub_index_rejects_missing_and_out_of_table_values():
+    values = sub_index("pm25", [np.nan, -1.0, 20.0])
+    assert np.isnan(values[0]) and np.isnan(values[1]) and not np.isnan(values[2])
+    # The 1-hour ozone table starts at 0.125 ppm
+    assert np.isnan(sub_index("o3_1h", [0.1])[0])
+
+def test_compute_aqi_takes_the_highest_sub_index():
+    result = compute_aqi({
+        "pm25": np.array([12.0, 60.0, np.nan]),
+        "o3_8h": np.array([0.080, 0.030, np.nan]),
+        "o3_1h": np.array([0.170, np.nan, np.nan])
+    })
+    assert result["sub_indices"]["o3"][0] == 157  # 1-hour ozone beats the 8-hour value
+    assert result["aqi"][0] == 157 and result["dominant"][0] == "o3"
+    assert result["aqi"][1] == 154 and result["dominant"][1] == "pm25"
+    assert np.isnan(result["aqi"][2]) and result["dominant"][2] is None
+    assert category_names(result["category"]).tolist() == ["Unhealthy", "Unhealthy", None]
+
+def test_categorize_band_edges():
+    assert categorize([0, 50, 51, 100, 101, 300, 301, 600, np.nan]).tolist() == [0, 0, 1, 1, 2, 4, 5, 5, -1]
+
+def test_nowcast_of_a_constant_series_is_the_constant():
+    assert nowcast(np.full(12, 23.0))[()] == pytest.approx(23.0)
+
+def test_nowcast_weights_recent_hours():
+    hourly = np.full(12, np.nan)
+    hourly[-3:] = [10.0, 20.0, 30.0]
+    # Weight 1 - (30 - 10) / 30 is raised to the 0.5 minimum
+    expected = (30 + 0.5 * 20 + 0.25 * 10) / (1 + 0.5 + 0.25)
+    assert nowcast(hourly)[()] == pytest.approx(expected)
+
+def test_nowcast_uses_the_weight_factor_above_the_minimum():
+    hourly = np.arange(1.0, 13.0) + 40  # 41 (oldest) .. 52 (newest)
+    weight = 1 - (52 - 41) / 52
+    powers = weight ** np.arange(12)
+    expected = (powers * hourly[::-1]).sum() / powers.sum()
+    assert nowcast(hourly)[()] == pytest.approx(expected)
+
+def test_nowcast_needs_two_of_the_three_latest_hours():
+    hourly = np.full(12, 15.0)
+    hourly[-1] = hourly[-2] = np.nan
+    assert np.isnan(nowcast(hourly)[()])
+    hourly[-2] = 15.0
+    assert nowcast(hourly)[()] == pytest.approx(15.0)
+
+def test_rolling_nowcast_is_aligned_with_the_latest_hour():
+    series = np.random.default_rng(7).uniform(5, 80, size=40)
+    result = rolling_nowcast(series)
+    assert np.isnan(result[:11]).all()
+    for hour in (11, 20, 39):
+        assert result[hour] == pytest.approx(nowcast(series[hour - 11:hour + 1])[()])
+
+def test_rolling_mean_requires_min_periods():
+    series = np.arange(10, dtype=np.float64)
+    series[3] = np.nan
+    means = rolling_mean(series, window=8, min_periods=6)
+    assert np.isnan(means[:5]).all()  # At most 5 valid hours so far
+    assert means[6] == pytest.approx(np.nanmean(series[:7]))
+    assert means[9] == pytest.approx(np.nanmean(series[2:10]))
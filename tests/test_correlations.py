@@ -0,0 +1,86 @@
+"""Parallel co-moment updates of correlations.py against numpy."""
+
+import numpy as np
+import pytest
+
+from correlations import Accumulators, batch_moments, describe, merge_moments, remove_moments
+
+def reference(x, y):
+    """Accumulators of one sample computed directly with numpy."""
+    return np.array([len(x), x.mean(), y.mean(), ((x - x.mean()) ** 2).sum(),
+                     ((y - y.mean()) ** 2).sum(), ((x - x.mean()) * (y - y.mean())).sum()])
+
+def moments_of(x, y):
+    _, moments = batch_moments(np.zeros(len(x), dtype=np.int64), x, y)
+    return moments
+
+@pytest.fixture
+def sample():
+    rng = np.random.default_rng(17)
+    x = rng.normal(25, 6, 500)
+    # Large offsets make a naive sum-of-squares update lose precision
+    y = 1e4 + 0.8 * x + rng.normal(0, 3, 500)
+    return x, y
+
+def test_batch_moments_groups_by_key(sample):
+    x, y = sample
+    keys = np.arange(len(x)) % 3
+    unique, moments = batch_moments(keys, x, y)
+    assert unique.tolist() == [0, 1, 2]
+    for key in unique:
+        assert moments[key] == pytest.approx(reference(x[keys == key], y[keys == key]))
+
+@pytest.mark.parametrize("split", [1, 7, 250, 499])
+def test_merge_matches_one_pass(sample, split):
+    x, y = sample
+    merged = merge_moments(moments_of(x[:split], y[:split]), moments_of(x[split:], y[split:]))
+    assert merged[0] == pytest.approx(reference(x, y), rel=1e-9)
+
+def test_merge_with_empty_is_identity(sample):
+    x, y = sample
+    moments = moments_of(x, y)
+    assert merge_moments(np.zeros((1, 6)), moments)[0] == pytest.approx(moments[0])
+    assert merge_moments(moments, np.zeros((1, 6)))[0] == pytest.approx(moments[0])
+
+def test_many_small_merges_match_numpy(sample):
+    x, y = sample
+    total = np.zeros((1, 6))
+    for start in range(0, len(x), 13):
+        total = merge_moments(total, moments_of(x[start:start + 13], y[start:start + 13]))
+    assert total[0] == pytest.approx(reference(x, y), rel=1e-9)
+
+@pytest.mark.parametrize("split", [1, 100, 498])
+def test_remove_undoes_merge(sample, split):
+    x, y = sample
+    total = moments_of(x, y)
+    rest = remove_moments(total, moments_of(x[split:], y[split:]))
+    assert rest[0] == pytest.approx(reference(x[:split], y[:split]), rel=1e-6, abs=1e-6)
+
+def test_removing_everything_leaves_zeros(sample):
+    x, y = sample
+    total = moments_of(x, y)
+    assert remove_moments(total, total)[0].tolist() == [0.0] * 6
+
+def test_accumulators_subtract_ignores_unknown_keys(sample):
+    x, y = sample
+    accumulators = Accumulators()
+    accumulators.add(*batch_moments(np.arange(len(x)) % 2, x, y))
+    accumulators.subtract(np.array([1, 5]), np.vstack([moments_of(x[1::2][:10], y[1::2][:10]),
+                                                       moments_of(x[:3], y[:3])]))
+    assert len(accumulators) == 2
+    assert accumulators.moments[0] == pytest.approx(reference(x[::2], y[::2]))
+    assert accumulators.moments[1] == pytest.approx(reference(x[1::2][10:], y[1::2][10:]), rel=1e-6)
+
+def test_describe_matches_numpy(sample):
+    x, y = sample
+    result = describe(moments_of(x, y)[0])
+    slope, intercept = np.polyfit(x, y, 1)
+    assert result["n"] == len(x)
+    assert result["r"] == pytest.approx(np.corrcoef(x, y)[0, 1], abs=1e-4)
+    assert result["slope"] == pytest.approx(slope, abs=1e-4)
+    assert result["intercept"] == pytest.approx(intercept, abs=1e-4)
+
+def test_describe_needs_two_varying_observations():
+    assert describe(np.array([1, 5.0, 2.0, 0, 0, 0]))["r"] is None
+    constant = describe(np.array([3, 5.0, 2.0, 0, 4.0, 0]))
+    assert constant["n"] == 3 and constant["slope"] is None
@@ -0,0 +1,71 @@
+"""Lag window and horizon alignment of the ridge models in forecast.py."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from forecast import HORIZON, LAGS, ForecastEngine, fit_station
+
+START = pd.Timestamp("2026-09-01T00:00:00Z")
+
+def trend(hours, slope=0.5, offset=40.0):
+    """Hourly series rising by slope per hour: every horizon is last value + slope * k."""
+    index = pd.date_range(START, periods=hours, freq="h")
+    return pd.Series(offset + slope * np.arange(hours), index=index)
+
+@pytest.fixture
+def engine(tmp_path):
+    return ForecastEngine(path=str(tmp_path / "models.npz"))
+
+def test_fit_station_needs_enough_windows():
+    series = trend(LAGS + HORIZON + 10)
+    assert fit_station(series.to_numpy(), series.index.hour.to_numpy()) is None
+
+def test_forecast_continues_the_series_from_the_hour_after_the_last(engine):
+    history = trend(300)
+    assert engine.train(pd.DataFrame({"up": history, "down": 400 - history})) == 2
+
+    recent = trend(300 + 40).iloc[-30:]
+    last = recent.index[-1]
+    forecast = engine.predict(pd.DataFrame({"up": recent, "down": 400 - recent}), now=last + pd.Timedelta(minutes=70))
+    assert forecast.index[0] == last + pd.Timedelta(hours=1)
+    assert len(forecast) == HORIZON
+
+    steps = np.arange(1, HORIZON + 1)
+    assert forecast["up"].to_numpy() == pytest.approx(recent.iloc[-1] + 0.5 * steps, abs=0.05)
+    assert forecast["down"].to_numpy() == pytest.approx(400 - recent.iloc[-1] - 0.5 * steps, abs=0.05)
+
+def test_forecast_uses_the_latest_lag_window(engine):
+    history = trend(300)
+    engine.train(pd.DataFrame({"up": history}))
+    recent = trend(330)
+    # A window shifted by one hour would be one step behind the series
+    now = recent.index[-1] + pd.Timedelta(minutes=30)
+    first = engine.predict(pd.DataFrame({"up": recent.iloc[:-1]}), now=now)["up"]
+    second = engine.predict(pd.DataFrame({"up": recent}), now=now)["up"]
+    assert first.index[0] == second.index[0] - pd.Timedelta(hours=1)
+    first, second = first.iloc[0], second.iloc[0]
+    assert first == pytest.approx(recent.iloc[-1], abs=0.05)
+    assert second == pytest.approx(recent.iloc[-1] + 0.5, abs=0.05)
+
+def test_station_with_a_long_gap_in_its_window_is_left_out(engine):
+    history = trend(300)
+    engine.train(pd.DataFrame({"a": history, "b": history}))
+    recent = pd.DataFrame({"a": trend(330), "b": trend(330)}).iloc[-LAGS:]
+    recent.iloc[5:5 + 6, 1] = np.nan  # Longer than the gaps that are filled
+    assert engine.predict(recent, now=recent.index[-1]).columns.tolist() == ["a"]
+
+def test_forecast_after_a_gap_starts_at_the_current_hour(engine):
+    engine.train(pd.DataFrame({"up": trend(300)}))
+    recent = pd.DataFrame({"up": trend(330)})
+    last = recent.index[-1]
+    full = engine.predict(recent, now=last)
+
+    # Ingestion stopped five hours ago: the steps up to now are in the past
+    late = engine.predict(recent, now=last + pd.Timedelta(hours=5, minutes=20))
+    assert late.index[0] == last + pd.Timedelta(hours=5)
+    assert len(late) == HORIZON - 4
+    assert late["up"].to_numpy() == pytest.approx(full["up"].to_numpy()[4:])
+
+    # Nothing is left once the newest observation is a whole horizon old
+    assert engine.predict(recent, now=last + pd.Timedelta(hours=HORIZON + 1)).empty
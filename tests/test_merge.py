@@ -0,0 +1,109 @@
+"""Site resolution and cross-source deduplication of merge.MergeIndex."""
+
+import pandas as pd
+import pytest
+
+import merge
+from merge import MergeIndex, name_words
+from spatial import StationIndex
+
+HOUR = pd.Timestamp("2026-10-18T06:00:00Z")
+
+def station(station_id, source, lat, lon, name=None):
+    return {"station_id": station_id, "station_name": name, "latitude": lat, "longitude": lon, "source": source}
+
+def readings(*rows):
+    """Measurement frame of (station dict, parameter, timestamp, value[, unit]) rows."""
+    return pd.DataFrame([{**s, "parameter": parameter, "timestamp": timestamp.isoformat(), "value": value,
+                          "unit": unit[0] if unit else "µg/m³"}
+                         for s, parameter, timestamp, value, *unit in rows])
+
+EPA = station("epa:1", "epa", 27.7000, 85.3000, "Ratnapark Kathmandu")
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    stations = StationIndex(path=str(tmp_path / "stations.json"))
+    stations.add([EPA], save=False)
+    monkeypatch.setattr(merge, "stations", stations)
+    return MergeIndex(path=str(tmp_path / "merge_index.npz"))
+
+def test_name_words_skip_generic_words():
+    assert name_words("Ratnapark Air Quality Station, Kathmandu") == {"ratnapark", "kathmandu"}
+    assert name_words(None) == set()
+
+@pytest.mark.parametrize("other, site", [
+    # Another source within MATCH_RADIUS_KM, whatever its name
+    (station("openaq:9", "openaq", 27.7010, 85.3000, "Some Monitor"), "epa:1"),
+    # Within NAME_MATCH_RADIUS_KM with a shared distinctive word
+    (station("waqi:3", "waqi", 27.7100, 85.3000, "Ratnapark, Nepal"), "epa:1"),
+    # Within NAME_MATCH_RADIUS_KM but a different name
+    (station("waqi:4", "waqi", 27.7100, 85.3000, "Balaju"), "waqi:4"),
+    # Same name, but further than NAME_MATCH_RADIUS_KM
+    (station("waqi:5", "waqi", 27.7300, 85.3000, "Ratnapark"), "waqi:5"),
+    # The same source never merges with itself
+    (station("epa:2", "epa", 27.7001, 85.3000, "Ratnapark"), "epa:2"),
+    # Without coordinates there is nothing to match
+    (station("airnow:7", "airnow", None, None, "Ratnapark"), "airnow:7")
+])
+def test_resolve(index, other, site):
+    with index.lock:
+        assert index.resolve(other) == site
+
+def test_sites_are_remembered_and_chained(index):
+    near = station("openaq:9", "openaq", 27.7010, 85.3000, "Some Monitor")
+    with index.lock:
+        assert index.site_ids(readings((near, "pm25", HOUR, 1.0))).tolist() == ["epa:1"]
+    merge.stations.add([near], save=False)
+    # Too far from the EPA station itself, but next to the OpenAQ one on its site
+    chained = station("waqi:8", "waqi", 27.7035, 85.3000, "Another Name")
+    with index.lock:
+        assert index.resolve(chained) == "epa:1"
+
+def test_batch_keeps_the_most_trusted_source(index):
+    near = station("openaq:9", "openaq", 27.7010, 85.3000)
+    kept = index.merge(readings((near, "pm25", HOUR, 40.0),
+                                (EPA, "pm25", HOUR + pd.Timedelta(minutes=10), 42.0),
+                                (near, "pm10", HOUR, 80.0)))
+    assert kept[["source", "parameter"]].values.tolist() == [["epa", "pm25"], ["openaq", "pm10"]]
+    assert index.superseded == []
+
+def test_aqi_readings_do_not_compete_with_concentrations(index):
+    airnow = station("airnow:1", "airnow", 27.7004, 85.3000, "Ratnapark")
+    openaq = station("openaq:9", "openaq", 27.7000, 85.3000, "Ratnapark")
+    merge.stations.add([airnow], save=False)
+
+    # AirNow outranks OpenAQ, but its AQI is not a pm25 concentration
+    assert len(index.merge(readings((openaq, "pm25", HOUR, 38.0)))) == 1
+    kept = index.merge(readings((airnow, "pm25", HOUR, 107, "AQI")))
+    assert kept["unit"].tolist() == ["AQI"]
+    assert index.superseded == []
+    assert index.sites["airnow:1"] == index.sites["openaq:9"] == "epa:1"
+
+    # Within one batch both kinds survive, and each still dedups against its own kind
+    batch = index.merge(readings((openaq, "pm25", HOUR + pd.Timedelta(hours=1), 40.0),
+                                 (airnow, "pm25", HOUR + pd.Timedelta(hours=1), 110, "AQI"),
+                                 (EPA, "pm25", HOUR + pd.Timedelta(hours=1), 41.0)))
+    assert sorted(zip(batch["source"], batch["unit"])) == [("airnow", "AQI"), ("epa", "µg/m³")]
+
+def test_stored_readings_are_dropped_or_superseded(index):
+    waqi = station("waqi:3", "waqi", 27.7100, 85.3000, "Ratnapark")
+    assert len(index.merge(readings((waqi, "pm25", HOUR, 55.0)))) == 1
+
+    # A more trusted source for the same site and hour replaces the stored reading
+    assert len(index.merge(readings((EPA, "pm25", HOUR + pd.Timedelta(minutes=30), 52.0)))) == 1
+    bucket = merge.bucket_numbers(pd.Series([HOUR.isoformat()]))[0]
+    assert index.superseded == [("waqi:3", "waqi", "pm25", bucket)]
+
+    # A less trusted source arriving later is dropped
+    assert index.merge(readings((waqi, "pm25", HOUR, 55.0))).empty
+    # The next hour is a different reading
+    assert len(index.merge(readings((waqi, "pm25", HOUR + pd.Timedelta(hours=1), 57.0)))) == 1
+
+def test_saved_index_keeps_sites_and_holders(index):
+    waqi = station("waqi:3", "waqi", 27.7100, 85.3000, "Ratnapark")
+    index.merge(readings((EPA, "pm25", HOUR, 52.0)))
+    index.save()
+
+    reloaded = MergeIndex(path=index.path)
+    assert reloaded.merge(readings((waqi, "pm25", HOUR, 55.0))).empty
+    assert reloaded.sites == {"epa:1": "epa:1", "waqi:3": "epa:1"}
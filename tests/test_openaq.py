@@ -0,0 +1,66 @@
+"""Paging of OpenAQ.iter_openaq_pages against a fake measurements endpoint."""
+
+import json
+
+import pandas as pd
+import pytest
+import requests
+
+import http_client
+import OpenAQ
+
+START = pd.Timestamp("2026-10-18T00:00:00Z")
+
+def result(location, hour):
+    return {"locationId": location, "location": f"Station {location}", "parameter": "pm25",
+            "value": 10.0 + location, "unit": "µg/m³",
+            "date": {"utc": (START + pd.Timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%SZ")},
+            "coordinates": {"latitude": 27.7, "longitude": 85.3}}
+
+class FakeAPI:
+    """Serves results sorted by date, refusing pages past MAX_PAGE like the v2 API."""
+
+    MAX_PAGE = 2
+
+    def __init__(self, results):
+        self.results = results
+        self.requests = []
+
+    def get(self, url, params=None, **kwargs):
+        params = dict(params)
+        self.requests.append(params)
+        response = requests.Response()
+        if params["page"] > self.MAX_PAGE:
+            response.status_code = 422
+            response._content = b'{"detail": "page limit"}'
+            return response
+        rows = sorted(self.results, key=lambda r: r["date"]["utc"], reverse=params["sort"] == "desc")
+        if "date_from" in params:
+            rows = [r for r in rows if pd.Timestamp(r["date"]["utc"]) >= pd.Timestamp(params["date_from"])]
+        if "date_to" in params:
+            rows = [r for r in rows if pd.Timestamp(r["date"]["utc"]) <= pd.Timestamp(params["date_to"])]
+        offset = (params["page"] - 1) * params["limit"]
+        response.status_code = 200
+        response._content = json.dumps({"results": rows[offset:offset + params["limit"]]}).encode()
+        return response
+
+@pytest.fixture
+def api(monkeypatch):
+    # Three stations reporting every hour for a day: 72 rows, three per timestamp
+    fake = FakeAPI([result(location, hour) for hour in range(24) for location in (1, 2, 3)])
+    monkeypatch.setattr(http_client, "get", fake.get)
+    return fake
+
+@pytest.mark.parametrize("sort", ["asc", "desc"])
+def test_pages_cover_the_window_past_the_page_limit(api, sort):
+    pages = list(OpenAQ.iter_openaq_pages("NP", page_size=10, sort=sort))
+    rows = pd.concat(pages)
+    assert len(rows) == 72
+    assert not rows.duplicated(["station_id", "timestamp"]).any()
+    assert max(params["page"] for params in api.requests) == 1
+
+def test_one_timestamp_larger_than_a_page_is_stepped_through(api):
+    api.results = [result(location, 0) for location in range(5)] + [result(location, 1) for location in range(5)]
+    rows = pd.concat(OpenAQ.iter_openaq_pages("NP", page_size=3, sort="asc"))
+    assert len(rows) == 10
+    assert not rows.duplicated(["station_id", "timestamp"]).any()
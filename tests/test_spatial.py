@@ -0,0 +1,67 @@
+"""Grid queries of spatial.StationIndex against a brute-force scan."""
+
+import numpy as np
+import pytest
+
+from spatial import BRUTE_FORCE_LIMIT, StationIndex, haversine_km
+
+def random_stations(rng, count, offset=0):
+    # Half spread over the globe, half clustered around the antimeridian and a pole
+    lats = np.concatenate([rng.uniform(-90, 90, count // 2), rng.uniform(60, 90, count - count // 2)])
+    lons = np.concatenate([rng.uniform(-180, 180, count // 2), rng.uniform(170, 190, count - count // 2)])
+    lons = (lons + 180) % 360 - 180
+    return [{"station_id": f"s{offset + i}", "latitude": lat, "longitude": lon,
+             "source": "a" if i % 3 else "b"}
+            for i, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist()))]
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    rng = np.random.default_rng(14)
+    index = StationIndex(path=str(tmp_path_factory.mktemp("spatial") / "stations.json"))
+    index.add(random_stations(rng, 3 * BRUTE_FORCE_LIMIT), save=False)
+    # Added after the merge, so queries also scan the pending list
+    index.add(random_stations(rng, 100, offset=10 ** 6), save=False)
+    assert index.pending
+    return index
+
+def brute_force(index, lat, lon, source=None):
+    distances = haversine_km(lat, lon, index.lat, index.lon)
+    ids = np.array([record["station_id"] for record in index.records])
+    if source is not None:
+        keep = index.sources == source
+        ids, distances = ids[keep], distances[keep]
+    order = np.argsort(distances, kind="stable")
+    return ids[order], distances[order]
+
+QUERIES = [(27.7, 85.3), (0.0, 179.9), (-0.5, -179.8), (75.0, 180.0), (89.5, 10.0), (-89.9, 0.0), (45.0, -120.0)]
+
+@pytest.mark.parametrize("lat, lon", QUERIES)
+@pytest.mark.parametrize("radius_km", [10, 150, 800])
+def test_within_matches_brute_force(index, lat, lon, radius_km):
+    ids, distances = brute_force(index, lat, lon)
+    expected = set(ids[distances <= radius_km].tolist())
+    found = index.within(lat, lon, radius_km)
+    assert {s["station_id"] for s in found} == expected
+    assert [s["distance_km"] for s in found] == sorted(s["distance_km"] for s in found)
+
+@pytest.mark.parametrize("lat, lon", QUERIES)
+@pytest.mark.parametrize("k", [1, 7, 50])
+def test_nearest_matches_brute_force(index, lat, lon, k):
+    _, distances = brute_force(index, lat, lon)
+    found = index.nearest(lat, lon, k=k)
+    assert len(found) == k
+    assert [s["distance_km"] for s in found] == pytest.approx(np.round(distances[:k], 3).tolist(), abs=1e-3)
+
+@pytest.mark.parametrize("lat, lon", QUERIES[:3])
+def test_nearest_filters_by_source_and_distance(index, lat, lon):
+    ids, distances = brute_force(index, lat, lon, source="b")
+    found = index.nearest(lat, lon, k=5, source="b", max_distance_km=2000)
+    assert {s["station_id"] for s in found} == set(ids[:5][distances[:5] <= 2000].tolist())
+    assert all(s["source"] == "b" for s in found)
+
+def test_reloaded_index_answers_the_same(index):
+    index.save()
+    reloaded = StationIndex(path=index.path)
+    assert len(reloaded) == len(index)
+    for lat, lon in QUERIES:
+        assert reloaded.within(lat, lon, 300) == index.within(lat, lon, 300)
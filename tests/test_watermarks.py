@@ -0,0 +1,111 @@
+"""Response validators and watermarks of watermarks.WatermarkStore."""
+
+import pandas as pd
+import pytest
+import requests
+
+from watermarks import WatermarkStore
+
+def make_response(body, status=200, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response.headers.update(headers or {})
+    return response
+
+@pytest.fixture
+def marks(tmp_path):
+    return WatermarkStore("test", directory=str(tmp_path))
+
+def test_new_response_is_changed_and_validators_wait_for_commit(marks, tmp_path):
+    response = make_response(b'{"a": 1}', headers={"ETag": '"v1"'})
+    assert marks.check_response("req", response)
+    assert marks.conditional_headers("req") == {}
+
+    marks.commit(None, ["req"])
+    assert marks.conditional_headers("req") == {"If-None-Match": '"v1"'}
+    assert WatermarkStore("test", directory=str(tmp_path)).conditional_headers("req") == {"If-None-Match": '"v1"'}
+
+def test_uncommitted_response_is_parsed_again(marks):
+    body = b'{"a": 1}'
+    assert marks.check_response("req", make_response(body))
+    # The data was never stored, so the same body must not count as unchanged
+    assert marks.check_response("req", make_response(body))
+
+def test_identical_body_is_unchanged_after_commit(marks):
+    body = b'{"a": 1}'
+    marks.check_response("req", make_response(body))
+    marks.commit(None, ["req"])
+    assert not marks.check_response("req", make_response(body, headers={"ETag": '"v2"'}))
+    # Validators of an unchanged response are refreshed straight away
+    assert marks.conditional_headers("req") == {"If-None-Match": '"v2"'}
+    assert marks.check_response("req", make_response(b'{"a": 2}'))
+
+def test_not_modified_is_unchanged(marks):
+    marks.check_response("req", make_response(b"x", headers={"Last-Modified": "Mon, 05 Oct 2026 10:00:00 GMT"}))
+    marks.commit(None, ["req"])
+    assert not marks.check_response("req", make_response(b"", status=304))
+    assert marks.conditional_headers("req") == {"If-Modified-Since": "Mon, 05 Oct 2026 10:00:00 GMT"}
+
+def test_commit_only_keeps_the_given_requests(marks):
+    marks.check_response("a", make_response(b"1", headers={"ETag": '"a"'}))
+    marks.check_response("b", make_response(b"2", headers={"ETag": '"b"'}))
+    marks.commit(None, ["a"])
+    assert marks.conditional_headers("a") == {"If-None-Match": '"a"'}
+    assert marks.conditional_headers("b") == {}
+
+def test_filter_new_drops_rows_at_or_before_the_watermark(marks):
+    stored = pd.DataFrame({
+        "station_id": ["s1", "s1"],
+        "parameter": ["pm25", "pm25"],
+        "timestamp": ["2026-10-01T10:00:00Z", "2026-10-01T11:00:00Z"]
+    })
+    marks.commit(stored)
+    assert marks.get("s1|pm25") == pd.Timestamp("2026-10-01T11:00:00Z")
+
+    batch = pd.DataFrame({
+        "station_id": ["s1", "s1", "s2"],
+        "parameter": ["pm25", "pm25", "pm25"],
+        "timestamp": ["2026-10-01T11:00:00Z", "2026-10-01T12:00:00Z", "2026-10-01T09:00:00Z"]
+    })
+    new = marks.filter_new(batch)
+    assert new["timestamp"].tolist() == ["2026-10-01T12:00:00Z", "2026-10-01T09:00:00Z"]
+
+def test_advance_never_moves_backwards(marks):
+    marks.advance("q", "2026-10-01T12:00:00Z")
+    marks.advance("q", "2026-10-01T08:00:00")
+    assert marks.get("q") == pd.Timestamp("2026-10-01T12:00:00Z")
+
+def test_saves_from_two_processes_are_merged(tmp_path):
+    # Two stores on the same file stand in for two processes refreshing one source
+    first = WatermarkStore("test", directory=str(tmp_path))
+    second = WatermarkStore("test", directory=str(tmp_path))
+    first.advance("s1|pm25", "2026-10-01T12:00:00Z")
+    first.advance("s2|pm25", "2026-10-01T08:00:00Z")
+    first.check_response("a", make_response(b"1", headers={"ETag": '"a"'}))
+    first.commit(None, ["a"])
+
+    second.advance("s1|pm25", "2026-10-01T10:00:00Z")
+    second.advance("s2|pm25", "2026-10-01T09:00:00Z")
+    second.check_response("b", make_response(b"2", headers={"ETag": '"b"'}))
+    second.commit(None, ["b"])
+
+    merged = WatermarkStore("test", directory=str(tmp_path))
+    assert merged.get("s1|pm25") == pd.Timestamp("2026-10-01T12:00:00Z")
+    assert merged.get("s2|pm25") == pd.Timestamp("2026-10-01T09:00:00Z")
+    assert merged.conditional_headers("a") == {"If-None-Match": '"a"'}
+    assert merged.conditional_headers("b") == {"If-None-Match": '"b"'}
+    # The later saver picked up the other's entries in memory too
+    assert second.conditional_headers("a") == {"If-None-Match": '"a"'}
+
+def test_newer_validators_replace_older_ones_on_disk(tmp_path):
+    first = WatermarkStore("test", directory=str(tmp_path))
+    second = WatermarkStore("test", directory=str(tmp_path))
+    first.check_response("a", make_response(b"1", headers={"ETag": '"v1"'}))
+    first.commit(None, ["a"])
+    second.check_response("a", make_response(b"2", headers={"ETag": '"v2"'}))
+    second.commit(None, ["a"])
+    # A save without new validators must not restore the stale ones
+    first.advance("s1|pm25", "2026-10-01T12:00:00Z")
+    first.save()
+    assert WatermarkStore("test", directory=str(tmp_path)).conditional_headers("a") == {"If-None-Match": '"v2"'}